@@ -0,0 +1,253 @@
+"""
+Администрирование базы карт из командной строки
+
+    python admin.py export --format jsonl --output users.jsonl
+    python admin.py import --format csv --input users.csv
+    python admin.py check
+    python admin.py migrate-legacy
+
+Экспорт и импорт идут потоково, по одному пользователю. С JSON бэкендом
+бот на время любой команды нужно остановить: оба процесса держат базу
+в памяти и перезаписали бы изменения друг друга, поэтому база, открытая
+ботом, не откроется
+"""
+
+import argparse
+import csv
+import json
+import re
+import sys
+from typing import Iterator, Optional, TextIO, Tuple
+
+from config import (
+    DB_BACKEND,
+    DB_FILE,
+    SQLITE_DB_FILE,
+    CARD_NUMBER_LENGTH,
+    BALANCE_HISTORY_RAW_DAYS,
+    BALANCE_HISTORY_DAILY_DAYS
+)
+from storage import Storage, StorageError, create_storage
+from storage import history
+
+CSV_FIELDS = ("chat_id", "card_number", "balance_history", "balance_rollups", "payments",
+              "balance_alert")
+NESTED_FIELDS = ("balance_history", "balance_rollups", "payments", "balance_alert")
+PAYMENT_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def open_storage(backend: str, path: Optional[str]) -> Storage:
+    options = {
+        "history_raw_days": BALANCE_HISTORY_RAW_DAYS,
+        "history_daily_days": BALANCE_HISTORY_DAILY_DAYS
+    }
+    if backend == "json":
+        # Файл пишется целиком один раз при закрытии, а не после каждой записи.
+        # Старые записи переводятся только командой migrate-legacy, а история
+        # при открытии не сворачивается: export и check видят базу такой,
+        # как она на диске, и не перезаписывают файл
+        options.update(flush_interval=3600, flush_max_dirty=sys.maxsize,
+                       migrate_legacy=False, compact_on_open=False)
+        return create_storage(backend, path or DB_FILE, **options)
+    return create_storage(backend, path or SQLITE_DB_FILE, **options)
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_sorted(values: list, strict: bool = False) -> bool:
+    if strict:
+        return all(a < b for a, b in zip(values, values[1:]))
+    return all(a <= b for a, b in zip(values, values[1:]))
+
+
+def validate_user(chat_id: int, user_data: dict) -> list:
+    """Проверяет запись пользователя в формате экспорта, возвращает список проблем"""
+    problems = []
+    card_number = user_data.get("card_number")
+    # Номер хранится без последней (контрольной) цифры
+    if card_number is not None and not (
+            isinstance(card_number, str) and card_number.isdigit()
+            and len(card_number) == CARD_NUMBER_LENGTH - 1):
+        problems.append(f"invalid card number {card_number!r}")
+
+    columns = user_data.get("balance_history") or history.empty_history()
+    if len(columns.get("t", [])) != len(columns.get("b", [])):
+        problems.append("balance history columns differ in length")
+    elif not _is_sorted(columns["t"]):
+        problems.append("balance history is not ordered by time")
+    elif not all(_is_number(value) for value in columns["t"] + columns["b"]):
+        problems.append("balance history contains non-numeric values")
+
+    rollups = user_data.get("balance_rollups") or history.empty_rollups()
+    for level in history.BUCKET_LEVELS:
+        level_columns = rollups.get(level, {})
+        lengths = {len(level_columns.get(field, [])) for field in history.BUCKET_FIELDS}
+        if len(lengths) > 1:
+            problems.append(f"{level} rollups columns differ in length")
+        elif not _is_sorted(level_columns.get("t", []), strict=True):
+            problems.append(f"{level} rollups are not ordered by start")
+
+    for payment_date, payment in (user_data.get("payments") or {}).items():
+        if not PAYMENT_DATE_RE.match(payment_date):
+            problems.append(f"invalid payment date {payment_date!r}")
+        elif not isinstance(payment, dict):
+            problems.append(f"payment {payment_date} is not an object")
+        elif payment.get("amount") is not None and not _is_number(payment["amount"]):
+            problems.append(f"payment {payment_date} has non-numeric amount")
+
+    alert = user_data.get("balance_alert")
+    if alert is not None and not (
+            isinstance(alert, dict) and _is_number(alert.get("threshold")) and alert["threshold"] > 0
+            and (alert.get("baseline") is None or _is_number(alert["baseline"]))):
+        problems.append(f"invalid balance alert {alert!r}")
+
+    return [f"{chat_id}: {problem}" for problem in problems]
+
+
+def write_jsonl(users: Iterator[Tuple[int, dict]], output: TextIO) -> int:
+    count = 0
+    for chat_id, user_data in users:
+        record = {"chat_id": chat_id, **user_data}
+        output.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        count += 1
+    return count
+
+
+def write_csv(users: Iterator[Tuple[int, dict]], output: TextIO) -> int:
+    # Вложенные поля записываются компактным JSON внутри ячейки
+    writer = csv.writer(output)
+    writer.writerow(CSV_FIELDS)
+    count = 0
+    for chat_id, user_data in users:
+        writer.writerow([chat_id, user_data.get("card_number") or ""] + [
+            json.dumps(user_data.get(field), ensure_ascii=False, separators=(",", ":"))
+            for field in NESTED_FIELDS
+        ])
+        count += 1
+    return count
+
+
+def read_jsonl(source: TextIO) -> Iterator[Tuple[int, dict]]:
+    for line_number, line in enumerate(source, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            chat_id = int(record.pop("chat_id"))
+        except (ValueError, KeyError, TypeError) as e:
+            raise StorageError(f"line {line_number}: {e}") from e
+        yield chat_id, record
+
+
+def read_csv(source: TextIO) -> Iterator[Tuple[int, dict]]:
+    csv.field_size_limit(sys.maxsize)
+    for row_number, row in enumerate(csv.DictReader(source), 2):
+        try:
+            record = {"card_number": row["card_number"] or None}
+            for field in NESTED_FIELDS:
+                value = json.loads(row[field]) if row.get(field) else None
+                if value is not None:
+                    record[field] = value
+            yield int(row["chat_id"]), record
+        except (ValueError, KeyError, TypeError) as e:
+            raise StorageError(f"row {row_number}: {e}") from e
+
+
+def command_export(storage: Storage, args) -> int:
+    output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        writer = write_csv if args.format == "csv" else write_jsonl
+        count = writer(storage.iter_users(args.batch_size), output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"Exported {count} users", file=sys.stderr)
+    return 0
+
+
+def command_import(storage: Storage, args) -> int:
+    source = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8", newline="")
+    imported = skipped = 0
+    try:
+        reader = read_csv if args.format == "csv" else read_jsonl
+        for chat_id, user_data in reader(source):
+            problems = validate_user(chat_id, user_data)
+            if problems and not args.force:
+                for problem in problems:
+                    print(f"Skipping {problem}", file=sys.stderr)
+                skipped += 1
+                continue
+            if not args.dry_run:
+                storage.import_user(chat_id, user_data)
+            imported += 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    action = "Validated" if args.dry_run else "Imported"
+    print(f"{action} {imported} users, skipped {skipped}", file=sys.stderr)
+    return 1 if skipped else 0
+
+
+def command_check(storage: Storage, args) -> int:
+    problems = list(storage.check_integrity())
+    checked = 0
+    for chat_id, user_data in storage.iter_users(args.batch_size):
+        problems.extend(validate_user(chat_id, user_data))
+        checked += 1
+
+    legacy = storage.migrate_legacy_users() if args.fix_legacy else 0
+    for problem in problems:
+        print(problem)
+    print(f"Checked {checked} users, found {len(problems)} problems"
+          + (f", migrated {legacy} legacy records" if legacy else ""), file=sys.stderr)
+    return 1 if problems else 0
+
+
+def command_migrate_legacy(storage: Storage, args) -> int:
+    migrated = storage.migrate_legacy_users()
+    print(f"Migrated {migrated} legacy records", file=sys.stderr)
+    return 0
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Card database administration")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default=DB_BACKEND)
+    parser.add_argument("--path", help="database file (defaults to DB_FILE / SQLITE_DB_FILE)")
+    parser.add_argument("--batch-size", type=int, default=500)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="stream all users to JSONL or CSV")
+    export_parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    export_parser.add_argument("--output", default="-")
+    export_parser.set_defaults(handler=command_export)
+
+    import_parser = commands.add_parser("import", help="import users from JSONL or CSV")
+    import_parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    import_parser.add_argument("--input", default="-")
+    import_parser.add_argument("--dry-run", action="store_true", help="only validate records")
+    import_parser.add_argument("--force", action="store_true", help="import records that fail validation")
+    import_parser.set_defaults(handler=command_import)
+
+    check_parser = commands.add_parser("check", help="check the whole database for consistency")
+    check_parser.add_argument("--fix-legacy", action="store_true",
+                              help="also migrate legacy records after the check")
+    check_parser.set_defaults(handler=command_check)
+
+    migrate_parser = commands.add_parser("migrate-legacy", help="convert legacy records in one batch")
+    migrate_parser.set_defaults(handler=command_migrate_legacy)
+
+    args = parser.parse_args(argv)
+    storage = open_storage(args.backend, args.path)
+    try:
+        return args.handler(storage, args)
+    except StorageError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    finally:
+        storage.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
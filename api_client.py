@@ -1,7 +1,368 @@
+import asyncio
+import logging
+import random
+import time
 import aiohttp
-from typing import Optional, List, Dict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Sequence
+
+import codec
+from cache import TTLCache
+from logging_setup import get_trace_id
+from metrics import API_REQUEST_SECONDS
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from rate_limit import TokenBucket
+from config import (
+    API_URL,
+    API_TRACE_ID,
+    API_CHANNEL,
+    API_CONNECT_TIMEOUT,
+    API_READ_TIMEOUT,
+    API_POOL_LIMIT,
+    API_POOL_LIMIT_PER_HOST,
+    API_KEEPALIVE_TIMEOUT,
+    API_DNS_CACHE_TTL,
+    API_CACHE_TTL_SECONDS,
+    API_CACHE_MAX_SIZE,
+    API_RATE_LIMIT_PER_SECOND,
+    API_RATE_LIMIT_BURST,
+    API_REQUEST_TIMEOUT,
+    API_RETRY_ATTEMPTS,
+    API_RETRY_BASE_DELAY,
+    API_RETRY_MAX_DELAY,
+    API_BREAKER_FAILURE_THRESHOLD,
+    API_BREAKER_RESET_SECONDS,
+    API_MAX_RESPONSE_BYTES,
+    API_PARSE_IN_THREAD_BYTES,
+    API_LAZY_PARSE_MIN_BYTES
+)
+
+logger = logging.getLogger(__name__)
+
+# Метка endpoint в метриках задержки
+ACCOUNT_ENDPOINT = "account"
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Поле ответа со списком транзакций (его можно разбирать лениво)
+TRANSACTIONS_FIELD = "transactions"
+
+
+class ResponseTooLargeError(Exception):
+    """Ответ API больше API_MAX_RESPONSE_BYTES"""
+
+
+class ApiUnavailableError(Exception):
+    """API ответило временной ошибкой (429/5xx)"""
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"DNB API returned status {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After: число секунд или HTTP дата"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int) -> float:
+    """Экспоненциальная задержка с полным джиттером для попытки attempt (с 1)"""
+    return random.uniform(0, min(API_RETRY_MAX_DELAY, API_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+@dataclass
+class AccountInfo:
+    """
+    Данные карты из одного ответа API: баланс и транзакции
+    Транзакции - список; codec.LazyArray, декодируемый по мере перебора,
+    только если включен API_LAZY_PARSE_MIN_BYTES и ответ не меньше него
+    """
+
+    balance: Optional[float]
+    transactions: Sequence[Dict] = field(default_factory=list)
+
+
+async def read_body(response: aiohttp.ClientResponse, limit: int = API_MAX_RESPONSE_BYTES) -> bytes:
+    """Читает тело ответа, не больше limit байт (0 - без ограничения)"""
+    if limit and response.content_length is not None and response.content_length > limit:
+        raise ResponseTooLargeError(f"DNB API response is {response.content_length} bytes")
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        body += chunk
+        if limit and len(body) > limit:
+            raise ResponseTooLargeError(f"DNB API response exceeds {limit} bytes")
+    return bytes(body)
+
+
+def decode_body(body: bytes, lazy_min_bytes: int = API_LAZY_PARSE_MIN_BYTES) -> Any:
+    """Декодирует тело ответа; массив транзакций - лениво, если ответ не меньше lazy_min_bytes"""
+    if lazy_min_bytes and len(body) >= lazy_min_bytes:
+        return codec.loads_lazy(body, TRANSACTIONS_FIELD)
+    return codec.loads(body)
+
+
+def parse_account_data(data: Any) -> AccountInfo:
+    """Разбирает ответ API (уже декодированный JSON) в AccountInfo"""
+    # API может возвращать список транзакций в разных форматах
+    # Пытаемся получить из поля "transactions" или взять сам data, если это список
+    if isinstance(data, dict):
+        return AccountInfo(
+            balance=data.get("balance"),
+            transactions=data.get("transactions") or []
+        )
+    if isinstance(data, list):
+        return AccountInfo(balance=None, transactions=data)
+    if isinstance(data, codec.LazyArray):
+        return AccountInfo(balance=None, transactions=data)
+    return AccountInfo(balance=None)
+
+
+class DnbApiClient:
+    """
+    Долгоживущий клиент DNB API
+
+    Держит одну aiohttp сессию с пулом соединений, чтобы запросы
+    переиспользовали TCP+TLS соединения вместо нового рукопожатия на каждый вызов.
+    Успешные ответы кешируются на короткое время, а одновременные запросы
+    одной карты объединяются в один HTTP вызов. Частота обращений к API
+    ограничивается token bucket под квоту DNB.
+
+    Временные ошибки (сеть, таймауты, 429/5xx) повторяются с экспоненциальной
+    задержкой; если API недоступно несколько запросов подряд, circuit breaker
+    размыкается и запросы сразу отклоняются с CircuitOpenError
+    """
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._cache = TTLCache(API_CACHE_TTL_SECONDS, API_CACHE_MAX_SIZE)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._rate_limiter = TokenBucket(API_RATE_LIMIT_PER_SECOND, API_RATE_LIMIT_BURST)
+        self.breaker = CircuitBreaker(API_BREAKER_FAILURE_THRESHOLD, API_BREAKER_RESET_SECONDS)
+
+    async def start(self) -> None:
+        """Создает сессию и пул соединений"""
+        if self._session is not None:
+            return
+
+        connector = aiohttp.TCPConnector(
+            limit=API_POOL_LIMIT,
+            limit_per_host=API_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=API_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=API_DNS_CACHE_TTL,
+            use_dns_cache=True
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=API_REQUEST_TIMEOUT,
+            connect=API_CONNECT_TIMEOUT,
+            sock_read=API_READ_TIMEOUT
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+            headers={
+                "X-Dnbapi-Channel": API_CHANNEL,
+                "Content-Type": "application/json"
+            }
+        )
+
+    async def close(self) -> None:
+        """Закрывает сессию и все соединения пула"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        self._cache.clear()
+
+    async def fetch_account_data(self, card_number: str) -> Optional[Any]:
+        """
+        Запрашивает данные по карте с повторами временных ошибок
+
+        Returns:
+            Разобранный JSON ответа или None, если API отклонило запрос (4xx)
+
+        Raises:
+            CircuitOpenError: API считается недоступным
+            ApiUnavailableError, aiohttp.ClientError, asyncio.TimeoutError:
+                попытки исчерпаны
+        """
+        if self._session is None:
+            raise RuntimeError("DnbApiClient is not started")
+
+        self.breaker.check()
+        try:
+            data = await self._post_with_retries({"accountNumber": card_number})
+        except (ApiUnavailableError, aiohttp.ClientError, asyncio.TimeoutError):
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            self.breaker.release()
+            raise
+        self.breaker.record_success()
+        return data
+
+    async def _post_with_retries(self, body: dict) -> Optional[Any]:
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._rate_limiter.acquire()
+            try:
+                return await self._post(body)
+            except (ApiUnavailableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= API_RETRY_ATTEMPTS:
+                    raise
+                retry_after = getattr(e, "retry_after", None)
+                delay = retry_after if retry_after is not None else backoff_delay(attempt)
+                if delay > API_RETRY_MAX_DELAY:
+                    # Сервер просит подождать дольше, чем имеет смысл держать запрос
+                    raise
+                await asyncio.sleep(delay)
+
+    async def _post(self, body: dict) -> Optional[Any]:
+        """Один HTTP запрос к API с замером задержки"""
+        # Trace id текущего обновления или проверки выплаты, чтобы запрос
+        # можно было найти в логах DNB
+        headers = {"X-Dnbapi-Trace-Id": get_trace_id() or API_TRACE_ID}
+        started = time.perf_counter()
+        status = "error"
+        try:
+            async with self._session.post(API_URL, json=body, headers=headers) as response:
+                status = str(response.status)
+                if response.status == 200:
+                    payload = await read_body(response)
+                    if len(payload) >= API_PARSE_IN_THREAD_BYTES:
+                        # Большой ответ не блокирует event loop на время разбора
+                        loop = asyncio.get_running_loop()
+                        return await loop.run_in_executor(None, decode_body, payload)
+                    return decode_body(payload)
+                if response.status not in RETRYABLE_STATUSES:
+                    return None
+                raise ApiUnavailableError(
+                    response.status,
+                    parse_retry_after(response.headers.get("Retry-After"))
+                )
+        except asyncio.TimeoutError:
+            status = "timeout"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            API_REQUEST_SECONDS.observe(elapsed, endpoint=ACCOUNT_ENDPOINT, status=status)
+            logger.info(
+                "DNB API request",
+                extra={"endpoint": ACCOUNT_ENDPOINT, "status": status,
+                       "duration_ms": round(elapsed * 1000, 1), "sampled": status == "200"}
+            )
+
+    async def fetch_account(self, card_number: str) -> Optional[AccountInfo]:
+        """
+        Получает баланс и транзакции карты одним запросом
+
+        Ответ берется из кеша, если он еще свежий; если запрос по этой карте
+        уже выполняется, вызывающий ждет его результата
+
+        Returns:
+            AccountInfo или None в случае ошибки
+
+        Raises:
+            CircuitOpenError: API временно недоступно
+        """
+        cached = self._cache.get(card_number)
+        if cached is not None:
+            return cached
+
+        # Пока API недоступно, отвечаем сразу, не ставя запрос в очередь
+        if self.breaker.is_open:
+            raise CircuitOpenError(self.breaker.retry_after())
+
+        task = self._inflight.get(card_number)
+        if task is None:
+            task = asyncio.ensure_future(self._load_account(card_number))
+            self._inflight[card_number] = task
+            task.add_done_callback(lambda _: self._inflight.pop(card_number, None))
+
+        # shield: отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    async def _load_account(self, card_number: str) -> Optional[AccountInfo]:
+        try:
+            data = await self.fetch_account_data(card_number)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.warning("Error getting account data: %s", e)
+            return None
+
+        if data is None:
+            return None
+
+        account = parse_account_data(data)
+        self._cache.set(card_number, account)
+        return account
+
+
+_client: Optional[DnbApiClient] = None
+
+
+async def init_api_client() -> DnbApiClient:
+    """Создает общий клиент API (вызывается один раз при запуске бота)"""
+    global _client
+    if _client is None:
+        _client = DnbApiClient()
+        await _client.start()
+    return _client
+
+
+async def close_api_client() -> None:
+    """Закрывает общий клиент API при остановке бота"""
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+def api_retry_after() -> float:
+    """Сколько секунд API еще считается недоступным (0, если доступно)"""
+    if _client is None:
+        return 0.0
+    return _client.breaker.retry_after() if _client.breaker.is_open else 0.0
+
+
+def get_api_client() -> DnbApiClient:
+    """Возвращает общий клиент API"""
+    if _client is None:
+        raise RuntimeError("API client is not initialized, call init_api_client() first")
+    return _client
+
+
+async def fetch_account(card_number: str) -> Optional[AccountInfo]:
+    """
+    Получает баланс и транзакции карты через API DNB
+
+    Args:
+        card_number: Номер карты
+
+    Returns:
+        AccountInfo или None в случае ошибки
+
+    Raises:
+        CircuitOpenError: API временно недоступно
+    """
+    return await get_api_client().fetch_account(card_number)
 
-from config import API_URL, API_TRACE_ID, API_CHANNEL
 
 async def get_card_balance(card_number: str) -> Optional[float]:
     """
@@ -12,64 +373,30 @@ async def get_card_balance(card_number: str) -> Optional[float]:
 
     Returns:
         Баланс карты или None в случае ошибки
+
+    Raises:
+        CircuitOpenError: API временно недоступно
     """
-    headers = {
-        "X-Dnbapi-Trace-Id": API_TRACE_ID,
-        "X-Dnbapi-Channel": API_CHANNEL,
-        "Content-Type": "application/json"
-    }
-
-    body = {
-        "accountNumber": card_number
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_URL, json=body, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get("balance")
-                else:
-                    return None
-    except Exception as e:
-        print(f"Error getting balance: {e}")
+    account = await fetch_account(card_number)
+    if account is None:
         return None
+    return account.balance
 
-async def get_card_transactions(card_number: str) -> Optional[List[Dict]]:
+async def get_card_transactions(card_number: str) -> Optional[Sequence[Dict]]:
     """
     Получает последние транзакции по карте
 
     Args:
         card_number: Номер карты
-        limit: Количество транзакций для получения (по умолчанию 5)
 
     Returns:
-        Список транзакций или None в случае ошибки
+        Транзакции (список или, для больших ответов при включенном
+        API_LAZY_PARSE_MIN_BYTES, codec.LazyArray) или None в случае ошибки
+
+    Raises:
+        CircuitOpenError: API временно недоступно
     """
-    headers = {
-        "X-Dnbapi-Trace-Id": API_TRACE_ID,
-        "X-Dnbapi-Channel": API_CHANNEL,
-        "Content-Type": "application/json"
-    }
-
-    body = {
-        "accountNumber": card_number
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(API_URL, json=body, headers=headers) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    # API может возвращать список транзакций в разных форматах
-                    # Пытаемся получить из поля "transactions" или вернуть сам data, если это список
-                    if isinstance(data, dict):
-                        return data.get("transactions", [])
-                    elif isinstance(data, list):
-                        return data
-                    return []
-                else:
-                    return None
-    except Exception as e:
-        print(f"Error getting transactions: {e}")
+    account = await fetch_account(card_number)
+    if account is None:
         return None
+    return account.transactions
@@ -0,0 +1,145 @@
+"""
+Уведомления об изменении баланса по подписке (/notify <порог>)
+
+Балансы карт с подписками опрашиваются в фоне раз в
+BALANCE_ALERT_INTERVAL_MINUTES, по одному запросу на карту. Новый баланс
+сравнивается с последним известным балансом карты, а для каждого
+подписчика - с опорным балансом, о котором он уже знает (последнее
+уведомление или нажатие кнопки). Уведомление уходит, только когда
+изменение достигает порога пользователя.
+Карты делятся между процессами бота шардами, как и при проверке выплат
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from config import BALANCE_ALERT_INTERVAL_MINUTES, BALANCE_ALERT_CONCURRENCY
+from database import get_alert_cards, record_card_balance
+from api_client import get_card_balance, api_retry_after
+from circuit_breaker import CircuitOpenError
+from logging_setup import trace_context
+from messages import Messages
+from metrics import BALANCE_POLL_SECONDS, BALANCE_ALERTS_QUEUED
+from notifier import wake_dispatcher
+from payment_checker import sleep_or_wake
+from sharding import ShardLeases
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BalancePollStats:
+    """Итоги одного прохода опроса балансов"""
+
+    cards: int = 0
+    changed: int = 0
+    alerts: int = 0
+    errors: int = 0
+    duration: float = 0.0
+
+    def summary(self) -> str:
+        return (
+            f"Balance poll: cards={self.cards} changed={self.changed} "
+            f"alerts={self.alerts} errors={self.errors} time={self.duration:.1f}s"
+        )
+
+
+def select_alerts(balance: float, subscribers: list) -> list:
+    """
+    Пары (chat_id, текст или None) для record_card_balance
+    Подписчику без опорного баланса он только запоминается, без уведомления
+    """
+    alerts = []
+    for chat_id, threshold, baseline in subscribers:
+        if baseline is None:
+            alerts.append((chat_id, None))
+        elif abs(balance - baseline) >= threshold:
+            alerts.append((chat_id, Messages.balance_changed(baseline, balance)))
+    return alerts
+
+
+async def poll_card_balance(card_number: str, last_balance: Optional[float],
+                            subscribers: list, stats: BalancePollStats) -> None:
+    """Запрашивает баланс карты и рассылает уведомления ее подписчикам"""
+    balance = await get_card_balance(card_number)
+    if balance is None:
+        raise RuntimeError("failed to fetch balance")
+
+    alerts = select_alerts(balance, subscribers)
+    if balance == last_balance and not alerts:
+        return
+
+    # Баланс карты, опорные балансы, уведомления и история подписчиков -
+    # одной записью
+    await record_card_balance(card_number, balance, alerts)
+    if balance != last_balance:
+        stats.changed += 1
+
+    queued = sum(1 for _, text in alerts if text is not None)
+    if queued:
+        stats.alerts += queued
+        BALANCE_ALERTS_QUEUED.inc(queued)
+        wake_dispatcher()
+
+
+async def run_balance_poll(work_list: list) -> BalancePollStats:
+    """
+    Опрашивает карты из списка [(card_number, last_balance, subscribers)]
+    не более BALANCE_ALERT_CONCURRENCY одновременно
+    """
+    stats = BalancePollStats(cards=len(work_list))
+    semaphore = asyncio.Semaphore(BALANCE_ALERT_CONCURRENCY)
+    started = time.monotonic()
+
+    async def poll_one(card_number: str, last_balance: Optional[float], subscribers: list) -> None:
+        with trace_context():
+            async with semaphore:
+                while True:
+                    # Пока API недоступно, опрос стоит на паузе
+                    pause = api_retry_after()
+                    if pause > 0:
+                        await asyncio.sleep(pause)
+                        continue
+                    try:
+                        await poll_card_balance(card_number, last_balance, subscribers, stats)
+                    except CircuitOpenError:
+                        continue
+                    except Exception as e:
+                        stats.errors += 1
+                        logger.warning("Error polling balance for users %s: %s",
+                                       ", ".join(chat_id for chat_id, _, _ in subscribers), e)
+                    return
+
+    await asyncio.gather(*(poll_one(*item) for item in work_list))
+
+    stats.duration = time.monotonic() - started
+    BALANCE_POLL_SECONDS.observe(stats.duration)
+    return stats
+
+
+async def balance_alert_task():
+    """Фоновый опрос балансов карт с подписками на уведомления"""
+    interval = BALANCE_ALERT_INTERVAL_MINUTES * 60
+    leases = ShardLeases(kind="balance")
+    shards_changed = asyncio.Event()
+    lease_task = asyncio.create_task(leases.run(on_change=shards_changed.set))
+
+    try:
+        while True:
+            started = time.time()
+            shards_changed.clear()
+            try:
+                work_list = [item for item in await get_alert_cards() if leases.owns(item[0])]
+                if work_list:
+                    stats = await run_balance_poll(work_list)
+                    logger.info(stats.summary())
+            except Exception:
+                logger.exception("Error in balance alert task")
+            # Новые шарды (в том числе первые после запуска) опрашиваются сразу
+            await sleep_or_wake(shards_changed, max(interval - (time.time() - started), 1.0))
+    finally:
+        lease_task.cancel()
+        await asyncio.gather(lease_task, return_exceptions=True)
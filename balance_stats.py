@@ -0,0 +1,83 @@
+"""
+Статистика баланса за период (/stats)
+
+Минимум, максимум, средний баланс и расход за период складываются из
+дневной статистики хранилища (по строке на день), которая обновляется
+при каждой записи истории, а не пересчитываются по всей истории.
+
+График отправляется в Telegram один раз: file_id отправленной картинки
+запоминается для (чат, период) и используется повторно, пока в истории
+не появится новая запись или не начнется новый день
+"""
+
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+from charts import render_balance_chart
+from config import BALANCE_HISTORY_RAW_DAYS, STATS_CHART_WIDTH, STATS_CHART_HEIGHT
+from database import get_balance_history
+from metrics import STATS_CHART_RENDER_SECONDS
+from storage.history import DAY_SECONDS, day_start
+
+# Период -> число дней, включая сегодняшний
+RANGES = {"7d": 7, "30d": 30, "90d": 90, "365d": 365}
+DEFAULT_RANGE = "30d"
+CALLBACK_PREFIX = "stats:"
+
+
+@dataclass
+class BalanceSummary:
+    """Итоги за период по дневной статистике"""
+
+    minimum: float
+    maximum: float
+    average: float
+    spent: float
+    # Дней с первой записи в периоде по сегодняшний включительно
+    days: int
+    count: int
+
+    @property
+    def spent_per_day(self) -> float:
+        return self.spent / self.days
+
+
+def range_start(range_key: str, now: int) -> int:
+    """Начало (UTC день) периода, заканчивающегося сегодня"""
+    return day_start(now) - (RANGES[range_key] - 1) * DAY_SECONDS
+
+
+def summarize(stats: list, now: int) -> Optional[BalanceSummary]:
+    """Сводит дневную статистику [(day, min, max, sum, count, spent), ...]"""
+    if not stats:
+        return None
+    count = sum(row[4] for row in stats)
+    return BalanceSummary(
+        minimum=min(row[1] for row in stats),
+        maximum=max(row[2] for row in stats),
+        average=sum(row[3] for row in stats) / count,
+        spent=sum(row[5] for row in stats),
+        days=(day_start(now) - stats[0][0]) // DAY_SECONDS + 1,
+        count=count
+    )
+
+
+async def load_chart_points(chat_id: int, range_key: str, stats: list, now: int) -> list:
+    """
+    Точки графика: сырая история, если период в нее помещается,
+    иначе средний баланс по дням из дневной статистики
+    """
+    if RANGES[range_key] <= BALANCE_HISTORY_RAW_DAYS:
+        return await get_balance_history(chat_id, range_start(range_key, now))
+    return [(day, total / count) for day, _, _, total, count, _ in stats]
+
+
+def render_chart(points: list, range_key: str, now: int) -> bytes:
+    """Рисует PNG; вызывается в пуле потоков, чтобы не задерживать event loop"""
+    started = time.perf_counter()
+    png = render_balance_chart(
+        points, range_start(range_key, now), now, STATS_CHART_WIDTH, STATS_CHART_HEIGHT
+    )
+    STATS_CHART_RENDER_SECONDS.observe(time.perf_counter() - started)
+    return png
@@ -0,0 +1,10 @@
+"""
+Офлайн бенчмарки бота
+
+    python -m bench.gen_db --users 10000 --output bench_data/cards_db.json
+    python -m bench.dnb_stub --port 8765 --latency-ms 80 --error-rate 0.01
+    python -m bench.run --users 10000 --output bench_results.json
+
+bench.run сам поднимает заглушку DNB API и генерирует базу во временном
+каталоге; результаты пишутся в JSON файл для сравнения между версиями
+"""
@@ -0,0 +1,110 @@
+"""
+Локальная заглушка DNB API для бенчмарков
+
+Отвечает на POST с {"accountNumber": ...} балансом и транзакциями карты.
+Задержка, доля ошибок и число транзакций настраиваются; данные карты
+детерминированы номером карты, поэтому повторные прогоны сопоставимы
+"""
+
+import argparse
+import asyncio
+import random
+import zlib
+from dataclasses import dataclass
+from datetime import date, timedelta
+
+from aiohttp import web
+
+
+@dataclass
+class StubOptions:
+    latency_ms: float = 50.0
+    jitter_ms: float = 20.0
+    error_rate: float = 0.0
+    # Статус временной ошибки (503 - повторяется клиентом)
+    error_status: int = 503
+    transactions: int = 20
+    # Доля карт, у которых среди транзакций есть выплата
+    payment_rate: float = 0.5
+    payment_amount: float = 5000.0
+    seed: int = 1
+
+
+def card_transactions(card_number: str, options: StubOptions, today: date) -> list:
+    """Транзакции карты: мелкие списания и, для части карт, свежая выплата"""
+    rng = random.Random(zlib.crc32(card_number.encode("utf-8")) ^ options.seed)
+    transactions = []
+    if rng.random() < options.payment_rate:
+        transactions.append({
+            "id": f"{card_number}-pay-{today.isoformat()}",
+            "date": today.isoformat(),
+            "amount": {"amount": f"{options.payment_amount:.2f}", "currency": "NOK"}
+        })
+    for index in range(options.transactions - len(transactions)):
+        day = today - timedelta(days=index // 3)
+        transactions.append({
+            "id": f"{card_number}-{index}",
+            "date": day.isoformat(),
+            "amount": {"amount": f"-{rng.uniform(10, 500):.2f}", "currency": "NOK"}
+        })
+    return transactions
+
+
+def build_stub_app(options: StubOptions) -> web.Application:
+    rng = random.Random(options.seed)
+    app = web.Application()
+    app["requests"] = 0
+
+    async def account_handler(request: web.Request) -> web.Response:
+        app["requests"] += 1
+        body = await request.json()
+        card_number = str(body.get("accountNumber", ""))
+
+        delay = max(0.0, rng.gauss(options.latency_ms, options.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+        if rng.random() < options.error_rate:
+            return web.json_response({"error": "unavailable"}, status=options.error_status)
+
+        transactions = card_transactions(card_number, options, date.today())
+        balance = 1000.0 + zlib.crc32(card_number.encode("utf-8")) % 100000 / 10
+        return web.json_response({"balance": balance, "transactions": transactions})
+
+    app.router.add_post("/{tail:.*}", account_handler)
+    return app
+
+
+async def start_stub(host: str, port: int, options: StubOptions) -> web.AppRunner:
+    """Запускает заглушку; остановка - runner.cleanup()"""
+    runner = web.AppRunner(build_stub_app(options), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=host, port=port).start()
+    return runner
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local DNB API stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=StubOptions.latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=StubOptions.jitter_ms)
+    parser.add_argument("--error-rate", type=float, default=StubOptions.error_rate)
+    parser.add_argument("--transactions", type=int, default=StubOptions.transactions)
+    parser.add_argument("--payment-rate", type=float, default=StubOptions.payment_rate)
+    parser.add_argument("--seed", type=int, default=StubOptions.seed)
+    args = parser.parse_args()
+
+    options = StubOptions(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        transactions=args.transactions,
+        payment_rate=args.payment_rate,
+        seed=args.seed
+    )
+    print(f"DNB API stub listening on http://{args.host}:{args.port}/")
+    web.run_app(build_stub_app(options), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
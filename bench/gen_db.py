@@ -0,0 +1,75 @@
+"""
+Генератор синтетической базы cards_db.json
+
+Пишет базу в текущем формате JSON бэкенда потоково, по одному
+пользователю, поэтому годится и для миллиона записей
+"""
+
+import argparse
+import json
+import random
+import time
+from typing import Iterator, Tuple
+
+from config import CARD_NUMBER_LENGTH
+
+DAY_SECONDS = 24 * 3600
+
+
+def card_number_for(chat_id: int) -> str:
+    # Номер хранится без последней цифры
+    return str(10 ** (CARD_NUMBER_LENGTH - 2) + chat_id)[: CARD_NUMBER_LENGTH - 1]
+
+
+def generate_users(count: int, history_points: int = 30, seed: int = 1,
+                   now: int = None, cards: int = 0) -> Iterator[Tuple[str, dict]]:
+    """
+    Пары (chat_id, запись пользователя) с историей балансов за history_points дней
+    При cards > 0 пользователи делят между собой cards разных карт
+    """
+    rng = random.Random(seed)
+    now = int(now or time.time())
+    for index in range(count):
+        chat_id = 100000 + index
+        timestamps, balances = [], []
+        balance = round(rng.uniform(100, 20000), 2)
+        for day in range(history_points, 0, -1):
+            balance = round(max(0.0, balance + rng.uniform(-800, 600)), 2)
+            timestamps.append(now - day * DAY_SECONDS + rng.randrange(DAY_SECONDS))
+            balances.append(balance)
+        yield str(chat_id), {
+            "card_number": card_number_for(100000 + index % cards if cards else chat_id),
+            "balance_history": {"t": timestamps, "b": balances},
+            "payments": {}
+        }
+
+
+def write_db(path: str, count: int, history_points: int = 30, seed: int = 1,
+             cards: int = 0) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{")
+        users = generate_users(count, history_points, seed, cards=cards)
+        for index, (chat_id, user) in enumerate(users):
+            if index:
+                f.write(",")
+            f.write(f"\n{json.dumps(chat_id)}: {json.dumps(user, separators=(',', ':'))}")
+        f.write("\n}\n")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate a synthetic cards_db.json")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=30, help="balance history points per user")
+    parser.add_argument("--cards", type=int, default=0,
+                        help="distinct cards shared by the users, 0 - one card per user")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="cards_db.json")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    write_db(args.output, args.users, args.history, args.seed, args.cards)
+    print(f"Wrote {args.users} users to {args.output} in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
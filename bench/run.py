@@ -0,0 +1,333 @@
+"""
+Сценарии нагрузки: обработчик баланса, проход проверки выплат, хранилище
+
+Каждый прогон поднимает заглушку DNB API, генерирует синтетическую базу
+во временном каталоге и пишет результаты в JSON файл:
+
+    python -m bench.run --users 10000 --scenario all --output bench_results.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from bench.dnb_stub import StubOptions, start_stub
+
+SCENARIOS = ("balance", "sweep", "storage")
+
+
+def summarize(samples: list) -> dict:
+    """Сводка задержек в миллисекундах"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": round(ordered[-1] * 1000, 3)
+    }
+
+
+def configure_env(args, workdir: str) -> None:
+    """
+    Настройки бота для прогона; задаются до импорта модулей бота
+    (в том числе bench.gen_db), потому что config читает окружение при импорте
+    """
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench-token",
+        "DB_BACKEND": args.backend,
+        "DB_FILE": os.path.join(workdir, "cards_db.json"),
+        "SQLITE_DB_FILE": os.path.join(workdir, "cards.sqlite3"),
+        "API_URL": f"http://127.0.0.1:{args.stub_port}/account",
+        "API_RATE_LIMIT_PER_SECOND": str(args.api_rate),
+        "API_CACHE_TTL_SECONDS": "0",
+        "PAYMENT_CHECK_CONCURRENCY": str(args.concurrency),
+        # Повторы одного чата в прогоне идут подряд, окно их бы отбросило
+        "BALANCE_THROTTLE_SECONDS": "0",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": "WARNING"
+    })
+
+
+async def feed_balance_requests(dp, bot, chat_ids: list, requests: int, concurrency: int) -> list:
+    from aiogram.types import Chat, Message, Update
+    from messages import ButtonTexts
+
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def one(index: int) -> None:
+        chat_id = chat_ids[index % len(chat_ids)]
+        update = Update(update_id=index, message=Message(
+            message_id=index,
+            date=datetime.now(),
+            chat=Chat(id=chat_id, type="private"),
+            text=ButtonTexts.GET_BALANCE
+        ))
+        async with semaphore:
+            started = time.perf_counter()
+            await dp.feed_update(bot, update)
+            samples.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(index) for index in range(requests)))
+    return samples
+
+
+async def scenario_balance(args, chat_ids: list) -> dict:
+    """Пропускная способность и задержка обработчика кнопки баланса"""
+    from aiogram import Bot
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import EditMessageText, SendMessage
+    from aiogram.types import Chat, Message
+
+    import main as bot_main
+    from api_client import init_api_client, close_api_client
+    from metrics import UPDATES_DROPPED
+
+    class FakeSession(BaseSession):
+        """Сессия Telegram без сети: ответы собираются локально"""
+
+        async def make_request(self, bot, method, timeout=None):
+            if isinstance(method, (SendMessage, EditMessageText)):
+                return Message(
+                    message_id=1,
+                    date=datetime.now(),
+                    chat=Chat(id=method.chat_id, type="private"),
+                    text=method.text
+                ).as_(bot)
+            return True
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def close(self):
+            pass
+
+    bot = Bot(token=os.environ["BOT_TOKEN"], session=FakeSession())
+    await init_api_client()
+    try:
+        started = time.perf_counter()
+        samples = await feed_balance_requests(
+            bot_main.dp, bot, chat_ids, args.requests, args.concurrency
+        )
+        wall = time.perf_counter() - started
+    finally:
+        await close_api_client()
+
+    result = summarize(samples)
+    # Повторы одного чата, пока его запрос выполняется, отбрасываются middleware
+    result["dropped"] = int(UPDATES_DROPPED.value(group="balance"))
+    result["wall_seconds"] = round(wall, 3)
+    result["throughput_rps"] = round(len(samples) / wall, 1) if wall else None
+    return result
+
+
+async def scenario_sweep(args, stub) -> dict:
+    """Полный проход проверки выплат по всем пользователям"""
+    from api_client import init_api_client, close_api_client
+    from database import get_unpaid_cards
+    from payment_checker import run_payment_sweep
+
+    period = datetime.now().strftime("%Y-%m-%d")
+    await init_api_client()
+    try:
+        requests_before = stub.app["requests"]
+        started = time.perf_counter()
+        work_list = await get_unpaid_cards(period)
+        listed = time.perf_counter() - started
+        stats = await run_payment_sweep(period, work_list)
+        wall = time.perf_counter() - started
+    finally:
+        await close_api_client()
+
+    return {
+        "cards": len(work_list),
+        "users": sum(len(chat_ids) for _, chat_ids in work_list),
+        "work_list_seconds": round(listed, 3),
+        "wall_seconds": round(wall, 3),
+        "checked": stats.checked,
+        "found": stats.found,
+        "errors": stats.errors,
+        "api_requests": stub.app["requests"] - requests_before,
+        "cards_per_second": round(stats.checked / wall, 1) if wall else None
+    }
+
+
+def measure(operation, count: int) -> list:
+    samples = []
+    for index in range(count):
+        started = time.perf_counter()
+        operation(index)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def scenario_storage(args, source_db: str, workdir: str) -> dict:
+    """Стоимость чтения и записи для каждого бэкенда хранилища"""
+    from storage import create_storage
+    from storage.migrate import migrate_json_to_sqlite
+
+    rng = random.Random(args.seed)
+    chat_ids = [100000 + rng.randrange(args.users) for _ in range(args.storage_ops)]
+    results = {}
+
+    for backend in ("json", "sqlite"):
+        path = os.path.join(workdir, f"storage-bench.{backend}")
+        started = time.perf_counter()
+        if backend == "json":
+            shutil.copyfile(source_db, path)
+        else:
+            migrate_json_to_sqlite(source_db, path)
+        prepare = time.perf_counter() - started
+
+        started = time.perf_counter()
+        store = create_storage(backend, path)
+        open_seconds = time.perf_counter() - started
+
+        now = int(time.time())
+        reads = measure(lambda i: store.get_card_number(chat_ids[i]), len(chat_ids))
+        writes = measure(
+            lambda i: store.add_balance_history(chat_ids[i], now + i, float(i)), len(chat_ids)
+        )
+        history = measure(lambda i: store.get_balance_history(chat_ids[i]), len(chat_ids))
+
+        started = time.perf_counter()
+        unpaid = store.get_unpaid_cards(datetime.now().strftime("%Y-%m-%d"))
+        scan = time.perf_counter() - started
+
+        started = time.perf_counter()
+        store.close()
+        close_seconds = time.perf_counter() - started
+
+        results[backend] = {
+            "prepare_seconds": round(prepare, 3),
+            "open_seconds": round(open_seconds, 3),
+            "get_card_number": summarize(reads),
+            "add_balance_history": summarize(writes),
+            "get_balance_history": summarize(history),
+            "get_unpaid_cards_seconds": round(scan, 3),
+            "unpaid_cards": len(unpaid),
+            "close_seconds": round(close_seconds, 3),
+            "file_bytes": os.path.getsize(path)
+        }
+    return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def run(args, workdir: str) -> dict:
+    configure_env(args, workdir)
+    from bench.gen_db import write_db
+
+    started = time.perf_counter()
+    write_db(os.environ["DB_FILE"], args.users, args.history, args.seed, args.cards)
+    generated = time.perf_counter() - started
+    source_db = os.path.join(workdir, "source.json")
+    shutil.copyfile(os.environ["DB_FILE"], source_db)
+
+    if args.backend == "sqlite":
+        from storage.migrate import migrate_json_to_sqlite
+        migrate_json_to_sqlite(source_db, os.environ["SQLITE_DB_FILE"])
+
+    options = StubOptions(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        transactions=args.transactions,
+        payment_rate=args.payment_rate,
+        seed=args.seed
+    )
+    stub = await start_stub("127.0.0.1", args.stub_port, options)
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = {"generate_db_seconds": round(generated, 3)}
+    try:
+        chat_ids = [100000 + index for index in range(args.users)]
+        if "balance" in scenarios:
+            results["balance"] = await scenario_balance(args, chat_ids)
+        if "sweep" in scenarios:
+            results["sweep"] = await scenario_sweep(args, stub)
+    finally:
+        from database import close_db
+        await close_db()
+        await stub.cleanup()
+
+    if "storage" in scenarios:
+        results["storage"] = scenario_storage(args, source_db, workdir)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run offline bot benchmarks")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json",
+                        help="storage backend for the balance and sweep scenarios")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=30)
+    parser.add_argument("--cards", type=int, default=0,
+                        help="distinct cards shared by the users, 0 - one card per user")
+    parser.add_argument("--requests", type=int, default=500, help="balance requests to send")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--storage-ops", type=int, default=2000)
+    parser.add_argument("--api-rate", type=float, default=0, help="API rate limit, 0 - unlimited")
+    parser.add_argument("--latency-ms", type=float, default=StubOptions.latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=StubOptions.jitter_ms)
+    parser.add_argument("--error-rate", type=float, default=StubOptions.error_rate)
+    parser.add_argument("--transactions", type=int, default=StubOptions.transactions)
+    parser.add_argument("--payment-rate", type=float, default=StubOptions.payment_rate)
+    parser.add_argument("--stub-port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--keep-data", action="store_true", help="keep the generated data directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    try:
+        results = asyncio.run(run(args, workdir))
+    finally:
+        if args.keep_data:
+            print(f"Benchmark data kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": vars(args),
+        "results": results
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
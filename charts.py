@@ -0,0 +1,119 @@
+"""
+Графики баланса в PNG без внешних зависимостей
+
+Баланс не меняется до следующей записи, поэтому график ступенчатый.
+Подписи (значения и период) идут в текст сообщения, на картинке только
+сетка, линия баланса и заливка под ней. Точки, попавшие в один столбец
+пикселей, сводятся в один отрезок, поэтому время отрисовки зависит от
+размера картинки, а не от длины истории
+"""
+
+import struct
+import zlib
+from typing import List, Sequence, Tuple
+
+BACKGROUND = (255, 255, 255)
+GRID = (226, 230, 236)
+AXIS = (160, 168, 178)
+LINE = (0, 114, 114)
+FILL = (214, 236, 236)
+MARGIN = 16
+GRID_LINES = 4
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return (struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+
+def encode_png(width: int, height: int, rows: Sequence[bytes]) -> bytes:
+    """PNG из строк RGB, каждая строка начинается с байта фильтра"""
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + _chunk(b"IHDR", header)
+            + _chunk(b"IDAT", zlib.compress(b"".join(rows), 6)) + _chunk(b"IEND", b""))
+
+
+class Canvas:
+    """RGB холст из строк, рисуются только прямоугольники"""
+
+    def __init__(self, width: int, height: int, color: Tuple[int, int, int] = BACKGROUND):
+        self.width = width
+        self.height = height
+        blank = b"\x00" + bytes(color) * width
+        self.rows: List[bytearray] = [bytearray(blank) for _ in range(height)]
+
+    def rect(self, x0: int, x1: int, y0: int, y1: int, color: Tuple[int, int, int]) -> None:
+        """Закрашивает прямоугольник с углами (x0, y0) и (x1, y1) включительно"""
+        x0, x1 = max(min(x0, x1), 0), min(max(x0, x1), self.width - 1)
+        y0, y1 = max(min(y0, y1), 0), min(max(y0, y1), self.height - 1)
+        if x0 > x1 or y0 > y1:
+            return
+        pixels = bytes(color) * (x1 - x0 + 1)
+        for y in range(y0, y1 + 1):
+            self.rows[y][1 + x0 * 3:1 + (x1 + 1) * 3] = pixels
+
+    def to_png(self) -> bytes:
+        return encode_png(self.width, self.height, self.rows)
+
+
+def _columns(points: Sequence[Tuple[int, float]], to_x) -> list:
+    """Сводит точки по столбцам: [x, минимум, максимум, последний баланс]"""
+    columns = []
+    for ts, balance in points:
+        x = to_x(ts)
+        if columns and columns[-1][0] == x:
+            column = columns[-1]
+            column[1] = min(column[1], balance)
+            column[2] = max(column[2], balance)
+            column[3] = balance
+        else:
+            columns.append([x, balance, balance, balance])
+    return columns
+
+
+def render_balance_chart(points: Sequence[Tuple[int, float]], start: int, end: int,
+                         width: int = 800, height: int = 400) -> bytes:
+    """
+    Ступенчатый график баланса за [start, end] в PNG
+    points - [(timestamp, balance), ...] по возрастанию времени
+    """
+    canvas = Canvas(width, height)
+    left, right = MARGIN, width - 1 - MARGIN
+    top, bottom = MARGIN, height - 1 - MARGIN
+
+    for index in range(GRID_LINES + 1):
+        y = top + round(index * (bottom - top) / GRID_LINES)
+        canvas.rect(left, right, y, y, GRID)
+    canvas.rect(left, right, bottom, bottom, AXIS)
+
+    points = [(ts, balance) for ts, balance in points if start <= ts <= end]
+    if not points:
+        return canvas.to_png()
+
+    low = min(balance for _, balance in points)
+    high = max(balance for _, balance in points)
+    padding = (high - low) * 0.05 or max(abs(high) * 0.05, 1.0)
+    low, high = low - padding, high + padding
+    span = max(end - start, 1)
+
+    def to_x(ts: int) -> int:
+        return left + round((ts - start) / span * (right - left))
+
+    def to_y(balance: float) -> int:
+        return bottom - round((balance - low) / (high - low) * (bottom - top))
+
+    columns = _columns(points, to_x)
+    # Сначала заливка, затем линия поверх нее
+    for index, (x, _, _, last) in enumerate(columns):
+        next_x = columns[index + 1][0] if index + 1 < len(columns) else right
+        canvas.rect(x, next_x, to_y(last) + 1, bottom - 1, FILL)
+
+    previous = None
+    for index, (x, column_min, column_max, last) in enumerate(columns):
+        next_x = columns[index + 1][0] if index + 1 < len(columns) else right
+        if previous is not None:
+            column_min, column_max = min(column_min, previous), max(column_max, previous)
+        canvas.rect(x - 1, x + 1, to_y(column_max), to_y(column_min), LINE)
+        canvas.rect(x, next_x, to_y(last) - 1, to_y(last) + 1, LINE)
+        previous = last
+    return canvas.to_png()
@@ -0,0 +1,72 @@
+"""
+Circuit breaker для внешних сервисов
+"""
+
+import time
+
+
+class CircuitOpenError(Exception):
+    """Сервис считается недоступным: запрос отклонен без обращения к нему"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"circuit is open, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Размыкается после failure_threshold неудач подряд и на reset_timeout
+    секунд отклоняет все запросы. Затем пропускает один пробный запрос:
+    успех замыкает цепь, неудача снова размыкает ее
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        """True, пока запросы отклоняются"""
+        return self._opened_at is not None and self.retry_after() > 0
+
+    def retry_after(self) -> float:
+        """Через сколько секунд стоит повторить попытку"""
+        if self._opened_at is None:
+            return 0.0
+        remaining = self._opened_at + self.reset_timeout - time.monotonic()
+        if remaining > 0:
+            return remaining
+        # Время вышло, но пробный запрос еще выполняется
+        return 1.0 if self._probing else 0.0
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос прямо сейчас"""
+        if self._opened_at is None:
+            return True
+        if self.retry_after() > 0:
+            return False
+        self._probing = True
+        return True
+
+    def check(self) -> None:
+        """Как allow(), но бросает CircuitOpenError"""
+        if not self.allow():
+            raise CircuitOpenError(self.retry_after())
+
+    def record_success(self) -> None:
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def release(self) -> None:
+        """Запрос прерван без результата: следующий запрос снова может быть пробным"""
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self._probing or self._failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+            self._probing = False
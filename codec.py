@@ -0,0 +1,204 @@
+"""
+Сериализация JSON с подключаемым кодеком
+
+По умолчанию используется orjson, если он установлен, иначе стандартный
+json. Вывод всегда компактный, в UTF-8, без экранирования не-ASCII символов.
+
+loads_lazy разбирает документ, не декодируя большой массив целиком:
+элементы декодируются по мере перебора, поэтому перебор можно прервать
+на первом подходящем элементе. Разбор идет на Python и в 3-5 раз медленнее
+loads, зато расходует в разы меньше памяти - он нужен только для очень
+больших документов
+"""
+
+import json
+import re
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен
+    orjson = None
+
+JsonData = Union[bytes, bytearray, memoryview, str]
+
+
+class Codec:
+    """Стандартный json"""
+
+    name = "json"
+
+    def loads(self, data: JsonData) -> Any:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class OrjsonCodec(Codec):
+    """orjson: разбор и запись в несколько раз быстрее стандартного json"""
+
+    name = "orjson"
+
+    def loads(self, data: JsonData) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+
+_codec: Codec = OrjsonCodec() if orjson is not None else Codec()
+
+
+def use_codec(name: str) -> None:
+    """Выбирает кодек: "orjson", "json" или "auto" (orjson, если установлен)"""
+    global _codec
+    if name == "auto":
+        _codec = OrjsonCodec() if orjson is not None else Codec()
+    elif name == "orjson":
+        if orjson is None:
+            raise ImportError("orjson is not installed")
+        _codec = OrjsonCodec()
+    elif name == "json":
+        _codec = Codec()
+    else:
+        raise ValueError(f"Unknown JSON codec: {name}")
+
+
+def codec_name() -> str:
+    return _codec.name
+
+
+def loads(data: JsonData) -> Any:
+    return _codec.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Компактный JSON в UTF-8"""
+    return _codec.dumps(obj)
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Строки целиком и скобки: внутри строк скобки не считаются
+_STRUCTURE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.DOTALL)
+
+
+_CLOSING = {"[": "]", "{": "}"}
+
+
+def _skip_whitespace(text: str, index: int) -> int:
+    return _WHITESPACE.match(text, index).end()
+
+
+def _next_char(text: str, index: int) -> Tuple[str, int]:
+    """Первый значимый символ с позиции index и его позиция"""
+    index = _skip_whitespace(text, index)
+    if index >= len(text):
+        raise ValueError("Unexpected end of JSON document")
+    return text[index], index
+
+
+def _value_end(text: str, index: int) -> int:
+    """Конец JSON массива или объекта, начинающегося в index; содержимое не декодируется"""
+    expected = []
+    for match in _STRUCTURE.finditer(text, index):
+        token = match.group()
+        if token in _CLOSING:
+            expected.append(_CLOSING[token])
+        elif token in "]}":
+            if not expected or expected.pop() != token:
+                raise ValueError(f"Unexpected {token!r} at position {match.start()}")
+            if not expected:
+                return match.end()
+    raise ValueError("Unterminated JSON value")
+
+
+class LazyArray:
+    """
+    JSON массив, элементы которого декодируются при первом обращении
+
+    Уже декодированные элементы запоминаются, поэтому повторный и
+    одновременный перебор (например, из кеша ответов API) безопасен
+    """
+
+    def __init__(self, text: str, start: int):
+        # start - позиция открывающей скобки массива
+        self._text: Optional[str] = text
+        self._position = start + 1
+        self._items: List[Any] = []
+
+    def _decode_next(self) -> bool:
+        text = self._text
+        if text is None:
+            return False
+        char, index = _next_char(text, self._position)
+        if char == "]":
+            self._text = None
+            return False
+        item, index = _decoder.raw_decode(text, index)
+        char, index = _next_char(text, index)
+        if char == ",":
+            index += 1
+        elif char != "]":
+            raise ValueError(f"Expected ',' or ']' at position {index}")
+        self._position = index
+        self._items.append(item)
+        return True
+
+    def __iter__(self) -> Iterator[Any]:
+        index = 0
+        while index < len(self._items) or self._decode_next():
+            yield self._items[index]
+            index += 1
+
+    def _decode_all(self) -> List[Any]:
+        while self._decode_next():
+            pass
+        return self._items
+
+    def __len__(self) -> int:
+        return len(self._decode_all())
+
+    def __getitem__(self, index):
+        return self._decode_all()[index]
+
+    def __bool__(self) -> bool:
+        return bool(self._items) or self._decode_next()
+
+
+def loads_lazy(data: JsonData, lazy_key: str) -> Any:
+    """
+    Разбирает JSON документ, оставляя массив lazy_key верхнего уровня
+    (или сам документ, если он массив) неразобранным - вместо него LazyArray
+    """
+    text = bytes(data).decode("utf-8") if not isinstance(data, str) else data
+    char, index = _next_char(text, 0)
+    if char == "[":
+        return LazyArray(text, index)
+    if char != "{":
+        return _decoder.decode(text)
+
+    result = {}
+    char, index = _next_char(text, index + 1)
+    if char == "}":
+        return result
+    while True:
+        key, index = _decoder.raw_decode(text, index)
+        char, index = _next_char(text, index)
+        if char != ":":
+            raise ValueError(f"Expected ':' at position {index}")
+        char, index = _next_char(text, index + 1)
+        if key == lazy_key and char == "[":
+            result[key] = LazyArray(text, index)
+            index = _value_end(text, index)
+        else:
+            result[key], index = _decoder.raw_decode(text, index)
+        char, index = _next_char(text, index)
+        if char == "}":
+            return result
+        if char != ",":
+            raise ValueError(f"Expected ',' or '}}' at position {index}")
+        index = _skip_whitespace(text, index + 1)
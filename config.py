@@ -11,14 +11,84 @@ load_dotenv()
 
 # Telegram Bot
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling или webhook
+
+# Логирование
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))  # доля записей частых событий
+
+# Webhook (BOT_MODE=webhook)
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")  # публичный https адрес бота
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # обязателен в режиме webhook
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+HEALTH_PATH = os.getenv("HEALTH_PATH", "/healthz")
+
+# Метрики Prometheus (METRICS_PORT=0 - выключены)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
 
 # Database
+DB_BACKEND = os.getenv("DB_BACKEND", "json")  # json или sqlite
 DB_FILE = os.getenv("DB_FILE", "cards_db.json")
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE", "cards_db.sqlite3")
+# Расположение базы в прежних версиях: пока там лежит файл, а базы по DB_FILE
+# (SQLITE_DB_FILE) еще нет, бот не запускается, чтобы не начать с пустой базы
+LEGACY_DB_FILE = os.getenv("LEGACY_DB_FILE", "")
+DB_FLUSH_INTERVAL_SECONDS = float(os.getenv("DB_FLUSH_INTERVAL_SECONDS", "5"))
+DB_FLUSH_MAX_DIRTY = int(os.getenv("DB_FLUSH_MAX_DIRTY", "100"))
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+BALANCE_HISTORY_RAW_DAYS = int(os.getenv("BALANCE_HISTORY_RAW_DAYS", "30"))  # затем агрегаты по дням
+BALANCE_HISTORY_DAILY_DAYS = int(os.getenv("BALANCE_HISTORY_DAILY_DAYS", "365"))  # затем по неделям
 
 # DNB API
 API_URL = os.getenv("API_URL", "https://api-open.ccp.dnb.no/v1/kronekort/balance")
-API_TRACE_ID = os.getenv("API_TRACE_ID", "")
+API_TRACE_ID = os.getenv("API_TRACE_ID", "")  # используется, если у запроса нет своего trace id
 API_CHANNEL = os.getenv("API_CHANNEL", "BMPULS")
+API_CONNECT_TIMEOUT = float(os.getenv("API_CONNECT_TIMEOUT", "5"))
+API_READ_TIMEOUT = float(os.getenv("API_READ_TIMEOUT", "15"))
+API_POOL_LIMIT = int(os.getenv("API_POOL_LIMIT", "100"))
+API_POOL_LIMIT_PER_HOST = int(os.getenv("API_POOL_LIMIT_PER_HOST", "20"))
+API_KEEPALIVE_TIMEOUT = float(os.getenv("API_KEEPALIVE_TIMEOUT", "30"))
+API_DNS_CACHE_TTL = int(os.getenv("API_DNS_CACHE_TTL", "300"))
+API_CACHE_TTL_SECONDS = float(os.getenv("API_CACHE_TTL_SECONDS", "30"))
+API_CACHE_MAX_SIZE = int(os.getenv("API_CACHE_MAX_SIZE", "1024"))
+API_RATE_LIMIT_PER_SECOND = float(os.getenv("API_RATE_LIMIT_PER_SECOND", "5"))  # 0 - без ограничения
+API_RATE_LIMIT_BURST = float(os.getenv("API_RATE_LIMIT_BURST", "10"))
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", "20"))
+API_RETRY_ATTEMPTS = int(os.getenv("API_RETRY_ATTEMPTS", "3"))
+API_RETRY_BASE_DELAY = float(os.getenv("API_RETRY_BASE_DELAY", "0.5"))
+API_RETRY_MAX_DELAY = float(os.getenv("API_RETRY_MAX_DELAY", "10"))
+API_BREAKER_FAILURE_THRESHOLD = int(os.getenv("API_BREAKER_FAILURE_THRESHOLD", "5"))
+API_BREAKER_RESET_SECONDS = float(os.getenv("API_BREAKER_RESET_SECONDS", "60"))
+API_MAX_RESPONSE_BYTES = int(os.getenv("API_MAX_RESPONSE_BYTES", "4194304"))  # 0 - без ограничения
+# Ответы от этого размера декодируются в пуле потоков, а не в event loop
+API_PARSE_IN_THREAD_BYTES = int(os.getenv("API_PARSE_IN_THREAD_BYTES", "262144"))
+# Ленивый разбор транзакций для ответов от этого размера (0 - выключен):
+# в 3-5 раз медленнее полного разбора, но на 20 000 транзакций держит
+# в памяти ~4 МБ вместо ~20 МБ
+API_LAZY_PARSE_MIN_BYTES = int(os.getenv("API_LAZY_PARSE_MIN_BYTES", "0"))
+
+# Состояния диалогов (FSM): database - в базе бота, общие для процессов (только SQLite);
+# memory - только в процессе; auto - database с SQLite, иначе memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "auto")
+FSM_STATE_TTL_SECONDS = float(os.getenv("FSM_STATE_TTL_SECONDS", "86400"))  # с последнего изменения
+FSM_CACHE_SECONDS = float(os.getenv("FSM_CACHE_SECONDS", "2"))
+FSM_CACHE_MAX_SIZE = int(os.getenv("FSM_CACHE_MAX_SIZE", "10000"))
+
+# Уведомления об изменении баланса (/notify); 0 - фоновый опрос выключен
+BALANCE_ALERT_INTERVAL_MINUTES = float(os.getenv("BALANCE_ALERT_INTERVAL_MINUTES", "30"))
+BALANCE_ALERT_CONCURRENCY = int(os.getenv("BALANCE_ALERT_CONCURRENCY", "5"))
+
+# Статистика баланса (/stats): размер графика в пикселях
+STATS_CHART_WIDTH = int(os.getenv("STATS_CHART_WIDTH", "800"))
+STATS_CHART_HEIGHT = int(os.getenv("STATS_CHART_HEIGHT", "400"))
+
+# Повторные нажатия кнопки баланса в течение окна отбрасываются (0 - только параллельные)
+BALANCE_THROTTLE_SECONDS = float(os.getenv("BALANCE_THROTTLE_SECONDS", "3"))
 
 # Card validation
 CARD_NUMBER_LENGTH = int(os.getenv("CARD_NUMBER_LENGTH", "12"))
@@ -27,6 +97,30 @@ CARD_NUMBER_LENGTH = int(os.getenv("CARD_NUMBER_LENGTH", "12"))
 PAYMENT_DATES = [int(x.strip()) for x in os.getenv("PAYMENT_DATES", "1,16").split(",")]
 PAYMENT_CHECK_DAYS_BEFORE = int(os.getenv("PAYMENT_CHECK_DAYS_BEFORE", "2"))
 PAYMENT_CHECK_DAYS_AFTER = int(os.getenv("PAYMENT_CHECK_DAYS_AFTER", "2"))
+PAYMENT_SHIFT_RULE = os.getenv("PAYMENT_SHIFT_RULE", "previous")  # выплата в выходной: previous | next | none
+PAYMENT_CALENDAR_MONTHS = int(os.getenv("PAYMENT_CALENDAR_MONTHS", "12"))  # на сколько месяцев строить окна
 PAYMENT_CHECK_INTERVAL_HOURS = int(os.getenv("PAYMENT_CHECK_INTERVAL_HOURS", "1"))
+PAYMENT_CHECK_CONCURRENCY = int(os.getenv("PAYMENT_CHECK_CONCURRENCY", "10"))
+PAYMENT_POLL_MIN_MINUTES = float(os.getenv("PAYMENT_POLL_MIN_MINUTES", "10"))  # интервал в день выплаты
+PAYMENT_POLL_MAX_BACKOFF = int(os.getenv("PAYMENT_POLL_MAX_BACKOFF", "8"))  # предел множителя без изменений
+PAYMENT_SCHEDULE_REFRESH_MINUTES = float(os.getenv("PAYMENT_SCHEDULE_REFRESH_MINUTES", "15"))
+
+# Очередь исходящих уведомлений
+NOTIFY_RATE_PER_SECOND = float(os.getenv("NOTIFY_RATE_PER_SECOND", "25"))  # общий лимит Telegram ~30/с
+NOTIFY_RATE_BURST = float(os.getenv("NOTIFY_RATE_BURST", "25"))
+NOTIFY_CHAT_INTERVAL_SECONDS = float(os.getenv("NOTIFY_CHAT_INTERVAL_SECONDS", "1"))  # не чаще 1 сообщения в чат
+NOTIFY_BATCH_SIZE = int(os.getenv("NOTIFY_BATCH_SIZE", "50"))
+NOTIFY_CLAIM_SECONDS = float(os.getenv("NOTIFY_CLAIM_SECONDS", "60"))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "8"))
+NOTIFY_RETRY_BASE_DELAY = float(os.getenv("NOTIFY_RETRY_BASE_DELAY", "5"))
+NOTIFY_RETRY_MAX_DELAY = float(os.getenv("NOTIFY_RETRY_MAX_DELAY", "900"))
+NOTIFY_POLL_SECONDS = float(os.getenv("NOTIFY_POLL_SECONDS", "30"))
+NOTIFY_RETENTION_DAYS = int(os.getenv("NOTIFY_RETENTION_DAYS", "30"))
+
+# Распределение проверки выплат между процессами (несколько процессов - только с DB_BACKEND=sqlite)
+CHECKER_SHARDS = int(os.getenv("CHECKER_SHARDS", "16"))
+CHECKER_LEASE_SECONDS = float(os.getenv("CHECKER_LEASE_SECONDS", "120"))
+WORKER_ID = os.getenv("WORKER_ID", "")  # по умолчанию hostname-pid
 PAYMENT_MIN_AMOUNT = int(os.getenv("PAYMENT_MIN_AMOUNT", "1000"))
+TRANSACTION_CURSOR_SIZE = int(os.getenv("TRANSACTION_CURSOR_SIZE", "200"))
 NORWAY_TIMEZONE = os.getenv("NORWAY_TIMEZONE", "Europe/Oslo")
@@ -1,146 +1,267 @@
-import json
+"""
+Асинхронный API хранилища
+
+Бэкенды работают синхронно, поэтому все вызовы выполняются в отдельном
+пуле потоков и не блокируют цикл событий aiogram. Записи для одного
+chat_id выполняются строго последовательно
+"""
+
+import asyncio
+import functools
 import os
-from typing import Optional
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 from datetime import datetime
 
-from config import DB_FILE
+from config import (
+    DB_BACKEND,
+    DB_FILE,
+    SQLITE_DB_FILE,
+    LEGACY_DB_FILE,
+    DB_FLUSH_INTERVAL_SECONDS,
+    DB_FLUSH_MAX_DIRTY,
+    DB_EXECUTOR_WORKERS,
+    BALANCE_HISTORY_RAW_DAYS,
+    BALANCE_HISTORY_DAILY_DAYS
+)
+from metrics import STORAGE_OPERATION_SECONDS, gauge, file_size
+from storage import Storage, StorageError, create_storage
+
+_storage: Optional[Storage] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_chat_locks: "weakref.WeakValueDictionary[object, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def check_legacy_db_file(path: str) -> None:
+    """Не дает создать новую пустую базу, пока база лежит на прежнем месте"""
+    if not LEGACY_DB_FILE or os.path.exists(path) or not os.path.exists(LEGACY_DB_FILE):
+        return
+    if os.path.abspath(LEGACY_DB_FILE) == os.path.abspath(path):
+        return
+    raise StorageError(
+        f"Database {path} does not exist, but a database was found at the legacy "
+        f"location {LEGACY_DB_FILE}. Move it to {DB_FILE} (or migrate it into "
+        f"{SQLITE_DB_FILE} with python -m storage.migrate) before starting the bot"
+    )
+
+def get_storage() -> Storage:
+    """Возвращает бэкенд хранилища, выбранный в конфигурации"""
+    global _storage
+    if _storage is None:
+        check_legacy_db_file(SQLITE_DB_FILE if DB_BACKEND == "sqlite" else DB_FILE)
+        options = {
+            "history_raw_days": BALANCE_HISTORY_RAW_DAYS,
+            "history_daily_days": BALANCE_HISTORY_DAILY_DAYS
+        }
+        if DB_BACKEND == "sqlite":
+            _storage = create_storage(DB_BACKEND, SQLITE_DB_FILE, **options)
+        else:
+            _storage = create_storage(
+                DB_BACKEND,
+                DB_FILE,
+                flush_interval=DB_FLUSH_INTERVAL_SECONDS,
+                flush_max_dirty=DB_FLUSH_MAX_DIRTY,
+                **options
+            )
+    return _storage
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db"
+        )
+    return _executor
+
+def _chat_lock(key) -> asyncio.Lock:
+    """Блокировка записей для одного chat_id или карты (удаляется, когда не используется)"""
+    lock = _chat_locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _chat_locks[key] = lock
+    return lock
 
-def load_db() -> dict:
-    """Загружает базу данных из JSON файла"""
-    if not os.path.exists(DB_FILE):
-        return {}
+def _db_file_size() -> Optional[float]:
+    if DB_BACKEND == "sqlite":
+        return file_size(SQLITE_DB_FILE, SQLITE_DB_FILE + "-wal")
+    return file_size(DB_FILE)
 
-    try:
-        with open(DB_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return {}
+gauge("storage_file_size_bytes", "Size of the database file on disk", function=_db_file_size)
 
-def save_db(db: dict) -> None:
-    """Сохраняет базу данных в JSON файл"""
-    with open(DB_FILE, 'w', encoding='utf-8') as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+async def _run(func: Callable, *args):
+    """Выполняет синхронный вызов бэкенда в пуле потоков хранилища"""
+    loop = asyncio.get_running_loop()
+    # Время включает ожидание свободного потока в пуле
+    with STORAGE_OPERATION_SECONDS.time(operation=func.__name__):
+        return await loop.run_in_executor(_get_executor(), functools.partial(func, *args))
 
-def get_card_number(chat_id: int) -> Optional[str]:
+async def _write(key, func: Callable, *args):
+    """Выполняет запись, сериализуя ее с другими записями того же chat_id (или карты)"""
+    async with _chat_lock(key):
+        return await _run(func, *args)
+
+async def init_db() -> None:
+    """Открывает хранилище при запуске бота, чтобы ошибки базы были видны сразу, а не на первом запросе"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_get_executor(), get_storage)
+
+async def close_db() -> None:
+    """Закрывает хранилище при остановке бота (JSON бэкенд сбрасывает изменения на диск)"""
+    global _storage, _executor
+    if _storage is not None:
+        await _run(_storage.close)
+        _storage = None
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+async def get_card_number(chat_id: int) -> Optional[str]:
     """Получает номер карты для указанного chat_id"""
-    db = load_db()
-    user_data = db.get(str(chat_id))
-    if isinstance(user_data, str):
-        # Миграция старого формата (просто номер карты) в новый формат
-        card_number = user_data
-        db[str(chat_id)] = {
-            "card_number": card_number,
-            "balance_history": []
-        }
-        save_db(db)
-        return card_number
-    elif isinstance(user_data, dict):
-        return user_data.get("card_number")
-    return None
+    return await _run(get_storage().get_card_number, chat_id)
 
-def set_card_number(chat_id: int, card_number: str) -> None:
+async def set_card_number(chat_id: int, card_number: str) -> None:
     """Сохраняет номер карты для указанного chat_id"""
-    db = load_db()
-    user_data = db.get(str(chat_id))
-
-    if isinstance(user_data, dict):
-        # Обновляем только номер карты, сохраняя историю
-        user_data["card_number"] = card_number
-        db[str(chat_id)] = user_data
-    else:
-        # Создаем новую запись
-        db[str(chat_id)] = {
-            "card_number": card_number,
-            "balance_history": []
-        }
-    save_db(db)
+    await _write(chat_id, get_storage().set_card_number, chat_id, card_number)
 
-def add_balance_history(chat_id: int, balance: float) -> None:
+async def add_balance_history(chat_id: int, balance: float) -> None:
     """Добавляет запись о балансе в историю пользователя"""
-    db = load_db()
-    user_data = db.get(str(chat_id))
+    await _write(chat_id, get_storage().add_balance_history, chat_id, int(time.time()), balance)
 
-    if not user_data:
-        return
+async def get_balance_history(chat_id: int, since: Optional[int] = None,
+                              until: Optional[int] = None) -> list:
+    """
+    Получает историю балансов для указанного chat_id
+    Возвращает [(timestamp, balance), ...], можно ограничить интервалом epoch секунд
+    """
+    return await _run(get_storage().get_balance_history, chat_id, since, until)
 
-    # Если старый формат, мигрируем
-    if isinstance(user_data, str):
-        card_number = user_data
-        user_data = {
-            "card_number": card_number,
-            "balance_history": []
-        }
+async def get_balance_rollups(chat_id: int, level: str, since: Optional[int] = None,
+                              until: Optional[int] = None) -> list:
+    """Агрегаты старой истории по дням ("day") или неделям ("week")"""
+    return await _run(get_storage().get_balance_rollups, chat_id, level, since, until)
 
-    # Добавляем новую запись в историю
-    current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    balance_entry = {
-        "date": current_datetime,
-        "balance": balance
-    }
+async def get_balance_stats(chat_id: int, since: Optional[int] = None) -> list:
+    """Дневная статистика [(day, min, max, sum, count, spent), ...], начиная с дня since"""
+    return await _run(get_storage().get_balance_stats, chat_id, since)
 
-    if "balance_history" not in user_data:
-        user_data["balance_history"] = []
+async def get_chart_file_id(chat_id: int, range_key: str, day: int) -> Optional[str]:
+    """file_id графика, если он отрисован сегодня и история с тех пор не менялась"""
+    return await _run(get_storage().get_chart_file_id, chat_id, range_key, day)
 
-    user_data["balance_history"].append(balance_entry)
-    db[str(chat_id)] = user_data
-    save_db(db)
+async def set_chart_file_id(chat_id: int, range_key: str, day: int, file_id: str) -> None:
+    """Запоминает file_id отправленного графика"""
+    await _write(chat_id, get_storage().set_chart_file_id, chat_id, range_key, day, file_id)
 
-def get_balance_history(chat_id: int) -> list:
-    """Получает историю балансов для указанного chat_id"""
-    db = load_db()
-    user_data = db.get(str(chat_id))
+async def delete_card_number(chat_id: int) -> None:
+    """Удаляет номер карты для указанного chat_id"""
+    await _write(chat_id, get_storage().delete_user, chat_id)
 
-    if isinstance(user_data, dict):
-        return user_data.get("balance_history", [])
-    return []
+async def mark_payment_received(chat_id: int, payment_date: str, amount: float,
+                                notification: Optional[str] = None) -> None:
+    """
+    Отмечает, что пользователь получил выплату за текущий период
+    Уведомление (если передано) ставится в очередь исходящих в той же записи
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    await _write(chat_id, get_storage().mark_payment_received,
+                 chat_id, payment_date, timestamp, amount, notification)
 
-def delete_card_number(chat_id: int) -> None:
-    """Удаляет номер карты для указанного chat_id"""
-    db = load_db()
-    if str(chat_id) in db:
-        del db[str(chat_id)]
-        save_db(db)
+async def is_payment_received(chat_id: int, payment_date: str) -> bool:
+    """Проверяет, была ли получена выплата за указанный период"""
+    return await _run(get_storage().is_payment_received, chat_id, payment_date)
 
-def mark_payment_received(chat_id: int, payment_date: str, amount: float) -> None:
-    """Отмечает, что пользователь получил выплату за текущий период"""
-    db = load_db()
-    user_data = db.get(str(chat_id))
+async def get_all_users() -> list:
+    """Возвращает список всех chat_id пользователей"""
+    return await _run(get_storage().get_all_users)
 
-    if not user_data:
-        return
+async def get_unpaid_cards(payment_date: str) -> list:
+    """Возвращает пары (card_number, [chat_id, ...]) с пользователями, еще не получившими выплату"""
+    return await _run(get_storage().get_unpaid_cards, payment_date)
 
-    # Если старый формат, мигрируем
-    if isinstance(user_data, str):
-        card_number = user_data
-        user_data = {
-            "card_number": card_number,
-            "balance_history": []
-        }
+async def get_card_subscribers(card_number: str) -> list:
+    """Возвращает chat_id всех пользователей, привязавших карту"""
+    return await _run(get_storage().get_card_subscribers, card_number)
 
-    # Добавляем информацию о выплате
-    if "payments" not in user_data:
-        user_data["payments"] = {}
+async def set_balance_alert(chat_id: int, threshold: Optional[float]) -> None:
+    """Подписывает на уведомления об изменении баланса не меньше threshold (None - отписывает)"""
+    await _write(chat_id, get_storage().set_balance_alert, chat_id, threshold)
 
-    user_data["payments"][payment_date] = {
-        "received": True,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "amount": amount
-    }
+async def get_balance_alert(chat_id: int) -> Optional[dict]:
+    """Возвращает подписку {"threshold", "baseline"} или None"""
+    return await _run(get_storage().get_balance_alert, chat_id)
 
-    db[str(chat_id)] = user_data
-    save_db(db)
+async def get_alert_cards() -> list:
+    """Возвращает карты с подписками: [(card_number, last_balance, [(chat_id, threshold, baseline)])]"""
+    return await _run(get_storage().get_alert_cards)
 
-def is_payment_received(chat_id: int, payment_date: str) -> bool:
-    """Проверяет, была ли получена выплата за указанный период"""
-    db = load_db()
-    user_data = db.get(str(chat_id))
+async def record_card_balance(card_number: str, balance: float, alerts: list = ()) -> None:
+    """
+    Сохраняет последний известный баланс карты и опорный баланс подписок
+    Уведомления из alerts и новый баланс в истории подписчиков карты
+    сохраняются в той же записи
+    """
+    await _write(("card", card_number), get_storage().record_card_balance,
+                 card_number, balance, time.time(), list(alerts))
 
-    if isinstance(user_data, dict):
-        payments = user_data.get("payments", {})
-        return payments.get(payment_date, {}).get("received", False)
-    return False
+async def record_user_balance(chat_id: int, card_number: str, balance: float) -> None:
+    """
+    Сохраняет баланс, который пользователь запросил сам: запись в истории,
+    последний баланс карты и опорный баланс его подписки - одной записью
+    """
+    async with _chat_lock(chat_id), _chat_lock(("card", card_number)):
+        await _run(get_storage().record_user_balance, chat_id, card_number, int(time.time()), balance)
 
-def get_all_users() -> list:
-    """Возвращает список всех chat_id пользователей"""
-    db = load_db()
-    return list(db.keys())
+async def get_card_cursor(card_number: str) -> Optional[dict]:
+    """Возвращает курсор уже просмотренных транзакций карты"""
+    return await _run(get_storage().get_card_cursor, card_number)
+
+async def set_card_cursor(card_number: str, cursor: dict) -> None:
+    """Сохраняет курсор просмотренных транзакций карты"""
+    await _write(("card", card_number), get_storage().set_card_cursor, card_number, cursor)
+
+async def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    """Захватывает или продлевает аренду name на ttl секунд"""
+    return await _run(get_storage().acquire_lease, name, owner, ttl, time.time())
+
+async def release_lease(name: str, owner: str) -> None:
+    """Освобождает аренду, если она принадлежит owner"""
+    await _run(get_storage().release_lease, name, owner)
+
+async def list_leases(prefix: str) -> list:
+    """Аренды с именем на prefix: [(name, owner, expires_at), ...]"""
+    return await _run(get_storage().list_leases, prefix)
+
+async def enqueue_notification(chat_id: int, text: str) -> None:
+    """Ставит сообщение пользователю в очередь исходящих"""
+    await _run(get_storage().enqueue_notification, chat_id, text, time.time())
+
+async def claim_notifications(limit: int, visibility_timeout: float) -> list:
+    """Забирает готовые к отправке сообщения из очереди исходящих"""
+    return await _run(get_storage().claim_notifications, time.time(), limit, visibility_timeout)
+
+async def mark_notification_sent(notification_id: int) -> None:
+    """Отмечает сообщение доставленным"""
+    await _run(get_storage().mark_notification_sent, notification_id, time.time())
+
+async def mark_notification_failed(notification_id: int, error: str,
+                                   retry_at: Optional[float]) -> None:
+    """Записывает неудачную попытку отправки (retry_at=None - больше не пытаться)"""
+    await _run(get_storage().mark_notification_failed, notification_id, error, retry_at)
+
+async def prune_notifications(before: float) -> int:
+    """Удаляет старые доставленные и неотправленные сообщения"""
+    return await _run(get_storage().prune_notifications, before)
+
+async def get_fsm_record(key: str) -> Optional[dict]:
+    """Возвращает запись FSM {"state", "data", "expires_at"} или None"""
+    return await _run(get_storage().get_fsm_record, key, time.time())
+
+async def update_fsm_record(key: str, changes: dict, ttl: float) -> Optional[dict]:
+    """Меняет состояние и/или данные FSM, запись живет ttl секунд с последнего изменения"""
+    now = time.time()
+    return await _write(("fsm", key), get_storage().update_fsm_record, key, changes, now + ttl, now)
+
+async def prune_fsm_records() -> int:
+    """Удаляет устаревшие записи FSM"""
+    return await _run(get_storage().prune_fsm_records, time.time())
@@ -39,10 +39,26 @@ check_env_file() {
     fi
 }
 
+# Перенос базы с прежнего места (./cards_db.json) в каталог ./data
+migrate_db_location() {
+    if [ ! -f cards_db.json ]; then
+        return
+    fi
+    if [ -e data/cards_db.json ]; then
+        print_error "Both cards_db.json and data/cards_db.json exist!"
+        print_info "Keep the up-to-date one in data/ and move the other away before starting the bot"
+        exit 1
+    fi
+    print_info "Moving cards_db.json to data/cards_db.json..."
+    mkdir -p data
+    mv cards_db.json data/cards_db.json
+}
+
 # Запуск контейнера
 start() {
     print_info "Starting DNB Balance Bot..."
     check_env_file
+    migrate_db_location
     docker compose up -d
     print_info "Bot started successfully!"
     print_info "Use './docker-run.sh logs' to view logs"
@@ -72,6 +88,7 @@ rebuild() {
     print_info "Rebuilding Docker image..."
     docker compose down
     docker compose build --no-cache
+    migrate_db_location
     docker compose up -d
     print_info "Bot rebuilt and started successfully!"
 }
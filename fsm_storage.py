@@ -0,0 +1,123 @@
+"""
+Хранилище состояний FSM aiogram поверх слоя хранения бота
+
+Состояние диалога (например, ожидание номера карты) переживает
+перезапуск и видно всем процессам бота, работающим с одной базой SQLite.
+JSON база принадлежит одному процессу и пишется целиком, поэтому с ней
+состояния хранятся в памяти (MemoryStorage aiogram). Запись устаревает
+через FSM_STATE_TTL_SECONDS после последнего изменения.
+
+Состояние читается на каждое входящее сообщение, поэтому чтения
+обслуживает небольшой кеш в памяти на FSM_CACHE_SECONDS. Запись всегда
+идет в базу; изменение, сделанное другим процессом, становится видно
+здесь не позже чем через FSM_CACHE_SECONDS
+"""
+
+import logging
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from cache import TTLCache
+from config import DB_BACKEND, FSM_STORAGE, FSM_STATE_TTL_SECONDS, FSM_CACHE_SECONDS, FSM_CACHE_MAX_SIZE
+from database import get_fsm_record, update_fsm_record, prune_fsm_records
+
+# Как часто удалять устаревшие записи из базы
+PRUNE_INTERVAL_SECONDS = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseFSMStorage(BaseStorage):
+    """FSM storage aiogram, хранящий состояния в базе бота"""
+
+    def __init__(self, state_ttl: float = FSM_STATE_TTL_SECONDS,
+                 cache_ttl: float = FSM_CACHE_SECONDS,
+                 cache_size: int = FSM_CACHE_MAX_SIZE,
+                 key_builder: Optional[KeyBuilder] = None):
+        self.state_ttl = state_ttl
+        # bot_id в ключе: несколько ботов могут делить одну базу
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        # Кешируется и отсутствие записи: у большинства сообщений состояния нет
+        self._cache = TTLCache(cache_ttl, cache_size)
+        self._next_prune = 0.0
+
+    async def _get_record(self, key: StorageKey) -> Optional[dict]:
+        storage_key = self.key_builder.build(key)
+        cached = self._cache.get(storage_key)
+        if cached is None:
+            cached = (await get_fsm_record(storage_key),)
+            self._cache.set(storage_key, cached)
+
+        record = cached[0]
+        if record is not None and record["expires_at"] <= time.time():
+            return None
+        return record
+
+    async def _update_record(self, key: StorageKey, changes: dict) -> Optional[dict]:
+        storage_key = self.key_builder.build(key)
+        try:
+            record = await update_fsm_record(storage_key, changes, self.state_ttl)
+        except BaseException:
+            # Результат записи неизвестен: следующее чтение идет в базу
+            self._cache.pop(storage_key)
+            raise
+        self._cache.set(storage_key, (record,))
+        await self._maybe_prune()
+        return record
+
+    async def _maybe_prune(self) -> None:
+        now = time.time()
+        if now < self._next_prune:
+            return
+        self._next_prune = now + PRUNE_INTERVAL_SECONDS
+        try:
+            pruned = await prune_fsm_records()
+        except Exception as e:
+            logger.warning("Error pruning FSM states: %s", e)
+            return
+        if pruned:
+            logger.info("Pruned %d expired FSM states", pruned)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        await self._update_record(key, {"state": state})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get_record(key)
+        return record["state"] if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(
+                f"Data must be a dict or dict-like object, got {type(data).__name__}"
+            )
+        await self._update_record(key, {"data": data})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        return dict(record["data"]) if record else {}
+
+    async def close(self) -> None:
+        # Соединение с базой закрывает close_db при остановке бота
+        self._cache.clear()
+
+
+def create_fsm_storage(backend: str = FSM_STORAGE, db_backend: str = DB_BACKEND) -> BaseStorage:
+    """
+    FSM storage по настройке FSM_STORAGE: "database" (только с SQLite),
+    "memory" (только этот процесс) или "auto" - database, если база в SQLite
+    """
+    if backend == "auto":
+        backend = "database" if db_backend == "sqlite" else "memory"
+    if backend == "database":
+        if db_backend != "sqlite":
+            raise ValueError("FSM_STORAGE=database requires DB_BACKEND=sqlite")
+        return DatabaseFSMStorage()
+    if backend == "memory":
+        return MemoryStorage()
+    raise ValueError(f"Unknown FSM storage: {backend}")
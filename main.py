@@ -1,17 +1,74 @@
 import asyncio
+import time
+from typing import Optional
 from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from aiogram.types import (
+    BufferedInputFile,
+    CallbackQuery,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InputMediaPhoto,
+    KeyboardButton,
+    Message,
+    ReplyKeyboardMarkup
+)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from database import get_card_number, set_card_number, add_balance_history
-from api_client import get_card_balance, get_card_transactions
-from config import BOT_TOKEN, CARD_NUMBER_LENGTH
+from database import (
+    get_card_number,
+    set_card_number,
+    record_user_balance,
+    set_balance_alert,
+    get_balance_alert,
+    get_balance_stats,
+    get_chart_file_id,
+    set_chart_file_id,
+    init_db,
+    close_db
+)
+from api_client import get_card_balance, get_card_transactions, init_api_client, close_api_client
+from circuit_breaker import CircuitOpenError
+from config import (
+    BOT_TOKEN,
+    BOT_MODE,
+    CARD_NUMBER_LENGTH,
+    BALANCE_THROTTLE_SECONDS,
+    BALANCE_ALERT_INTERVAL_MINUTES
+)
 from payment_checker import payment_checker_task
+from balance_alerts import balance_alert_task
+from balance_stats import (
+    RANGES,
+    DEFAULT_RANGE,
+    CALLBACK_PREFIX,
+    range_start,
+    summarize,
+    load_chart_points,
+    render_chart
+)
+from notifier import notification_dispatcher_task
 from messages import Messages, ButtonTexts
+from fsm_storage import create_fsm_storage
+from metrics import start_metrics_server, STATS_CHARTS
+from middlewares import ChatThrottleMiddleware, HandlerTimingMiddleware, TraceIdMiddleware
+from logging_setup import setup_logging, shutdown_logging
+from webhook_server import run_webhook
+from storage.history import day_start
 
-dp = Dispatcher()
+# С SQLite состояние ввода карты хранится в базе: переживает перезапуск и общее для реплик
+dp = Dispatcher(storage=create_fsm_storage())
+dp.update.outer_middleware(TraceIdMiddleware())
+# Отброшенные повторы не учитываются во времени обработчиков. Троттлинг
+# общий для сообщений и кнопок, чтобы /stats и переключение периода
+# не рисовали графики одного чата параллельно
+throttle = ChatThrottleMiddleware(BALANCE_THROTTLE_SECONDS)
+dp.message.middleware(throttle)
+dp.message.middleware(HandlerTimingMiddleware())
+dp.callback_query.middleware(throttle)
+dp.callback_query.middleware(HandlerTimingMiddleware())
 
 class CardStates(StatesGroup):
     waiting_for_card = State()
@@ -21,16 +78,29 @@ def get_main_keyboard():
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
             [KeyboardButton(text=ButtonTexts.GET_BALANCE)],
+            [KeyboardButton(text=ButtonTexts.STATS)],
             # [KeyboardButton(text=ButtonTexts.GET_TRANSACTIONS)]
         ],
         resize_keyboard=True
     )
     return keyboard
 
+def get_stats_keyboard(active: str):
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[[
+            InlineKeyboardButton(
+                text=("• " if key == active else "") + ButtonTexts.STATS_RANGES[key],
+                callback_data=CALLBACK_PREFIX + key
+            )
+            for key in RANGES
+        ]]
+    )
+    return keyboard
+
 @dp.message(Command("start"))
 async def command_start_handler(message: Message, state: FSMContext):
     # Проверяем, есть ли уже сохраненная карта
-    card_number = get_card_number(message.chat.id)
+    card_number = await get_card_number(message.chat.id)
 
     if card_number:
         await message.answer(
@@ -60,7 +130,7 @@ async def process_card_number(message: Message, state: FSMContext):
 
     # Сохраняем номер карты, обрезав последнюю цифру
     card_number_trimmed = card_number[:-1]
-    set_card_number(message.chat.id, card_number_trimmed)
+    await set_card_number(message.chat.id, card_number_trimmed)
 
     await message.answer(
         Messages.card_saved_success(card_number),
@@ -68,9 +138,9 @@ async def process_card_number(message: Message, state: FSMContext):
     )
     await state.clear()
 
-@dp.message(F.text == ButtonTexts.GET_BALANCE)
+@dp.message(F.text == ButtonTexts.GET_BALANCE, flags={"throttle": "balance"})
 async def get_balance_handler(message: Message):
-    card_number = get_card_number(message.chat.id)
+    card_number = await get_card_number(message.chat.id)
 
     if not card_number:
         await message.answer(Messages.NO_CARD_SAVED)
@@ -78,18 +148,129 @@ async def get_balance_handler(message: Message):
 
     status_message = await message.answer(Messages.GETTING_BALANCE)
 
-    balance = await get_card_balance(card_number)
+    try:
+        balance = await get_card_balance(card_number)
+    except CircuitOpenError as e:
+        await status_message.edit_text(Messages.api_unavailable(e.retry_after))
+        return
 
     if balance is not None:
-        # Сохраняем баланс в историю
-        add_balance_history(message.chat.id, balance)
+        # Сохраняем баланс в историю; пользователь его увидел, поэтому
+        # он же становится опорным для уведомлений об изменении
+        await record_user_balance(message.chat.id, card_number, balance)
         await status_message.edit_text(Messages.balance_result(balance))
     else:
         await status_message.edit_text(Messages.BALANCE_ERROR)
 
+@dp.message(Command("notify"))
+async def notify_handler(message: Message, command: CommandObject):
+    if not await get_card_number(message.chat.id):
+        await message.answer(Messages.NO_CARD_SAVED)
+        return
+
+    argument = (command.args or "").strip().lower()
+    if not argument:
+        alert = await get_balance_alert(message.chat.id)
+        await message.answer(Messages.notify_status(alert["threshold"]) if alert else Messages.NOTIFY_USAGE)
+        return
+
+    if argument in ("off", "0"):
+        await set_balance_alert(message.chat.id, None)
+        await message.answer(Messages.NOTIFY_DISABLED)
+        return
+
+    try:
+        threshold = float(argument.replace(" ", "").replace(",", "."))
+    except ValueError:
+        threshold = 0.0
+    if not 0 < threshold < float("inf"):
+        await message.answer(Messages.NOTIFY_INVALID_THRESHOLD)
+        return
+
+    await set_balance_alert(message.chat.id, threshold)
+    await message.answer(Messages.notify_enabled(threshold))
+
+async def deliver_chart(bot: Bot, chat_id: int, photo, caption: str, keyboard,
+                        message: Optional[Message] = None) -> Message:
+    """Отправляет график новым сообщением или заменяет им график в message"""
+    if message is None:
+        return await bot.send_photo(chat_id, photo, caption=caption, reply_markup=keyboard)
+    try:
+        return await message.edit_media(
+            InputMediaPhoto(media=photo, caption=caption), reply_markup=keyboard
+        )
+    except TelegramBadRequest as error:
+        # Повторное нажатие на текущий период, пока график не изменился
+        if "message is not modified" not in error.message:
+            raise
+        return message
+
+async def send_stats(bot: Bot, chat_id: int, range_key: str, message: Optional[Message] = None) -> bool:
+    """
+    Показывает статистику за период: новым сообщением или, если передано
+    message, заменяя в нем график. Без истории за период новое сообщение
+    отправляется с текстом, а message не меняется - тогда возвращает False
+    """
+    now = int(time.time())
+    stats = await get_balance_stats(chat_id, range_start(range_key, now))
+    summary = summarize(stats, now)
+    if summary is None:
+        if message is None:
+            await bot.send_message(chat_id, Messages.NO_STATS, reply_markup=get_stats_keyboard(range_key))
+        return False
+
+    caption = Messages.balance_stats(ButtonTexts.STATS_RANGES[range_key], summary)
+    keyboard = get_stats_keyboard(range_key)
+
+    # График, уже отправленный сегодня после последней записи истории,
+    # не рисуется и не загружается заново
+    today = day_start(now)
+    file_id = await get_chart_file_id(chat_id, range_key, today)
+    if file_id:
+        try:
+            await deliver_chart(bot, chat_id, file_id, caption, keyboard, message)
+            STATS_CHARTS.inc(source="cached")
+            return True
+        except TelegramBadRequest:
+            # file_id больше не принимается - рисуем заново
+            pass
+
+    points = await load_chart_points(chat_id, range_key, stats, now)
+    png = await asyncio.get_running_loop().run_in_executor(None, render_chart, points, range_key, now)
+    sent = await deliver_chart(
+        bot, chat_id, BufferedInputFile(png, filename="balance.png"), caption, keyboard, message
+    )
+    STATS_CHARTS.inc(source="rendered")
+    await set_chart_file_id(chat_id, range_key, today, sent.photo[-1].file_id)
+    return True
+
+@dp.message(Command("stats"), flags={"throttle": "stats"})
+@dp.message(F.text == ButtonTexts.STATS, flags={"throttle": "stats"})
+async def stats_handler(message: Message):
+    if not await get_card_number(message.chat.id):
+        await message.answer(Messages.NO_CARD_SAVED)
+        return
+
+    await send_stats(message.bot, message.chat.id, DEFAULT_RANGE)
+
+@dp.callback_query(F.data.startswith(CALLBACK_PREFIX), flags={"throttle": "stats"})
+async def stats_range_handler(callback: CallbackQuery):
+    range_key = callback.data[len(CALLBACK_PREFIX):]
+    message = callback.message
+    if range_key not in RANGES or message is None:
+        await callback.answer()
+        return
+
+    # Сообщение с графиком меняется на месте, а не дублируется. Недоступное
+    # боту сообщение и текст "нет истории" заменить графиком нельзя
+    editable = message if isinstance(message, Message) and message.photo else None
+    shown = await send_stats(callback.bot, message.chat.id, range_key, editable)
+    # Без истории за период график остается прежним, а причина видна во всплывающем уведомлении
+    await callback.answer(Messages.NO_STATS if editable and not shown else None)
+
 # @dp.message(F.text == "Получить последние 5 транзакций")
 # async def get_transactions_handler(message: Message):
-#     card_number = get_card_number(message.chat.id)
+#     card_number = await get_card_number(message.chat.id)
 
 #     if not card_number:
 #         await message.answer(
@@ -116,11 +297,41 @@ async def get_balance_handler(message: Message):
 
 async def main() -> None:
     bot = Bot(token=BOT_TOKEN)
+    await init_db()
+
+    # Общий клиент DNB API с пулом соединений на все время работы бота
+    await init_api_client()
+    metrics_runner = await start_metrics_server()
+
+    # Запускаем в фоне проверку выплат, опрос балансов по подпискам
+    # и отправку уведомлений из очереди
+    background = [
+        asyncio.create_task(payment_checker_task()),
+        asyncio.create_task(notification_dispatcher_task(bot))
+    ]
+    if BALANCE_ALERT_INTERVAL_MINUTES > 0:
+        background.append(asyncio.create_task(balance_alert_task()))
 
-    # Запускаем задачу проверки выплат в фоне
-    asyncio.create_task(payment_checker_task(bot))
+    def is_healthy() -> bool:
+        return not any(task.done() for task in background)
 
-    await dp.start_polling(bot)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(dp, bot, is_healthy)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_api_client()
+        await close_db()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        shutdown_logging()
\ No newline at end of file
@@ -60,6 +60,63 @@ class Messages:
         "Используйте /start чтобы ввести номер заново."
     )
 
+    @staticmethod
+    def api_unavailable(retry_after: float) -> str:
+        minutes = max(1, round(retry_after / 60))
+        return (
+            "Сервис DNB сейчас недоступен.\n"
+            f"Попробуйте еще раз примерно через {minutes} мин."
+        )
+
+    # Уведомления об изменении баланса (/notify)
+    NOTIFY_USAGE = (
+        "Уведомления об изменении баланса:\n"
+        "/notify 500 - сообщать, когда баланс изменится на 500 NOK и больше\n"
+        "/notify off - отключить уведомления"
+    )
+
+    NOTIFY_INVALID_THRESHOLD = "Порог должен быть положительным числом, например: /notify 500"
+
+    NOTIFY_DISABLED = "Уведомления об изменении баланса отключены."
+
+    @staticmethod
+    def notify_enabled(threshold: float) -> str:
+        return (
+            f"Буду сообщать, когда баланс изменится на {threshold:g} NOK и больше.\n"
+            "Отключить: /notify off"
+        )
+
+    @staticmethod
+    def notify_status(threshold: float) -> str:
+        return (
+            f"Уведомления включены: порог {threshold:g} NOK.\n"
+            "Изменить: /notify <сумма>, отключить: /notify off"
+        )
+
+    @staticmethod
+    def balance_changed(old_balance: float, new_balance: float) -> str:
+        change = new_balance - old_balance
+        return (
+            f"Баланс карты изменился на {change:+.2f} NOK\n"
+            f"Было: {old_balance} NOK, стало: {new_balance} NOK"
+        )
+
+    # Статистика баланса (/stats)
+    NO_STATS = (
+        "За этот период еще нет истории баланса.\n"
+        "Она появляется, когда вы запрашиваете баланс."
+    )
+
+    @staticmethod
+    def balance_stats(range_label: str, summary) -> str:
+        return (
+            f"Статистика баланса: {range_label}\n\n"
+            f"Минимум: {summary.minimum:.2f} NOK\n"
+            f"Максимум: {summary.maximum:.2f} NOK\n"
+            f"Средний баланс: {summary.average:.2f} NOK\n"
+            f"Расход: {summary.spent:.2f} NOK ({summary.spent_per_day:.2f} NOK в день)"
+        )
+
     # Выплаты
     @staticmethod
     def payment_received(amount: float) -> str:
@@ -79,3 +136,7 @@ class ButtonTexts:
 
     GET_BALANCE = "Получить баланс"
     GET_TRANSACTIONS = "Получить последние 5 транзакций"
+    STATS = "Статистика"
+
+    # Периоды статистики (ключи balance_stats.RANGES)
+    STATS_RANGES = {"7d": "7 дней", "30d": "30 дней", "90d": "90 дней", "365d": "год"}
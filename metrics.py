@@ -0,0 +1,274 @@
+"""
+Метрики в текстовом формате Prometheus
+
+Небольшой реестр счетчиков, gauge и гистограмм с метками и локальный
+HTTP endpoint для их сбора. Метрики обновляются из цикла событий бота
+"""
+
+import bisect
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT, METRICS_PATH
+
+# Границы гистограмм задержек в секундах
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SWEEP_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+LabelValues = Tuple[str, ...]
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    """Базовый класс метрики с набором меток"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """(суффикс имени, имена меток, значения меток, значение)"""
+        return ()
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}"
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Монотонно растущий счетчик"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield "", self.labelnames, key, value
+
+
+class Gauge(Metric):
+    """Текущее значение; может вычисляться функцией в момент сбора"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], Optional[float]]] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._function = function
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self._function is not None:
+            value = self._function()
+            if value is not None:
+                yield "", (), (), value
+            return
+        for key, value in sorted(self._values.items()):
+            yield "", self.labelnames, key, value
+
+
+class Histogram(Metric):
+    """Распределение значений по накопительным интервалам"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Значения меток -> [счетчики по интервалам (+Inf последний), сумма]
+        self._series: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0.0]
+            self._series[key] = series
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Замеряет длительность блока"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", names, key + (_format_value(bound),), cumulative
+            yield "_count", self.labelnames, key, cumulative
+            yield "_sum", self.labelnames, key, total
+
+
+class Registry:
+    """Набор метрик, отдаваемых на endpoint"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = (),
+          function: Optional[Callable[[], Optional[float]]] = None) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames, function))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def file_size(*paths: str) -> Optional[float]:
+    """Суммарный размер существующих файлов (None, если нет ни одного)"""
+    total = None
+    for path in paths:
+        try:
+            total = (total or 0) + os.path.getsize(path)
+        except OSError:
+            continue
+    return total
+
+
+# DNB API
+API_REQUEST_SECONDS = histogram(
+    "dnb_api_request_seconds", "DNB API HTTP request latency", ("endpoint", "status")
+)
+
+# Хранилище
+STORAGE_OPERATION_SECONDS = histogram(
+    "storage_operation_seconds", "Storage backend call latency", ("operation",)
+)
+
+# Обработчики aiogram
+HANDLER_SECONDS = histogram(
+    "bot_handler_seconds", "Telegram update handler latency", ("handler", "outcome")
+)
+
+UPDATES_DROPPED = counter(
+    "bot_updates_dropped_total", "Repeated requests dropped by the per-chat throttle", ("group",)
+)
+
+# Проверка выплат
+SWEEP_SECONDS = histogram(
+    "payment_sweep_seconds", "Payment sweep duration", ("period",), buckets=SWEEP_BUCKETS
+)
+SWEEP_CARDS_CHECKED = counter(
+    "payment_sweep_cards_checked_total", "Cards checked by payment sweeps", ("period",)
+)
+SWEEP_PAYMENTS_FOUND = counter(
+    "payment_sweep_payments_found_total", "Payments found by payment sweeps", ("period",)
+)
+SWEEP_ERRORS = counter(
+    "payment_sweep_errors_total", "Failed card checks in payment sweeps", ("period",)
+)
+
+BALANCE_POLL_SECONDS = histogram(
+    "balance_poll_seconds", "Balance alert poll duration", buckets=SWEEP_BUCKETS
+)
+BALANCE_ALERTS_QUEUED = counter(
+    "balance_alerts_queued_total", "Balance change notifications queued"
+)
+
+STATS_CHARTS = counter(
+    "stats_charts_total", "Balance charts sent, by source (cached file_id or rendered)", ("source",)
+)
+STATS_CHART_RENDER_SECONDS = histogram(
+    "stats_chart_render_seconds", "Balance chart rendering time"
+)
+
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    """
+    Запускает локальный HTTP endpoint с метриками
+    Возвращает runner для остановки или None, если метрики выключены (METRICS_PORT=0)
+    """
+    if not METRICS_PORT:
+        return None
+
+    async def metrics_handler(request: web.Request) -> web.Response:
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host=METRICS_HOST, port=METRICS_PORT).start()
+    logger.info("Metrics available on http://%s:%s%s", METRICS_HOST, METRICS_PORT, METRICS_PATH)
+    return runner
@@ -0,0 +1,127 @@
+"""
+Middleware aiogram
+"""
+
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject, Update
+
+from logging_setup import trace_context
+from metrics import HANDLER_SECONDS, UPDATES_DROPPED
+
+logger = logging.getLogger(__name__)
+
+
+class TraceIdMiddleware(BaseMiddleware):
+    """
+    Задает новый trace id на время обработки каждого обновления
+    Регистрируется как outer middleware обновлений, до выбора обработчика
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        with trace_context():
+            if isinstance(event, Update):
+                logger.debug("Update received", extra={"update_id": event.update_id,
+                                                       "update_type": event.event_type})
+            return await handler(event, data)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """
+    Замеряет время работы обработчиков
+    Регистрируется как inner middleware, чтобы знать, какой обработчик выбран
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await handler(event, data)
+            outcome = "ok"
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, handler=name, outcome=outcome)
+            logger.info(
+                "Update handled",
+                extra={"handler": name, "outcome": outcome,
+                       "duration_ms": round(elapsed * 1000, 1), "sampled": outcome == "ok"}
+            )
+
+
+class ChatThrottleMiddleware(BaseMiddleware):
+    """
+    Не дает одному чату запускать тяжелый обработчик параллельно и слишком часто
+
+    Действует на обработчики сообщений и нажатий inline кнопок с флагом
+    throttle (значение - имя группы). Пока обработчик группы выполняется
+    для чата, повторные нажатия отбрасываются: пользователь получит
+    результат первого. После запуска новые нажатия также отбрасываются
+    в течение window секунд. Один экземпляр можно зарегистрировать и для
+    сообщений, и для нажатий - тогда у них общие группы
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._inflight: Set[Tuple[str, int]] = set()
+        # Время последнего запуска обработчика для (группа, chat_id), monotonic
+        self._started: Dict[Tuple[str, int], float] = {}
+
+    def _prune(self, now: float) -> None:
+        if len(self._started) > 1024:
+            self._started = {
+                key: started for key, started in self._started.items()
+                if now - started < self.window
+            }
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        group = get_flag(data, "throttle")
+        if not group:
+            return await handler(event, data)
+        if isinstance(event, Message):
+            chat_id = event.chat.id
+        elif isinstance(event, CallbackQuery):
+            chat_id = event.message.chat.id if event.message else event.from_user.id
+        else:
+            return await handler(event, data)
+
+        key = (group, chat_id)
+        now = time.monotonic()
+        if key in self._inflight or now - self._started.get(key, float("-inf")) < self.window:
+            UPDATES_DROPPED.inc(group=group)
+            logger.debug("Dropped repeated %s request", group, extra={"chat_id": chat_id})
+            if isinstance(event, CallbackQuery):
+                # Иначе кнопка остается в состоянии загрузки
+                await event.answer()
+            return None
+
+        self._prune(now)
+        self._inflight.add(key)
+        self._started[key] = now
+        try:
+            return await handler(event, data)
+        finally:
+            self._inflight.discard(key)
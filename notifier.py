@@ -0,0 +1,191 @@
+"""
+Отправка уведомлений из очереди исходящих
+
+Проверка выплат не отправляет сообщения сама, а ставит их в очередь
+в хранилище. Диспетчер забирает готовые сообщения пачками и отправляет
+их с ограничением частоты: общим на бота и отдельным для каждого чата.
+Временные ошибки повторяются с экспоненциальной задержкой, а статус
+доставки записывается в хранилище
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+    TelegramUnauthorizedError
+)
+
+from config import (
+    NOTIFY_RATE_PER_SECOND,
+    NOTIFY_RATE_BURST,
+    NOTIFY_CHAT_INTERVAL_SECONDS,
+    NOTIFY_BATCH_SIZE,
+    NOTIFY_CLAIM_SECONDS,
+    NOTIFY_MAX_ATTEMPTS,
+    NOTIFY_RETRY_BASE_DELAY,
+    NOTIFY_RETRY_MAX_DELAY,
+    NOTIFY_POLL_SECONDS,
+    NOTIFY_RETENTION_DAYS
+)
+from database import (
+    claim_notifications,
+    mark_notification_sent,
+    mark_notification_failed,
+    prune_notifications
+)
+from rate_limit import TokenBucket
+
+# Ошибки, после которых повторять отправку бессмысленно
+# (бот заблокирован, чат удален, некорректное сообщение)
+PERMANENT_ERRORS = (
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramNotFound,
+    TelegramUnauthorizedError
+)
+
+PRUNE_INTERVAL_SECONDS = 3600
+
+logger = logging.getLogger(__name__)
+
+_wake: Optional[asyncio.Event] = None
+
+
+def _wake_event() -> asyncio.Event:
+    global _wake
+    if _wake is None:
+        _wake = asyncio.Event()
+    return _wake
+
+
+def wake_dispatcher() -> None:
+    """Будит диспетчер, чтобы новое сообщение ушло без ожидания опроса"""
+    _wake_event().set()
+
+
+def retry_delay(attempts: int) -> float:
+    """Задержка перед повтором после attempts неудачных попыток (full jitter)"""
+    ceiling = min(NOTIFY_RETRY_MAX_DELAY, NOTIFY_RETRY_BASE_DELAY * 2 ** attempts)
+    return max(NOTIFY_RETRY_BASE_DELAY, random.uniform(0, ceiling))
+
+
+class NotificationDispatcher:
+    """Отправляет сообщения из очереди исходящих с учетом лимитов Telegram"""
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.bucket = TokenBucket(NOTIFY_RATE_PER_SECOND, NOTIFY_RATE_BURST)
+        # Время последней отправки в каждый чат (monotonic)
+        self._last_sent: Dict[int, float] = {}
+        # После TelegramRetryAfter все отправки ждут до этого момента
+        self._paused_until = 0.0
+
+    async def _wait_turn(self, chat_id: int) -> None:
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                pause = self._last_sent.get(chat_id, 0.0) + NOTIFY_CHAT_INTERVAL_SECONDS - time.monotonic()
+            if pause <= 0:
+                break
+            await asyncio.sleep(pause)
+        await self.bucket.acquire()
+
+    async def send(self, item: dict) -> None:
+        """Отправляет одно сообщение и записывает результат"""
+        chat_id = item["chat_id"]
+        await self._wait_turn(chat_id)
+
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=item["text"])
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать: притормаживаем все отправки
+            self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+            logger.warning("Telegram rate limit hit, pausing notifications for %ss", e.retry_after)
+            await mark_notification_failed(item["id"], str(e), time.time() + e.retry_after)
+            return
+        except PERMANENT_ERRORS as e:
+            logger.warning("Notification %s to %s failed permanently: %s", item["id"], chat_id, e)
+            await mark_notification_failed(item["id"], str(e), None)
+            return
+        except Exception as e:
+            attempts = item["attempts"] + 1
+            retry_at = None
+            if attempts < NOTIFY_MAX_ATTEMPTS:
+                retry_at = time.time() + retry_delay(attempts)
+            logger.warning("Error sending notification %s to %s (attempt %d): %s",
+                           item["id"], chat_id, attempts, e)
+            await mark_notification_failed(item["id"], str(e), retry_at)
+            return
+        finally:
+            self._last_sent[chat_id] = time.monotonic()
+
+        await mark_notification_sent(item["id"])
+
+    async def dispatch_batch(self) -> int:
+        """
+        Забирает и отправляет пачку готовых сообщений
+        Сообщения одного чата уходят по порядку, разные чаты - параллельно
+        """
+        items = await claim_notifications(NOTIFY_BATCH_SIZE, NOTIFY_CLAIM_SECONDS)
+        if not items:
+            return 0
+
+        by_chat = defaultdict(list)
+        for item in items:
+            by_chat[item["chat_id"]].append(item)
+
+        async def send_chat(chat_items: list) -> None:
+            for item in chat_items:
+                try:
+                    await self.send(item)
+                except Exception:
+                    # Сообщение вернется в очередь по истечении захвата
+                    logger.exception("Error dispatching notification %s", item["id"])
+
+        await asyncio.gather(*(send_chat(chat_items) for chat_items in by_chat.values()))
+
+        # Старые записи о времени отправки больше не ограничивают чаты
+        horizon = time.monotonic() - NOTIFY_CHAT_INTERVAL_SECONDS
+        self._last_sent = {c: t for c, t in self._last_sent.items() if t > horizon}
+        return len(items)
+
+
+async def notification_dispatcher_task(bot: Bot):
+    """Фоновая задача отправки уведомлений из очереди исходящих"""
+    dispatcher = NotificationDispatcher(bot)
+    wake = _wake_event()
+    next_prune = 0.0
+
+    while True:
+        try:
+            wake.clear()
+            sent = await dispatcher.dispatch_batch()
+
+            now = time.time()
+            if now >= next_prune:
+                pruned = await prune_notifications(now - NOTIFY_RETENTION_DAYS * 24 * 3600)
+                if pruned:
+                    logger.info("Pruned %d old notifications", pruned)
+                next_prune = now + PRUNE_INTERVAL_SECONDS
+
+            if sent >= NOTIFY_BATCH_SIZE:
+                # Очередь не разобрана: сразу берем следующую пачку
+                continue
+
+            try:
+                await asyncio.wait_for(wake.wait(), timeout=NOTIFY_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+        except Exception:
+            logger.exception("Error in notification dispatcher task")
+            await asyncio.sleep(NOTIFY_POLL_SECONDS)
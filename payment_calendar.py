@@ -0,0 +1,223 @@
+"""
+Календарь периодов выплат
+
+Окна проверки выплат вычисляются один раз на несколько месяцев вперед
+и хранятся отсортированными по началу, поэтому "текущий период"
+и "начало следующего окна" находятся бинарным поиском.
+
+Дата выплаты, выпадающая на выходной или праздник Норвегии, переносится
+на ближайший предыдущий рабочий день (PAYMENT_SHIFT_RULE=previous),
+следующий (next) или не переносится (none). Дни, которых нет в месяце
+(например, 31), заменяются последним днем месяца
+"""
+
+import bisect
+import calendar
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence
+
+import pytz
+
+from config import (
+    PAYMENT_DATES,
+    PAYMENT_CHECK_DAYS_BEFORE,
+    PAYMENT_CHECK_DAYS_AFTER,
+    PAYMENT_SHIFT_RULE,
+    PAYMENT_CALENDAR_MONTHS,
+    NORWAY_TIMEZONE
+)
+
+SHIFT_RULES = ("previous", "next", "none")
+
+
+def easter_sunday(year: int) -> date:
+    """Пасхальное воскресенье по григорианскому календарю (алгоритм Мееуса)"""
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+@lru_cache(maxsize=32)
+def norwegian_holidays(year: int) -> frozenset:
+    """Официальные праздничные дни Норвегии (helligdager) за год"""
+    easter = easter_sunday(year)
+    return frozenset({
+        date(year, 1, 1),                   # Første nyttårsdag
+        easter - timedelta(days=3),         # Skjærtorsdag
+        easter - timedelta(days=2),         # Langfredag
+        easter,                             # Første påskedag
+        easter + timedelta(days=1),         # Andre påskedag
+        date(year, 5, 1),                   # Arbeidernes dag
+        date(year, 5, 17),                  # Grunnlovsdag
+        easter + timedelta(days=39),        # Kristi himmelfartsdag
+        easter + timedelta(days=49),        # Første pinsedag
+        easter + timedelta(days=50),        # Andre pinsedag
+        date(year, 12, 25),                 # Første juledag
+        date(year, 12, 26),                 # Andre juledag
+    })
+
+
+def is_business_day(day: date) -> bool:
+    return day.weekday() < 5 and day not in norwegian_holidays(day.year)
+
+
+def shift_to_business_day(day: date, rule: str = PAYMENT_SHIFT_RULE) -> date:
+    """Переносит дату выплаты с выходного или праздника по правилу rule"""
+    if rule == "none":
+        return day
+    step = timedelta(days=-1 if rule == "previous" else 1)
+    while not is_business_day(day):
+        day += step
+    return day
+
+
+def add_months(year: int, month: int, offset: int) -> tuple:
+    index = year * 12 + (month - 1) + offset
+    return index // 12, index % 12 + 1
+
+
+@dataclass(frozen=True)
+class PaymentWindow:
+    """Окно проверки одной выплаты"""
+
+    # Идентификатор периода: плановая дата выплаты "YYYY-MM-DD"
+    period: str
+    # Фактический день выплаты после переноса с выходных и праздников
+    payday: date
+    # Первый день окна проверки
+    start_date: date
+    # Начало дня выплаты и границы окна проверки, секунды epoch
+    payday_start: float
+    start: float
+    end: float
+
+
+class PaymentCalendar:
+    """Предвычисленные окна проверки выплат с поиском за O(log n)"""
+
+    def __init__(self, payment_dates: Sequence[int] = PAYMENT_DATES,
+                 days_before: int = PAYMENT_CHECK_DAYS_BEFORE,
+                 days_after: int = PAYMENT_CHECK_DAYS_AFTER,
+                 timezone: str = NORWAY_TIMEZONE,
+                 shift_rule: str = PAYMENT_SHIFT_RULE,
+                 months: int = PAYMENT_CALENDAR_MONTHS):
+        if shift_rule not in SHIFT_RULES:
+            raise ValueError(f"Unknown payment shift rule: {shift_rule}")
+        self.payment_dates = sorted(set(payment_dates))
+        self.days_before = days_before
+        self.days_after = days_after
+        self.tz = pytz.timezone(timezone)
+        self.shift_rule = shift_rule
+        self.months = max(months, 2)
+
+        self._windows: List[PaymentWindow] = []
+        self._starts: List[float] = []
+        self._by_period: Dict[str, PaymentWindow] = {}
+        # Момент, после которого таблицу окон нужно построить заново
+        self._valid_until = 0.0
+
+    def _local_midnight(self, day: date) -> float:
+        return self.tz.localize(datetime(day.year, day.month, day.day)).timestamp()
+
+    def _make_window(self, year: int, month: int, payment_date: int) -> PaymentWindow:
+        nominal = date(year, month, min(payment_date, calendar.monthrange(year, month)[1]))
+        payday = shift_to_business_day(nominal, self.shift_rule)
+        start_date = payday - timedelta(days=self.days_before)
+        return PaymentWindow(
+            period=nominal.isoformat(),
+            payday=payday,
+            start_date=start_date,
+            payday_start=self._local_midnight(payday),
+            start=self._local_midnight(start_date),
+            end=self._local_midnight(payday + timedelta(days=self.days_after))
+        )
+
+    def build(self, now: float) -> None:
+        """Строит окна от прошлого месяца на self.months месяцев вперед"""
+        today = datetime.fromtimestamp(now, self.tz).date()
+        windows = {}
+        for offset in range(-1, self.months):
+            year, month = add_months(today.year, today.month, offset)
+            for payment_date in self.payment_dates:
+                window = self._make_window(year, month, payment_date)
+                # 30 и 31 в коротком месяце дают один и тот же период
+                windows[window.period] = window
+
+        # Две даты, перенесенные на один рабочий день, - это одна выплата
+        by_payday = {}
+        for period in sorted(windows):
+            by_payday.setdefault(windows[period].payday, windows[period])
+
+        self._windows = sorted(by_payday.values(), key=lambda w: (w.start, w.period))
+        self._starts = [window.start for window in self._windows]
+        self._by_period = windows
+        # Перестраиваем заранее, пока впереди остается хотя бы месяц окон
+        year, month = add_months(today.year, today.month, self.months - 1)
+        self._valid_until = self._local_midnight(date(year, month, 1))
+
+    def _ensure(self, now: float) -> None:
+        if not self._windows or now >= self._valid_until or now < self._starts[0]:
+            self.build(now)
+
+    def current_window(self, now: Optional[float] = None) -> Optional[PaymentWindow]:
+        """Окно, в которое попадает now (при пересечении - начавшееся последним)"""
+        now = time.time() if now is None else now
+        self._ensure(now)
+        index = bisect.bisect_right(self._starts, now) - 1
+        # Окна могут пересекаться: идем назад, пока начало окна
+        # не станет дальше от now, чем длина самого длинного окна
+        while index >= 0:
+            window = self._windows[index]
+            if window.end >= now:
+                return window
+            if now - window.start > self._max_length():
+                break
+            index -= 1
+        return None
+
+    def _max_length(self) -> float:
+        # С запасом на переход на летнее время
+        return (self.days_before + self.days_after + 1) * 24 * 3600
+
+    def current_period(self, now: Optional[float] = None) -> Optional[str]:
+        window = self.current_window(now)
+        return window.period if window else None
+
+    def next_window_start(self, now: Optional[float] = None) -> Optional[float]:
+        """Начало ближайшего окна, которое начнется позже now"""
+        now = time.time() if now is None else now
+        self._ensure(now)
+        index = bisect.bisect_right(self._starts, now)
+        if index < len(self._starts):
+            return self._starts[index]
+        return None
+
+    def window_for(self, period: str) -> Optional[PaymentWindow]:
+        """Окно по идентификатору периода"""
+        window = self._by_period.get(period)
+        if window is None:
+            year, month, day = map(int, period.split("-"))
+            window = self._make_window(year, month, day)
+        return window
+
+
+_calendar: Optional[PaymentCalendar] = None
+
+
+def get_payment_calendar() -> PaymentCalendar:
+    """Общий календарь выплат по настройкам из config"""
+    global _calendar
+    if _calendar is None:
+        _calendar = PaymentCalendar()
+    return _calendar
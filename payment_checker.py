@@ -3,60 +3,88 @@
 """
 
 import asyncio
-from datetime import datetime, timedelta
-from typing import Optional
-import pytz
-
-from aiogram import Bot
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Iterable, Iterator, List, Optional
 
 from config import (
-    PAYMENT_DATES,
-    PAYMENT_CHECK_DAYS_BEFORE,
-    PAYMENT_CHECK_DAYS_AFTER,
     PAYMENT_CHECK_INTERVAL_HOURS,
+    PAYMENT_CHECK_CONCURRENCY,
+    PAYMENT_SCHEDULE_REFRESH_MINUTES,
     PAYMENT_MIN_AMOUNT,
-    NORWAY_TIMEZONE
+    TRANSACTION_CURSOR_SIZE
 )
 from database import (
-    get_all_users,
-    get_card_number,
+    get_unpaid_cards,
+    get_card_subscribers,
     is_payment_received,
-    mark_payment_received
+    mark_payment_received,
+    get_card_cursor,
+    set_card_cursor
 )
-from api_client import get_card_transactions
+from api_client import get_card_transactions, api_retry_after
+from circuit_breaker import CircuitOpenError
+from logging_setup import trace_context
 from messages import Messages
+from metrics import SWEEP_SECONDS, SWEEP_CARDS_CHECKED, SWEEP_PAYMENTS_FOUND, SWEEP_ERRORS
+from notifier import wake_dispatcher
+from payment_calendar import get_payment_calendar
+from payment_scheduler import PaymentScheduler
+from sharding import ShardLeases
 
+logger = logging.getLogger(__name__)
 
-def get_norway_time() -> datetime:
-    """Возвращает текущее время в Норвегии"""
-    norway_tz = pytz.timezone(NORWAY_TIMEZONE)
-    return datetime.now(norway_tz)
 
+@dataclass
+class PaymentCheckResult:
+    """Результат проверки выплаты по одной карте"""
 
-def get_current_payment_period() -> Optional[str]:
-    """
-    Определяет текущий период выплат на основе текущей даты
-    Возвращает строку вида "YYYY-MM-DD" для даты выплаты или None
-    """
-    now = get_norway_time()
+    found: bool
+    # Сколько транзакций появилось с прошлой проверки карты
+    new_transactions: int = 0
+    # Скольким пользователям карты выплата отмечена этой проверкой
+    notified: int = 0
 
-    # Определяем, к какому периоду выплат мы ближе
-    for payment_date in PAYMENT_DATES:
-        # Создаем дату выплаты для текущего месяца
-        try:
-            payment_datetime = now.replace(day=payment_date, hour=0, minute=0, second=0, microsecond=0)
-        except ValueError:
-            # Если такого дня нет в месяце (например, 31 февраля)
-            continue
 
-        # Проверяем, находимся ли мы в диапазоне проверки
-        start_check = payment_datetime - timedelta(days=PAYMENT_CHECK_DAYS_BEFORE)
-        end_check = payment_datetime + timedelta(days=PAYMENT_CHECK_DAYS_AFTER)
+@dataclass
+class SweepStats:
+    """Итоги одного прохода проверки выплат"""
 
-        if start_check <= now <= end_check:
-            return payment_datetime.strftime("%Y-%m-%d")
+    period: str
+    # Проверенные карты и выплаты, отмеченные их пользователям
+    checked: int = 0
+    found: int = 0
+    errors: int = 0
+    duration: float = 0.0
 
-    return None
+    def summary(self) -> str:
+        return (
+            f"Payment sweep for {self.period}: cards={self.checked} "
+            f"found={self.found} errors={self.errors} time={self.duration:.1f}s"
+        )
+
+    def record_metrics(self) -> None:
+        SWEEP_SECONDS.observe(self.duration, period=self.period)
+        SWEEP_CARDS_CHECKED.inc(self.checked, period=self.period)
+        SWEEP_PAYMENTS_FOUND.inc(self.found, period=self.period)
+        SWEEP_ERRORS.inc(self.errors, period=self.period)
+
+
+def get_payday_start(payment_period: str) -> float:
+    """Начало фактического дня выплаты (по времени Норвегии) в секундах epoch"""
+    return get_payment_calendar().window_for(payment_period).payday_start
+
+
+def get_current_payment_period(now: Optional[float] = None) -> Optional[str]:
+    """
+    Определяет текущий период выплат по календарю выплат
+    Возвращает строку вида "YYYY-MM-DD" для плановой даты выплаты или None
+    """
+    return get_payment_calendar().current_period(now)
 
 
 def check_transaction_is_payment(transaction: dict) -> Optional[float]:
@@ -84,87 +112,270 @@ def check_transaction_is_payment(transaction: dict) -> Optional[float]:
             return amount
         return None
     except (ValueError, TypeError) as exp:
-        print(f"ERROR: {exp}")
+        logger.warning("Cannot parse transaction amount: %s", exp)
         return None
 
 
-async def check_user_payment(chat_id: str, bot: Bot) -> bool:
+# Поля, в которых API может передавать идентификатор и дату транзакции
+TRANSACTION_ID_FIELDS = ("id", "transactionId", "transactionReference", "reference")
+TRANSACTION_DATE_FIELDS = ("date", "bookingDate", "transactionDate", "valueDate")
+
+
+def transaction_key(transaction: dict) -> str:
+    """
+    Устойчивый ключ транзакции для курсора
+    Идентификатор из API, а если его нет - хеш содержимого транзакции
+    """
+    for field in TRANSACTION_ID_FIELDS:
+        value = transaction.get(field)
+        if value:
+            return f"{field}:{value}"
+    data = json.dumps(transaction, sort_keys=True, ensure_ascii=False, default=str)
+    return "sha1:" + hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def transaction_date(transaction: dict) -> Optional[date]:
+    """Дата транзакции, если API ее передает в ISO формате"""
+    for field in TRANSACTION_DATE_FIELDS:
+        value = transaction.get(field)
+        if isinstance(value, str) and len(value) >= 10:
+            try:
+                return date.fromisoformat(value[:10])
+            except ValueError:
+                continue
+    return None
+
+
+def iter_new_transactions(transactions: Iterable[dict], cursor: Optional[dict],
+                          window_start: date, examined: List[str]) -> Iterator[dict]:
     """
-    Проверяет, получил ли пользователь выплату
-    Возвращает True, если выплата найдена
+    Перебирает транзакции, которые еще не проверялись
+
+    Транзакции из курсора карты пропускаются, как и транзакции с датой
+    раньше начала окна проверки: старое крупное зачисление не должно
+    засчитываться как выплата текущего периода.
+    Ключи просмотренных транзакций (не больше TRANSACTION_CURSOR_SIZE)
+    добавляются в examined для следующего курсора
     """
-    # Получаем текущий период выплат
-    payment_period = get_current_payment_period()
-    if not payment_period:
-        return False
+    seen = set(cursor.get("seen", [])) if cursor else set()
+    for transaction in transactions:
+        key = transaction_key(transaction)
+        if len(examined) < TRANSACTION_CURSOR_SIZE:
+            examined.append(key)
+        if key in seen:
+            continue
+        tx_date = transaction_date(transaction)
+        if tx_date is not None and tx_date < window_start:
+            continue
+        yield transaction
 
-    # Проверяем, не была ли уже зафиксирована выплата
-    if is_payment_received(int(chat_id), payment_period):
-        return True
 
-    # Получаем номер карты пользователя
-    card_number = get_card_number(int(chat_id))
-    if not card_number:
-        return False
+def build_cursor(examined: List[str], previous: Optional[dict] = None) -> dict:
+    """
+    Курсор карты: ключи просмотренных сейчас транзакций, а за ними ключи
+    прежнего курсора - перебор мог остановиться на выплате, не дойдя до них
+    """
+    keys = list(dict.fromkeys(examined + (previous.get("seen", []) if previous else [])))
+    return {
+        "seen": keys[:TRANSACTION_CURSOR_SIZE],
+        "updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
 
+async def notify_subscribers(card_number: str, payment_period: str, amount: float) -> int:
+    """
+    Отмечает выплату всем пользователям карты, у которых ее еще нет
+    Список берется из обратного индекса в момент находки, поэтому
+    пользователи, привязавшие карту после обновления рабочего списка,
+    тоже получают уведомление. Возвращает число отмеченных пользователей
+    """
+    notified = 0
+    for chat_id in await get_card_subscribers(card_number):
+        if await is_payment_received(int(chat_id), payment_period):
+            continue
+        # Уведомление ставится в очередь исходящих вместе с отметкой
+        # о выплате и отправляется диспетчером
+        await mark_payment_received(
+            int(chat_id), payment_period, amount,
+            notification=Messages.payment_received(amount)
+        )
+        notified += 1
+    if notified:
+        wake_dispatcher()
+    return notified
+
+
+async def check_card_payment(card_number: str, payment_period: str) -> PaymentCheckResult:
+    """
+    Проверяет, пришла ли на карту выплата за период
+    Транзакции запрашиваются один раз на карту, сколько бы
+    пользователей ее ни привязали
+    """
     # Получаем последние транзакции
     transactions = await get_card_transactions(card_number)
 
-    if not transactions:
-        return False
-
-    # Проверяем транзакции на наличие выплаты
-    for transaction in transactions:
+    if transactions is None:
+        raise RuntimeError("failed to fetch transactions")
+
+    # Проверяем только транзакции, появившиеся после прошлой проверки карты;
+    # перебор останавливается на первой выплате. Ответ обычно уже разобран
+    # целиком: по мере перебора транзакции декодируются, только если
+    # включен API_LAZY_PARSE_MIN_BYTES и ответ не меньше этого размера
+    cursor = await get_card_cursor(card_number)
+    window_start = get_payment_calendar().window_for(payment_period).start_date
+    examined: List[str] = []
+    new_transactions = 0
+    payment_amount = None
+    for transaction in iter_new_transactions(transactions, cursor, window_start, examined):
+        new_transactions += 1
         payment_amount = check_transaction_is_payment(transaction)
-
         if payment_amount:
-            # Выплата найдена!
-            mark_payment_received(int(chat_id), payment_period, payment_amount)
-
-            # Отправляем уведомление пользователю
-            try:
-                await bot.send_message(
-                    chat_id=int(chat_id),
-                    text=Messages.payment_received(payment_amount)
-                )
-            except Exception as e:
-                print(f"Error sending notification to {chat_id}: {e}")
+            break
 
-            return True
+    notified = 0
+    if payment_amount:
+        # Выплата найдена - расходится всем пользователям карты. Курсор
+        # сохраняется после отметки: при сбое между ними выплата найдется снова
+        notified = await notify_subscribers(card_number, payment_period, payment_amount)
+    if examined:
+        await set_card_cursor(card_number, build_cursor(examined, cursor))
 
-    return False
+    return PaymentCheckResult(
+        found=payment_amount is not None, new_transactions=new_transactions, notified=notified
+    )
 
 
-async def payment_checker_task(bot: Bot):
+async def run_payment_sweep(payment_period: str, work_list: list,
+                            scheduler: Optional[PaymentScheduler] = None) -> SweepStats:
     """
-    Основная задача для проверки выплат всех пользователей
-    Запускается периодически
+    Проверяет выплаты по рабочему списку пар (card_number, [chat_id, ...])
+    параллельно, не более PAYMENT_CHECK_CONCURRENCY проверок одновременно.
+    Частоту запросов к API ограничивает сам api_client.
+    Если передано расписание, каждый результат планирует следующую проверку
     """
-    while True:
-        try:
-            # Проверяем, находимся ли мы в периоде проверки выплат
-            payment_period = get_current_payment_period()
-
-            if payment_period:
-                print(f"Checking payments for period: {payment_period}")
+    stats = SweepStats(period=payment_period)
+    semaphore = asyncio.Semaphore(PAYMENT_CHECK_CONCURRENCY)
+    started = time.monotonic()
+
+    async def check_one(card_number: str, chat_ids: list) -> None:
+        # Свой trace id у каждой проверки: он попадает в логи и запросы к DNB
+        with trace_context():
+            async with semaphore:
+                await check_with_retries(card_number, chat_ids)
+
+    async def check_with_retries(card_number: str, chat_ids: list) -> None:
+        while True:
+            # Пока API недоступно, проход стоит на паузе
+            pause = api_retry_after()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            try:
+                result = await check_card_payment(card_number, payment_period)
+            except CircuitOpenError:
+                # Breaker разомкнулся посреди прохода: ждем и повторяем
+                continue
+            except Exception as e:
+                stats.errors += 1
+                logger.warning("Error checking payment for users %s: %s",
+                               ", ".join(chat_ids), e)
+                if scheduler is not None:
+                    scheduler.record(card_number, time.time())
+                return
+            break
+        stats.checked += 1
+        stats.found += result.notified
+        if scheduler is not None:
+            scheduler.record(card_number, time.time(), found=result.found,
+                             changed=result.new_transactions > 0)
+
+    await asyncio.gather(*(check_one(card_number, chat_ids) for card_number, chat_ids in work_list))
+
+    stats.duration = time.monotonic() - started
+    stats.record_metrics()
+    return stats
+
+
+async def sleep_or_wake(event: asyncio.Event, seconds: float) -> None:
+    """Спит seconds секунд или до установки event"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout=seconds)
+    except asyncio.TimeoutError:
+        pass
 
-                # Получаем всех пользователей
-                users = get_all_users()
 
-                # Проверяем каждого пользователя
-                for chat_id in users:
-                    try:
-                        await check_user_payment(chat_id, bot)
-                    except Exception as e:
-                        print(f"Error checking payment for user {chat_id}: {e}")
+async def payment_checker_task():
+    """
+    Основная задача для проверки выплат всех пользователей
 
-                    # Небольшая задержка между проверками разных пользователей
-                    await asyncio.sleep(1)
+    В период выплат карты проверяются по адаптивному расписанию:
+    задача просыпается к ближайшей запланированной проверке и проверяет
+    только те, чей срок наступил. Проверяются только карты из шардов,
+    аренду которых держит этот процесс
+    """
+    scheduler = PaymentScheduler()
+    next_refresh = 0.0
 
-            # Ждем до следующей проверки
-            await asyncio.sleep(PAYMENT_CHECK_INTERVAL_HOURS * 3600)
+    leases = ShardLeases()
+    shards_changed = asyncio.Event()
+    lease_task = asyncio.create_task(leases.run(on_change=shards_changed.set))
 
-        except Exception as e:
-            print(f"Error in payment checker task: {e}")
-            # В случае ошибки ждем 5 минут перед повтором
-            await asyncio.sleep(300)
+    try:
+        while True:
+            try:
+                # Проверяем, находимся ли мы в периоде проверки выплат
+                payment_period = get_current_payment_period()
+
+                if not payment_period:
+                    # Спим до начала следующего окна проверки
+                    next_start = get_payment_calendar().next_window_start()
+                    delay = PAYMENT_CHECK_INTERVAL_HOURS * 3600
+                    if next_start is not None:
+                        delay = max(next_start - time.time(), 1.0)
+                    logger.info("No payment window now, sleeping %.0fs until the next one", delay)
+                    await asyncio.sleep(delay)
+                    continue
+
+                now = time.time()
+                if (payment_period != scheduler.period or now >= next_refresh
+                        or shards_changed.is_set()):
+                    # Рабочий список за один проход: карты своих шардов, у которых
+                    # есть пользователи без найденной выплаты за период
+                    if payment_period != scheduler.period:
+                        logger.info("Checking payments for period: %s", payment_period)
+                    shards_changed.clear()
+                    work_list = [
+                        (card_number, chat_ids)
+                        for card_number, chat_ids in await get_unpaid_cards(payment_period)
+                        if leases.owns(card_number)
+                    ]
+                    scheduler.sync(payment_period, get_payday_start(payment_period), work_list, now)
+                    next_refresh = now + PAYMENT_SCHEDULE_REFRESH_MINUTES * 60
+
+                pause = api_retry_after()
+                if pause > 0:
+                    logger.warning("DNB API is unavailable, pausing payment checks for %.0fs", pause)
+                    await asyncio.sleep(pause)
+                    continue
+
+                # Шард мог уйти другому процессу после последнего обновления списка
+                due = [item for item in scheduler.pop_due(now) if leases.owns(item[0])]
+                if due:
+                    stats = await run_payment_sweep(payment_period, due, scheduler)
+                    logger.info(stats.summary())
+
+                # Спим до ближайшей проверки по расписанию, до обновления списка
+                # или до смены набора шардов
+                wake_at = next_refresh
+                next_due = scheduler.next_due()
+                if next_due is not None:
+                    wake_at = min(wake_at, next_due)
+                await sleep_or_wake(shards_changed, max(wake_at - time.time(), 1.0))
+
+            except Exception:
+                logger.exception("Error in payment checker task")
+                # В случае ошибки ждем 5 минут перед повтором
+                await asyncio.sleep(300)
+    finally:
+        lease_task.cancel()
+        await asyncio.gather(lease_task, return_exceptions=True)
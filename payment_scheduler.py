@@ -0,0 +1,154 @@
+"""
+Адаптивное расписание проверки выплат
+
+Карты лежат в очереди с приоритетом по времени следующей проверки:
+одна проверка карты обслуживает всех привязавших ее пользователей.
+Рядом с датой выплаты проверки идут чаще, а у карт, чьи
+транзакции не меняются, интервал растет экспоненциально.
+После найденной выплаты карта выбывает из расписания до следующего периода
+"""
+
+import heapq
+import itertools
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    PAYMENT_CHECK_INTERVAL_HOURS,
+    PAYMENT_POLL_MIN_MINUTES,
+    PAYMENT_POLL_MAX_BACKOFF
+)
+
+DAY_SECONDS = 24 * 3600
+
+
+@dataclass
+class ScheduleEntry:
+    """Состояние расписания одной карты"""
+
+    # chat_id пользователей карты, еще не получивших выплату
+    chat_ids: Tuple[str, ...]
+    due: float
+    unchanged: int = 0
+    version: int = 0
+
+
+class PaymentScheduler:
+    """Очередь проверок выплат с приоритетом по времени следующей проверки"""
+
+    def __init__(self):
+        self.period: Optional[str] = None
+        self.payday_start: float = 0.0
+        self._entries: Dict[str, ScheduleEntry] = {}
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _push(self, card_number: str, entry: ScheduleEntry) -> None:
+        # Старые записи кучи не удаляются, а отбрасываются по версии
+        entry.version += 1
+        heapq.heappush(self._heap, (entry.due, next(self._counter), card_number, entry.version))
+
+    def sync(self, period: str, payday_start: float, work_list: list, now: float) -> None:
+        """
+        Приводит расписание к актуальному рабочему списку пар
+        (card_number, [chat_id, ...])
+
+        Новые карты проверяются сразу, выбывшие (оплаченные или
+        отвязанные всеми пользователями) убираются. При смене периода
+        расписание строится заново
+        """
+        if period != self.period:
+            self.period = period
+            self.payday_start = payday_start
+            self._entries.clear()
+            self._heap.clear()
+
+        current = {card_number: tuple(chat_ids) for card_number, chat_ids in work_list}
+        for card_number in list(self._entries):
+            if card_number not in current:
+                del self._entries[card_number]
+
+        for card_number, chat_ids in current.items():
+            entry = self._entries.get(card_number)
+            if entry is None:
+                entry = ScheduleEntry(chat_ids=chat_ids, due=now)
+                self._entries[card_number] = entry
+                self._push(card_number, entry)
+            else:
+                # Новые пользователи уже привязанной карты получат выплату
+                # при ее ближайшей проверке, опрос не сбрасывается
+                entry.chat_ids = chat_ids
+
+        # Куча без устаревших записей, чтобы она не росла бесконечно
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [
+                item for item in self._heap
+                if item[2] in self._entries and self._entries[item[2]].version == item[3]
+            ]
+            heapq.heapify(self._heap)
+
+    def pop_due(self, now: float) -> list:
+        """Забирает из очереди все карты, чья проверка уже наступила"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, card_number, version = heapq.heappop(self._heap)
+            entry = self._entries.get(card_number)
+            if entry is not None and entry.version == version:
+                due.append((card_number, list(entry.chat_ids)))
+        return due
+
+    def next_due(self) -> Optional[float]:
+        """Время ближайшей запланированной проверки"""
+        while self._heap:
+            _, _, card_number, version = self._heap[0]
+            entry = self._entries.get(card_number)
+            if entry is not None and entry.version == version:
+                return self._heap[0][0]
+            heapq.heappop(self._heap)
+        return None
+
+    def base_interval(self, now: float) -> float:
+        """
+        Базовый интервал проверки: минимальный в день выплаты
+        и линейно растущий до PAYMENT_CHECK_INTERVAL_HOURS за сутки от него
+        """
+        min_interval = PAYMENT_POLL_MIN_MINUTES * 60
+        max_interval = max(PAYMENT_CHECK_INTERVAL_HOURS * 3600, min_interval)
+
+        if now < self.payday_start:
+            distance = self.payday_start - now
+        else:
+            distance = max(0.0, now - (self.payday_start + DAY_SECONDS))
+
+        ratio = min(distance / DAY_SECONDS, 1.0)
+        return min_interval + (max_interval - min_interval) * ratio
+
+    def record(self, card_number: str, now: float, found: bool = False,
+               changed: bool = False) -> None:
+        """Планирует следующую проверку карты по результату текущей"""
+        entry = self._entries.get(card_number)
+        if entry is None:
+            return
+
+        if found:
+            del self._entries[card_number]
+            return
+
+        if changed:
+            entry.unchanged = 0
+        else:
+            entry.unchanged += 1
+
+        base = self.base_interval(now)
+        backoff = min(2 ** entry.unchanged, PAYMENT_POLL_MAX_BACKOFF)
+        due = now + base * backoff
+
+        # В день выплаты все начинают с частого опроса, даже после долгого затишья
+        if now < self.payday_start:
+            due = min(due, self.payday_start)
+
+        entry.due = due
+        self._push(card_number, entry)
@@ -0,0 +1,38 @@
+"""
+Ограничение частоты запросов (token bucket)
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket: в среднем не более rate операций в секунду,
+    с допустимым всплеском до capacity операций подряд
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        """Ждет, пока не освободится токен, и забирает его"""
+        if self.rate <= 0:
+            return
+
+        # Под блокировкой ожидающие обслуживаются по очереди (FIFO)
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
@@ -0,0 +1,119 @@
+"""
+Разделение фоновых проверок карт (выплаты, балансы) между несколькими процессами бота
+
+Карты делятся на CHECKER_SHARDS шардов по хешу номера карты.
+Каждый шард проверяет только процесс, владеющий арендой шарда в хранилище.
+Процессы отмечаются арендой-пульсом и берут себе примерно поровну шардов;
+шарды упавшего процесса забираются после истечения его аренды.
+Несколько процессов возможны только с SQLite: JSON базу открывает один процесс
+"""
+
+import asyncio
+import logging
+import math
+import os
+import socket
+import time
+import zlib
+from typing import Optional, Set
+
+from config import CHECKER_SHARDS, CHECKER_LEASE_SECONDS, WORKER_ID
+from database import acquire_lease, release_lease, list_leases
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id() -> str:
+    return WORKER_ID or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def shard_of(key: str, shards: int = CHECKER_SHARDS) -> int:
+    """Номер шарда для ключа (стабилен между процессами и перезапусками)"""
+    return zlib.crc32(str(key).encode("utf-8")) % max(shards, 1)
+
+
+class ShardLeases:
+    """Владение шардами проверки выплат на основе аренд в хранилище"""
+
+    def __init__(self, shards: int = CHECKER_SHARDS, ttl: float = CHECKER_LEASE_SECONDS,
+                 owner: Optional[str] = None, kind: str = "payment"):
+        self.shards = max(shards, 1)
+        self.ttl = ttl
+        self.owner = owner or default_worker_id()
+        # Разные фоновые задачи делят шарды независимо, каждая под своими арендами
+        self.kind = kind
+        self.shard_prefix = f"{kind}-shard:"
+        self.worker_prefix = f"{kind}-worker:"
+        self.owned: Set[int] = set()
+        self._refreshed_at = 0.0
+
+    @property
+    def renew_interval(self) -> float:
+        # Продлеваем заметно раньше истечения, чтобы пережить паузы
+        return self.ttl / 3
+
+    def owns(self, key: str) -> bool:
+        return shard_of(key, self.shards) in self.owned
+
+    async def refresh(self) -> bool:
+        """
+        Продлевает свои аренды, забирает свободные шарды до справедливой доли
+        и отдает лишние. Возвращает True, если набор шардов изменился
+        """
+        now = time.time()
+        await acquire_lease(self.worker_prefix + self.owner, self.owner, self.ttl)
+
+        workers = await list_leases(self.worker_prefix)
+        live_workers = max(1, sum(1 for _, _, expires_at in workers if expires_at >= now))
+        target = math.ceil(self.shards / live_workers)
+
+        owned = set()
+        # Сначала продлеваем свои шарды
+        for shard in sorted(self.owned):
+            if len(owned) >= target:
+                await release_lease(f"{self.shard_prefix}{shard}", self.owner)
+            elif await acquire_lease(f"{self.shard_prefix}{shard}", self.owner, self.ttl):
+                owned.add(shard)
+
+        # Затем добираем свободные, начиная со своего места в кольце
+        start = shard_of(self.owner, self.shards)
+        for offset in range(self.shards):
+            if len(owned) >= target:
+                break
+            shard = (start + offset) % self.shards
+            if shard in owned:
+                continue
+            if await acquire_lease(f"{self.shard_prefix}{shard}", self.owner, self.ttl):
+                owned.add(shard)
+
+        changed = owned != self.owned
+        self.owned = owned
+        self._refreshed_at = now
+        if changed:
+            logger.info("Worker %s owns %s shards: %s", self.owner, self.kind, sorted(owned))
+        return changed
+
+    async def run(self, on_change=None) -> None:
+        """Фоновое продление аренд; on_change вызывается при смене набора шардов"""
+        try:
+            while True:
+                try:
+                    if await self.refresh() and on_change is not None:
+                        on_change()
+                except Exception as e:
+                    logger.warning("Error refreshing shard leases: %s", e)
+                    # Аренды могли истечь: не проверяем чужие шарды
+                    if self.owned and time.time() - self._refreshed_at >= self.ttl:
+                        self.owned = set()
+                        if on_change is not None:
+                            on_change()
+                await asyncio.sleep(self.renew_interval)
+        finally:
+            await self.release_all()
+
+    async def release_all(self) -> None:
+        """Отдает все аренды при остановке, чтобы другие процессы забрали шарды сразу"""
+        for shard in self.owned:
+            await release_lease(f"{self.shard_prefix}{shard}", self.owner)
+        await release_lease(self.worker_prefix + self.owner, self.owner)
+        self.owned = set()
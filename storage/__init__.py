@@ -0,0 +1,28 @@
+"""
+Слой хранения данных с подключаемыми бэкендами
+"""
+
+from storage.base import Storage, StorageError
+from storage.json_backend import JsonStorage
+from storage.sqlite_backend import SqliteStorage
+
+
+def create_storage(backend: str, path: str, **options) -> Storage:
+    """
+    Создает бэкенд хранилища по его имени ("json" или "sqlite")
+    options передаются конструктору бэкенда
+    """
+    if backend == "json":
+        return JsonStorage(path, **options)
+    if backend == "sqlite":
+        return SqliteStorage(path, **options)
+    raise StorageError(f"Unknown storage backend: {backend}")
+
+
+__all__ = [
+    "Storage",
+    "StorageError",
+    "JsonStorage",
+    "SqliteStorage",
+    "create_storage",
+]
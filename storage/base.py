@@ -0,0 +1,259 @@
+"""
+Базовый интерфейс хранилища данных пользователей
+"""
+
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional, Tuple
+
+
+class StorageError(Exception):
+    """Ошибка слоя хранения данных"""
+
+
+def apply_fsm_changes(current: Optional[dict], changes: dict, expires_at: float,
+                      now: float) -> Optional[dict]:
+    """
+    Новая запись FSM после изменения полей "state" и/или "data"
+    Устаревшая запись считается пустой; пустая запись (без состояния
+    и данных) не хранится - тогда возвращается None
+    """
+    if current is None or current["expires_at"] <= now:
+        current = {"state": None, "data": {}}
+    record = {
+        "state": changes.get("state", current["state"]),
+        "data": dict(changes.get("data", current["data"])),
+        "expires_at": expires_at
+    }
+    if record["state"] is None and not record["data"]:
+        return None
+    return record
+
+
+class Storage(ABC):
+    """
+    Абстрактный бэкенд хранилища
+
+    Каждая операция работает с данными одного пользователя
+    и не должна требовать чтения или записи всей базы
+    """
+
+    @abstractmethod
+    def get_card_number(self, chat_id: int) -> Optional[str]:
+        """Получает номер карты для указанного chat_id"""
+
+    @abstractmethod
+    def set_card_number(self, chat_id: int, card_number: str) -> None:
+        """Сохраняет номер карты, не затрагивая историю пользователя"""
+
+    @abstractmethod
+    def add_balance_history(self, chat_id: int, timestamp: int, balance: float) -> None:
+        """
+        Добавляет запись о балансе в историю пользователя
+        Повтор последнего баланса не записывается, старые записи
+        сворачиваются в агрегаты по политике хранения. Новая запись
+        учитывается в дневной статистике и сбрасывает кеш графиков
+        """
+
+    @abstractmethod
+    def get_balance_history(self, chat_id: int, since: Optional[int] = None,
+                            until: Optional[int] = None) -> list:
+        """Сырые записи истории [(timestamp, balance), ...] в интервале [since, until]"""
+
+    @abstractmethod
+    def get_balance_rollups(self, chat_id: int, level: str, since: Optional[int] = None,
+                            until: Optional[int] = None) -> list:
+        """
+        Агрегаты истории уровня "day" или "week":
+        [(start, min, max, last, count), ...]
+        """
+
+    @abstractmethod
+    def get_balance_stats(self, chat_id: int, since: Optional[int] = None) -> list:
+        """
+        Дневная статистика за последний год, начиная с дня since:
+        [(day, min, max, sum, count, spent), ...]
+        """
+
+    @abstractmethod
+    def get_chart_file_id(self, chat_id: int, range_key: str, day: int) -> Optional[str]:
+        """file_id графика за период, отрисованного в день day после последней записи истории"""
+
+    @abstractmethod
+    def set_chart_file_id(self, chat_id: int, range_key: str, day: int, file_id: str) -> None:
+        """Запоминает file_id отправленного графика"""
+
+    @abstractmethod
+    def delete_user(self, chat_id: int) -> None:
+        """Удаляет все данные пользователя"""
+
+    @abstractmethod
+    def mark_payment_received(self, chat_id: int, payment_date: str,
+                              timestamp: str, amount: float,
+                              notification: Optional[str] = None) -> None:
+        """
+        Отмечает выплату за указанный период
+        Если передан текст уведомления, оно ставится в очередь исходящих
+        в той же операции записи
+        """
+
+    @abstractmethod
+    def is_payment_received(self, chat_id: int, payment_date: str) -> bool:
+        """Проверяет, была ли получена выплата за указанный период"""
+
+    @abstractmethod
+    def get_all_users(self) -> list:
+        """Возвращает список всех chat_id пользователей"""
+
+    @abstractmethod
+    def get_unpaid_cards(self, payment_date: str) -> list:
+        """
+        Возвращает пары (card_number, [chat_id, ...]): карты и те ее
+        пользователи, у которых еще нет выплаты за указанный период
+        """
+
+    @abstractmethod
+    def get_card_subscribers(self, card_number: str) -> list:
+        """Возвращает chat_id всех пользователей, привязавших карту"""
+
+    @abstractmethod
+    def set_balance_alert(self, chat_id: int, threshold: Optional[float]) -> None:
+        """
+        Подписывает пользователя на уведомления об изменении баланса
+        не меньше threshold (None - отписывает). Опорный баланс
+        существующей подписки сохраняется
+        """
+
+    @abstractmethod
+    def get_balance_alert(self, chat_id: int) -> Optional[dict]:
+        """Подписка пользователя {"threshold", "baseline"} или None"""
+
+    @abstractmethod
+    def get_alert_cards(self) -> list:
+        """
+        Карты с подписками: [(card_number, last_balance,
+        [(chat_id, threshold, baseline), ...]), ...]
+        last_balance и baseline - None, пока баланс еще не известен
+        """
+
+    @abstractmethod
+    def record_card_balance(self, card_number: str, balance: float, now: float,
+                            alerts: list = ()) -> None:
+        """
+        Сохраняет последний известный баланс карты
+        alerts - пары (chat_id, текст или None): подписке пользователя карты
+        ставится опорный баланс balance, а текст (если есть) - в очередь
+        исходящих в той же операции записи. Если баланс карты изменился,
+        в той же операции он добавляется в историю всех ее подписчиков
+        """
+
+    @abstractmethod
+    def record_user_balance(self, chat_id: int, card_number: str, timestamp: int,
+                            balance: float) -> None:
+        """
+        Баланс, который пользователь запросил сам, одной операцией записи:
+        запись в историю (add_balance_history), последний баланс карты и
+        опорный баланс подписки пользователя (record_card_balance)
+        """
+
+    @abstractmethod
+    def get_card_cursor(self, card_number: str) -> Optional[dict]:
+        """Возвращает курсор уже просмотренных транзакций карты"""
+
+    @abstractmethod
+    def set_card_cursor(self, card_number: str, cursor: dict) -> None:
+        """Сохраняет курсор просмотренных транзакций карты"""
+
+    @abstractmethod
+    def enqueue_notification(self, chat_id: int, text: str, now: float) -> None:
+        """Ставит сообщение пользователю в очередь исходящих"""
+
+    @abstractmethod
+    def claim_notifications(self, now: float, limit: int, visibility_timeout: float) -> list:
+        """
+        Забирает до limit сообщений, готовых к отправке
+        На visibility_timeout секунд они скрываются от других отправителей.
+        Возвращает [{"id", "chat_id", "text", "attempts"}, ...]
+        """
+
+    @abstractmethod
+    def mark_notification_sent(self, notification_id: int, now: float) -> None:
+        """Отмечает сообщение доставленным"""
+
+    @abstractmethod
+    def mark_notification_failed(self, notification_id: int, error: str,
+                                 retry_at: Optional[float]) -> None:
+        """
+        Записывает неудачную попытку отправки
+        retry_at - время следующей попытки, None - больше не пытаться
+        """
+
+    @abstractmethod
+    def prune_notifications(self, before: float) -> int:
+        """Удаляет доставленные и окончательно неотправленные сообщения старше before"""
+
+    @abstractmethod
+    def acquire_lease(self, name: str, owner: str, ttl: float, now: float) -> bool:
+        """
+        Захватывает или продлевает аренду name на ttl секунд (compare-and-set)
+        Удается, если аренда свободна, истекла или уже принадлежит owner
+        """
+
+    @abstractmethod
+    def release_lease(self, name: str, owner: str) -> None:
+        """Освобождает аренду, если она принадлежит owner"""
+
+    @abstractmethod
+    def list_leases(self, prefix: str) -> list:
+        """Аренды с именем на prefix: [(name, owner, expires_at), ...]"""
+
+    # Состояния FSM хранит только бэкенд, общий для всех процессов бота
+    # (SQLite); остальные их не поддерживают, и fsm_storage держит
+    # состояния в памяти
+
+    def _fsm_unsupported(self) -> StorageError:
+        return StorageError(
+            f"{type(self).__name__} does not support FSM storage; use DB_BACKEND=sqlite"
+        )
+
+    def get_fsm_record(self, key: str, now: float) -> Optional[dict]:
+        """
+        Запись FSM {"state", "data", "expires_at"} по ключу aiogram
+        или None, если ее нет или она устарела
+        """
+        raise self._fsm_unsupported()
+
+    def update_fsm_record(self, key: str, changes: dict, expires_at: float,
+                          now: float) -> Optional[dict]:
+        """
+        Меняет поля записи FSM (см. apply_fsm_changes) и продлевает ее до expires_at
+        Возвращает запись после изменения или None, если она удалена
+        """
+        raise self._fsm_unsupported()
+
+    def prune_fsm_records(self, now: float) -> int:
+        """Удаляет устаревшие записи FSM, возвращает их количество"""
+        raise self._fsm_unsupported()
+
+    @abstractmethod
+    def iter_users(self, batch_size: int = 500) -> Iterator[Tuple[int, dict]]:
+        """
+        Перебирает всех пользователей порциями по batch_size, не загружая
+        в память копию всей базы. Запись пользователя в формате экспорта:
+        {"card_number", "balance_history": {"t", "b"}, "balance_rollups", "payments"}
+        и, если пользователь подписан на изменения баланса, "balance_alert"
+        """
+
+    @abstractmethod
+    def import_user(self, chat_id: int, user_data: dict) -> None:
+        """Записывает пользователя целиком (в формате iter_users), заменяя прежнюю запись"""
+
+    @abstractmethod
+    def migrate_legacy_users(self) -> int:
+        """Переводит записи старого формата в текущий, возвращает их количество"""
+
+    @abstractmethod
+    def check_integrity(self) -> list:
+        """Проверка целостности самого хранилища: список найденных проблем"""
+
+    def close(self) -> None:
+        """Освобождает ресурсы бэкенда"""
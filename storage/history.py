@@ -0,0 +1,223 @@
+"""
+Компактная история балансов
+
+Сырые записи хранятся колонками: {"t": [epoch секунды], "b": [балансы]}.
+Записи старше окна хранения сворачиваются в агрегаты по дням, а дневные
+агрегаты старше своего окна - в агрегаты по неделям. Агрегат хранит
+начало интервала, минимум, максимум, последний баланс и число записей.
+
+Отдельно при каждой записи обновляется дневная статистика за последний
+год (минимум, максимум, сумма и число записей, сумма списаний), чтобы
+статистику за период не приходилось считать по всей истории.
+Границы дней и недель считаются в UTC
+"""
+
+import bisect
+import time
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional, Tuple
+
+DAY_SECONDS = 24 * 3600
+WEEK_SECONDS = 7 * DAY_SECONDS
+
+BUCKET_LEVELS = ("day", "week")
+BUCKET_FIELDS = ("t", "min", "max", "last", "n")
+STATS_FIELDS = ("t", "min", "max", "sum", "n", "spent")
+# Сколько дней дневной статистики хранится
+STATS_DAYS = 366
+
+# Агрегат: (начало, минимум, максимум, последний баланс, число записей)
+Bucket = Tuple[int, float, float, float, int]
+# Дневная статистика: (начало дня, минимум, максимум, сумма, число записей, списания)
+StatsBucket = Tuple[int, float, float, float, int, float]
+
+
+def day_start(ts: int) -> int:
+    return ts - ts % DAY_SECONDS
+
+
+def week_start(ts: int) -> int:
+    # 1970-01-01 был четвергом, сдвигаем границу недели на понедельник
+    return ts - (ts - 4 * DAY_SECONDS) % WEEK_SECONDS
+
+
+def empty_history() -> dict:
+    return {"t": [], "b": []}
+
+
+def empty_rollups() -> dict:
+    return {level: {field: [] for field in BUCKET_FIELDS} for level in BUCKET_LEVELS}
+
+
+def empty_stats() -> dict:
+    return {field: [] for field in STATS_FIELDS}
+
+
+def parse_legacy_date(value: str) -> int:
+    """Переводит дату старого формата "YYYY-MM-DD HH:MM:SS" (локальное время) в epoch"""
+    return int(time.mktime(datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timetuple()))
+
+
+def normalize_history(raw) -> dict:
+    """
+    Приводит историю к колоночному формату
+    Старый формат - список словарей {"date": ..., "balance": ...}
+    """
+    if isinstance(raw, dict) and "t" in raw and "b" in raw:
+        return raw
+
+    history = empty_history()
+    if isinstance(raw, list):
+        for entry in raw:
+            try:
+                ts = parse_legacy_date(entry["date"])
+                balance = float(entry["balance"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            append_balance(history, ts, balance)
+    return history
+
+
+def append_balance(history: dict, ts: int, balance: float) -> bool:
+    """
+    Добавляет запись, если баланс изменился с прошлой записи
+    Возвращает True, если запись добавлена
+    """
+    if history["b"] and history["b"][-1] == balance:
+        return False
+    if history["t"] and ts < history["t"][-1]:
+        # Часы откатились назад: сохраняем порядок по времени
+        ts = history["t"][-1]
+    history["t"].append(ts)
+    history["b"].append(balance)
+    return True
+
+
+def rollup(items: Iterable[Bucket], bucket_fn: Callable[[int], int]) -> List[Bucket]:
+    """Сворачивает упорядоченные по времени агрегаты (или точки) в более крупные интервалы"""
+    result: List[Bucket] = []
+    for start, low, high, last, count in items:
+        bucket = bucket_fn(start)
+        if result and result[-1][0] == bucket:
+            _, r_low, r_high, _, r_count = result[-1]
+            result[-1] = (bucket, min(r_low, low), max(r_high, high), last, r_count + count)
+        else:
+            result.append((bucket, low, high, last, count))
+    return result
+
+
+def points_as_buckets(points: Iterable[Tuple[int, float]]) -> Iterable[Bucket]:
+    for ts, balance in points:
+        yield (ts, balance, balance, balance, 1)
+
+
+def merge_bucket(existing: Bucket, new: Bucket) -> Bucket:
+    """Объединяет два агрегата одного интервала (new - более поздний)"""
+    return (
+        existing[0],
+        min(existing[1], new[1]),
+        max(existing[2], new[2]),
+        new[3],
+        existing[4] + new[4]
+    )
+
+
+def iter_buckets(columns: dict) -> Iterable[Bucket]:
+    return zip(*(columns[field] for field in BUCKET_FIELDS))
+
+
+def _add_buckets(columns: dict, buckets: List[Bucket]) -> None:
+    """Добавляет агрегаты в колонки, объединяя совпадающие интервалы"""
+    for bucket in buckets:
+        starts = columns["t"]
+        index = bisect.bisect_left(starts, bucket[0])
+        if index < len(starts) and starts[index] == bucket[0]:
+            merged = merge_bucket(tuple(columns[f][index] for f in BUCKET_FIELDS), bucket)
+            for field, value in zip(BUCKET_FIELDS, merged):
+                columns[field][index] = value
+        else:
+            for field, value in zip(BUCKET_FIELDS, bucket):
+                columns[field].insert(index, value)
+
+
+def _cut_before(columns: dict, fields: Tuple[str, ...], cutoff: int) -> list:
+    """Удаляет из колонок записи раньше cutoff и возвращает их строками"""
+    index = bisect.bisect_left(columns["t"], cutoff)
+    if index == 0:
+        return []
+    removed = list(zip(*(columns[field][:index] for field in fields)))
+    for field in fields:
+        del columns[field][:index]
+    return removed
+
+
+def compact(history: dict, rollups: dict, now: int, raw_days: int, daily_days: int) -> bool:
+    """
+    Применяет политику хранения
+    Возвращает True, если что-то было свернуто
+    """
+    changed = False
+
+    raw_cutoff = day_start(now - raw_days * DAY_SECONDS)
+    old_points = _cut_before(history, ("t", "b"), raw_cutoff)
+    if old_points:
+        _add_buckets(rollups["day"], rollup(points_as_buckets(old_points), day_start))
+        changed = True
+
+    daily_cutoff = week_start(now - daily_days * DAY_SECONDS)
+    old_days = _cut_before(rollups["day"], BUCKET_FIELDS, daily_cutoff)
+    if old_days:
+        _add_buckets(rollups["week"], rollup(old_days, week_start))
+        changed = True
+
+    return changed
+
+
+def add_stat(stats: dict, ts: int, balance: float, previous: Optional[float]) -> None:
+    """
+    Учитывает новую запись истории в дневной статистике
+    previous - предыдущий баланс: его уменьшение считается списанием
+    """
+    day = day_start(ts)
+    spent = max(previous - balance, 0.0) if previous is not None else 0.0
+    if stats["t"] and stats["t"][-1] == day:
+        stats["min"][-1] = min(stats["min"][-1], balance)
+        stats["max"][-1] = max(stats["max"][-1], balance)
+        stats["sum"][-1] += balance
+        stats["n"][-1] += 1
+        stats["spent"][-1] += spent
+    else:
+        for field, value in zip(STATS_FIELDS, (day, balance, balance, balance, 1, spent)):
+            stats[field].append(value)
+
+
+def trim_stats(stats: dict, now: int) -> bool:
+    """Удаляет статистику старше STATS_DAYS, возвращает True, если что-то удалено"""
+    return bool(_cut_before(stats, STATS_FIELDS, day_start(now - STATS_DAYS * DAY_SECONDS)))
+
+
+def stats_from_history(history: dict) -> dict:
+    """Дневная статистика по сырой истории (для записей, созданных до ее появления)"""
+    stats = empty_stats()
+    previous = None
+    for ts, balance in zip(history["t"], history["b"]):
+        add_stat(stats, ts, balance, previous)
+        previous = balance
+    return stats
+
+
+def select_range(history: dict, since: Optional[int] = None, until: Optional[int] = None) -> list:
+    """Сырые записи (ts, balance) в интервале [since, until]"""
+    starts = history["t"]
+    lo = 0 if since is None else bisect.bisect_left(starts, since)
+    hi = len(starts) if until is None else bisect.bisect_right(starts, until)
+    return list(zip(starts[lo:hi], history["b"][lo:hi]))
+
+
+def select_buckets(columns: dict, since: Optional[int] = None, until: Optional[int] = None,
+                   fields: Tuple[str, ...] = BUCKET_FIELDS) -> list:
+    """Агрегаты (или дневная статистика), интервал которых начинается в [since, until]"""
+    starts = columns["t"]
+    lo = 0 if since is None else bisect.bisect_left(starts, since)
+    hi = len(starts) if until is None else bisect.bisect_right(starts, until)
+    return list(zip(*(columns[field][lo:hi] for field in fields)))
@@ -0,0 +1,727 @@
+"""
+Хранилище в JSON файле (формат cards_db.json)
+
+Файл пишется компактным JSON (кодек из codec: orjson, если установлен).
+Ключи верхнего уровня - chat_id пользователей; служебные разделы
+начинаются с "_": "_cards" хранит данные, относящиеся к карте,
+а не к пользователю, "_outbox" - очередь исходящих сообщений.
+Состояния диалогов aiogram в JSON базе не хранятся (см. fsm_storage).
+Обратный индекс карта -> chat_id строится в памяти при открытии
+
+База целиком держится в памяти процесса, изменения помечают ее "грязной",
+а фоновый поток объединяет их в одну атомарную запись на диск.
+Поэтому с файлом может работать только один процесс: два процесса
+перезаписывали бы изменения друг друга целиком. Второй процесс (реплика
+бота с шардами проверки или admin.py при запущенном боте) не откроет базу
+из-за блокировки <DB_FILE>.lock; для нескольких процессов нужен SQLite.
+Аренды шардов хранятся в файле <DB_FILE>.leases
+"""
+
+import copy
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка базы и аренды работают только внутри процесса
+    fcntl = None
+
+import codec
+from storage.base import Storage, StorageError
+from storage import history
+
+CARDS_KEY = "_cards"
+OUTBOX_KEY = "_outbox"
+# Поля записи пользователя, которые восстанавливаются сами и не экспортируются
+DERIVED_FIELDS = ("balance_stats", "chart_cache")
+
+# Как часто сворачивается история всех пользователей, а не только тех, кто пишет
+COMPACT_INTERVAL_SECONDS = 24 * 3600
+
+logger = logging.getLogger(__name__)
+
+
+def is_reserved_key(key: str) -> bool:
+    """Служебный раздел базы, а не запись пользователя"""
+    return key.startswith("_")
+
+
+def is_legacy_user(user_data) -> bool:
+    """
+    Запись старого формата: просто номер карты строкой
+    или история балансов списком словарей
+    """
+    if isinstance(user_data, str):
+        return True
+    return isinstance(user_data, dict) and isinstance(user_data.get("balance_history"), list)
+
+
+def normalize_user(user_data) -> Optional[dict]:
+    """Приводит запись пользователя к текущему формату"""
+    if isinstance(user_data, str):
+        return {
+            "card_number": user_data,
+            "balance_history": history.empty_history()
+        }
+    if isinstance(user_data, dict):
+        user_data["balance_history"] = history.normalize_history(user_data.get("balance_history"))
+        return user_data
+    return None
+
+
+def card_of(user_data) -> Optional[str]:
+    """Номер карты из записи пользователя любого формата"""
+    if isinstance(user_data, str):
+        return user_data
+    if isinstance(user_data, dict):
+        return user_data.get("card_number")
+    return None
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """
+    Записывает файл атомарно: временный файл, fsync и rename
+    При падении посреди записи на диске остается предыдущая версия
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    # fsync каталога, чтобы сам rename пережил сбой питания
+    try:
+        dir_fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+class JsonStorage(Storage):
+    """Бэкенд, хранящий всю базу в одном JSON файле с кешем в памяти"""
+
+    def __init__(self, path: str, flush_interval: float = 5.0, flush_max_dirty: int = 100,
+                 history_raw_days: int = 30, history_daily_days: int = 365,
+                 migrate_legacy: bool = True, compact_on_open: bool = True):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_max_dirty = flush_max_dirty
+        self.history_raw_days = history_raw_days
+        self.history_daily_days = history_daily_days
+
+        self._lock = threading.RLock()
+        self._write_lock = threading.Lock()
+        self._leases_lock = threading.Lock()
+        self._process_lock = self._lock_database()
+        try:
+            self._db = self.load_db()
+        except BaseException:
+            self._process_lock.close()
+            raise
+        self._dirty = 0
+        # Обратный индекс: номер карты -> chat_id пользователей с этой картой
+        self._subscribers: Dict[str, Set[str]] = {}
+        for chat_id, user_data in self._iter_users():
+            self._index_card(chat_id, None, card_of(user_data))
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+        # Записи старого формата переводятся один раз при открытии одной записью
+        # на диск, а не по одной во время запросов пользователей
+        if migrate_legacy:
+            migrated = self.migrate_legacy_users()
+            if migrated:
+                logger.info("Migrated %d legacy user records", migrated)
+                self.flush()
+
+        # История тех, кто давно не запрашивал баланс, тоже не растет без предела.
+        # Без compact_on_open (admin.py) база при открытии не меняется, а
+        # сворачивание откладывается на COMPACT_INTERVAL_SECONDS
+        if compact_on_open:
+            self._next_compact = 0.0
+            self._compact_all()
+        else:
+            self._next_compact = time.time() + COMPACT_INTERVAL_SECONDS
+
+        if flush_interval > 0:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="json-storage-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def _lock_database(self):
+        """Эксклюзивная блокировка базы на все время работы процесса"""
+        lock_file = open(self.path + ".lock", "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                lock_file.close()
+                raise StorageError(
+                    f"Database {self.path} is already open in another process. The JSON backend "
+                    "supports a single bot process; use DB_BACKEND=sqlite to run several workers"
+                ) from e
+        return lock_file
+
+    def load_db(self) -> dict:
+        """Загружает базу данных из JSON файла"""
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, 'rb') as f:
+                return codec.loads(f.read())
+        except ValueError as e:
+            # Не начинаем с пустой базы: первая же запись затерла бы все данные
+            raise StorageError(f"Database file {self.path} is corrupted: {e}") from e
+
+    def flush(self) -> None:
+        """Записывает накопленные изменения на диск, если они есть"""
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = codec.dumps(self._db)
+                dirty = self._dirty
+                self._dirty = 0
+            try:
+                atomic_write(self.path, data)
+            except Exception:
+                with self._lock:
+                    self._dirty += dirty
+                raise
+
+    def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self._compact_all()
+                self.flush()
+            except Exception as e:
+                logger.error("Error flushing database: %s", e)
+
+    def _schedule_flush(self) -> None:
+        """Вызывается после изменения, вне блокировки данных"""
+        if self._flusher is None:
+            self.flush()
+        elif self._dirty >= self.flush_max_dirty:
+            self._wakeup.set()
+
+    def _iter_users(self):
+        """Перебирает пары (chat_id, запись) без служебных разделов"""
+        for chat_id, user_data in self._db.items():
+            if not is_reserved_key(chat_id):
+                yield chat_id, user_data
+
+    def _index_card(self, chat_id: str, old_card: Optional[str], new_card: Optional[str]) -> None:
+        """Переносит chat_id в обратном индексе со старой карты на новую"""
+        if old_card == new_card:
+            return
+        if old_card:
+            chat_ids = self._subscribers.get(old_card)
+            if chat_ids is not None:
+                chat_ids.discard(chat_id)
+                if not chat_ids:
+                    del self._subscribers[old_card]
+        if new_card:
+            self._subscribers.setdefault(new_card, set()).add(chat_id)
+
+    def _get_user(self, chat_id: int) -> Optional[dict]:
+        user_data = self._db.get(str(chat_id))
+        return user_data if isinstance(user_data, dict) else None
+
+    def get_card_number(self, chat_id: int) -> Optional[str]:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            return user_data.get("card_number") if user_data else None
+
+    def set_card_number(self, chat_id: int, card_number: str) -> None:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            if user_data is not None:
+                # Обновляем только номер карты, сохраняя историю
+                self._index_card(str(chat_id), user_data.get("card_number"), card_number)
+                if user_data.get("card_number") != card_number and "balance_alert" in user_data:
+                    # Опорный баланс относился к прежней карте
+                    user_data["balance_alert"]["baseline"] = None
+                user_data["card_number"] = card_number
+            else:
+                # Создаем новую запись
+                self._db[str(chat_id)] = {
+                    "card_number": card_number,
+                    "balance_history": history.empty_history()
+                }
+                self._index_card(str(chat_id), None, card_number)
+            self._dirty += 1
+        self._schedule_flush()
+
+    def add_balance_history(self, chat_id: int, timestamp: int, balance: float) -> None:
+        with self._lock:
+            if self._add_history(chat_id, timestamp, balance):
+                self._dirty += 1
+        self._schedule_flush()
+
+    def _add_history(self, chat_id: int, timestamp: int, balance: float) -> bool:
+        """Возвращает True, если запись пользователя изменилась"""
+        user_data = self._get_user(chat_id)
+        if user_data is None:
+            return False
+
+        changed = False
+        balance_history = user_data["balance_history"]
+        previous = balance_history["b"][-1] if balance_history["b"] else None
+        stats = self._stats(user_data)
+        if history.append_balance(balance_history, timestamp, balance):
+            history.add_stat(stats, balance_history["t"][-1], balance, previous)
+            history.trim_stats(stats, timestamp)
+            # Графики отрисованы по прежней истории
+            user_data.pop("chart_cache", None)
+            changed = True
+        if self._compact(user_data, timestamp):
+            changed = True
+        return changed
+
+    def _compact(self, user_data: dict, now: int) -> bool:
+        rollups = user_data.setdefault("balance_rollups", history.empty_rollups())
+        return history.compact(
+            user_data["balance_history"], rollups, now,
+            self.history_raw_days, self.history_daily_days
+        )
+
+    @staticmethod
+    def _stats(user_data: dict) -> dict:
+        """Дневная статистика; у записей, созданных до ее появления, строится по истории"""
+        stats = user_data.get("balance_stats")
+        if stats is None:
+            stats = user_data["balance_stats"] = history.stats_from_history(user_data["balance_history"])
+        return stats
+
+    def _compact_all(self) -> None:
+        """Раз в COMPACT_INTERVAL_SECONDS сворачивает старую историю всех пользователей"""
+        now = time.time()
+        if now < self._next_compact:
+            return
+        self._next_compact = now + COMPACT_INTERVAL_SECONDS
+        with self._lock:
+            compacted = 0
+            for _, user_data in self._iter_users():
+                # Записи старого формата сворачиваются после перевода
+                if isinstance(user_data, dict) and not is_legacy_user(user_data):
+                    if self._compact(user_data, int(now)):
+                        compacted += 1
+            if compacted:
+                self._dirty += 1
+        if compacted:
+            logger.info("Compacted balance history of %d users", compacted)
+
+    def get_balance_history(self, chat_id: int, since: Optional[int] = None,
+                            until: Optional[int] = None) -> list:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            return history.select_range(user_data["balance_history"], since, until) if user_data else []
+
+    def get_balance_rollups(self, chat_id: int, level: str, since: Optional[int] = None,
+                            until: Optional[int] = None) -> list:
+        with self._lock:
+            user_data = self._db.get(str(chat_id))
+            if not isinstance(user_data, dict) or "balance_rollups" not in user_data:
+                return []
+            return history.select_buckets(user_data["balance_rollups"][level], since, until)
+
+    def get_balance_stats(self, chat_id: int, since: Optional[int] = None) -> list:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            if user_data is None:
+                return []
+            return history.select_buckets(self._stats(user_data), since, fields=history.STATS_FIELDS)
+
+    def get_chart_file_id(self, chat_id: int, range_key: str, day: int) -> Optional[str]:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            chart = (user_data or {}).get("chart_cache", {}).get(range_key)
+            return chart["file_id"] if chart and chart["day"] == day else None
+
+    def set_chart_file_id(self, chat_id: int, range_key: str, day: int, file_id: str) -> None:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            if user_data is None:
+                return
+            user_data.setdefault("chart_cache", {})[range_key] = {"day": day, "file_id": file_id}
+            self._dirty += 1
+        self._schedule_flush()
+
+    def delete_user(self, chat_id: int) -> None:
+        with self._lock:
+            if str(chat_id) in self._db:
+                self._index_card(str(chat_id), card_of(self._db[str(chat_id)]), None)
+                del self._db[str(chat_id)]
+                self._dirty += 1
+        self._schedule_flush()
+
+    def mark_payment_received(self, chat_id: int, payment_date: str,
+                              timestamp: str, amount: float,
+                              notification: Optional[str] = None) -> None:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            if user_data is None:
+                return
+
+            user_data.setdefault("payments", {})[payment_date] = {
+                "received": True,
+                "timestamp": timestamp,
+                "amount": amount
+            }
+            if notification is not None:
+                self._enqueue(chat_id, notification, time.time())
+            self._dirty += 1
+        self._schedule_flush()
+
+    def _outbox(self) -> dict:
+        return self._db.setdefault(OUTBOX_KEY, {"next_id": 1, "items": {}})
+
+    def _enqueue(self, chat_id: int, text: str, now: float) -> None:
+        outbox = self._outbox()
+        notification_id = outbox["next_id"]
+        outbox["next_id"] += 1
+        outbox["items"][str(notification_id)] = {
+            "chat_id": chat_id,
+            "text": text,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+            "sent_at": None,
+            "error": None
+        }
+
+    def enqueue_notification(self, chat_id: int, text: str, now: float) -> None:
+        with self._lock:
+            self._enqueue(chat_id, text, now)
+            self._dirty += 1
+        self._schedule_flush()
+
+    def claim_notifications(self, now: float, limit: int, visibility_timeout: float) -> list:
+        with self._lock:
+            ready = sorted(
+                (
+                    (item["next_attempt_at"], int(notification_id), item)
+                    for notification_id, item in self._outbox()["items"].items()
+                    if item["status"] == "pending" and item["next_attempt_at"] <= now
+                ),
+                key=lambda entry: entry[:2]
+            )[:limit]
+            claimed = []
+            for _, notification_id, item in ready:
+                item["next_attempt_at"] = now + visibility_timeout
+                claimed.append({
+                    "id": notification_id,
+                    "chat_id": item["chat_id"],
+                    "text": item["text"],
+                    "attempts": item["attempts"]
+                })
+            if claimed:
+                self._dirty += 1
+        self._schedule_flush()
+        return claimed
+
+    def mark_notification_sent(self, notification_id: int, now: float) -> None:
+        with self._lock:
+            item = self._outbox()["items"].get(str(notification_id))
+            if item is None:
+                return
+            item["status"] = "sent"
+            item["attempts"] += 1
+            item["sent_at"] = now
+            item["error"] = None
+            self._dirty += 1
+        self._schedule_flush()
+
+    def mark_notification_failed(self, notification_id: int, error: str,
+                                 retry_at: Optional[float]) -> None:
+        with self._lock:
+            item = self._outbox()["items"].get(str(notification_id))
+            if item is None:
+                return
+            item["attempts"] += 1
+            item["error"] = error
+            if retry_at is None:
+                item["status"] = "failed"
+            else:
+                item["next_attempt_at"] = retry_at
+            self._dirty += 1
+        self._schedule_flush()
+
+    def prune_notifications(self, before: float) -> int:
+        with self._lock:
+            items = self._outbox()["items"]
+            stale = [
+                notification_id for notification_id, item in items.items()
+                if item["status"] != "pending" and item["created_at"] < before
+            ]
+            for notification_id in stale:
+                del items[notification_id]
+            if stale:
+                self._dirty += 1
+        self._schedule_flush()
+        return len(stale)
+
+    def is_payment_received(self, chat_id: int, payment_date: str) -> bool:
+        with self._lock:
+            user_data = self._db.get(str(chat_id))
+            if isinstance(user_data, dict):
+                payments = user_data.get("payments", {})
+                return payments.get(payment_date, {}).get("received", False)
+            return False
+
+    def get_all_users(self) -> list:
+        with self._lock:
+            return [chat_id for chat_id, _ in self._iter_users()]
+
+    def get_unpaid_cards(self, payment_date: str) -> list:
+        with self._lock:
+            result = []
+            for card_number, chat_ids in self._subscribers.items():
+                unpaid = []
+                for chat_id in sorted(chat_ids):
+                    user_data = self._db.get(chat_id)
+                    payments = user_data.get("payments", {}) if isinstance(user_data, dict) else {}
+                    if not payments.get(payment_date, {}).get("received", False):
+                        unpaid.append(chat_id)
+                if unpaid:
+                    result.append((card_number, unpaid))
+            return result
+
+    def get_card_subscribers(self, card_number: str) -> list:
+        with self._lock:
+            return sorted(self._subscribers.get(card_number, ()))
+
+    def set_balance_alert(self, chat_id: int, threshold: Optional[float]) -> None:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            if user_data is None:
+                return
+            if threshold is None:
+                if user_data.pop("balance_alert", None) is None:
+                    return
+            else:
+                alert = user_data.setdefault("balance_alert", {"baseline": None})
+                alert["threshold"] = threshold
+            self._dirty += 1
+        self._schedule_flush()
+
+    def get_balance_alert(self, chat_id: int) -> Optional[dict]:
+        with self._lock:
+            user_data = self._get_user(chat_id)
+            alert = user_data.get("balance_alert") if user_data else None
+            return dict(alert) if alert else None
+
+    def get_alert_cards(self) -> list:
+        with self._lock:
+            cards = self._db.get(CARDS_KEY, {})
+            result = []
+            for card_number, chat_ids in self._subscribers.items():
+                subscribers = []
+                for chat_id in sorted(chat_ids):
+                    user_data = self._db.get(chat_id)
+                    alert = user_data.get("balance_alert") if isinstance(user_data, dict) else None
+                    if alert:
+                        subscribers.append((chat_id, alert["threshold"], alert["baseline"]))
+                if subscribers:
+                    result.append((card_number, cards.get(card_number, {}).get("balance"), subscribers))
+            return result
+
+    def record_card_balance(self, card_number: str, balance: float, now: float,
+                            alerts: list = ()) -> None:
+        with self._lock:
+            previous = self._db.get(CARDS_KEY, {}).get(card_number, {}).get("balance")
+            changed = self._record_card_balance(card_number, balance, now, alerts)
+            if previous != balance:
+                for chat_id in sorted(self._subscribers.get(card_number, ())):
+                    user_data = self._db.get(chat_id)
+                    if isinstance(user_data, dict) and user_data.get("balance_alert"):
+                        if self._add_history(int(chat_id), int(now), balance):
+                            changed = True
+            if changed:
+                self._dirty += 1
+        self._schedule_flush()
+
+    def _record_card_balance(self, card_number: str, balance: float, now: float,
+                             alerts: list) -> bool:
+        """Возвращает True, если изменился баланс карты, опорный баланс или очередь"""
+        card_data = self._db.setdefault(CARDS_KEY, {}).setdefault(card_number, {})
+        # Время проверки без смены баланса не стоит записи файла
+        changed = card_data.get("balance") != balance
+        card_data["balance"] = balance
+        card_data["balance_at"] = now
+        for chat_id, text in alerts:
+            user_data = self._get_user(chat_id)
+            if not user_data or user_data.get("card_number") != card_number:
+                continue
+            alert = user_data.get("balance_alert")
+            if alert is None:
+                continue
+            if alert["baseline"] != balance:
+                alert["baseline"] = balance
+                changed = True
+            if text is not None:
+                self._enqueue(int(chat_id), text, now)
+                changed = True
+        return changed
+
+    def record_user_balance(self, chat_id: int, card_number: str, timestamp: int,
+                            balance: float) -> None:
+        with self._lock:
+            changed = self._add_history(chat_id, timestamp, balance)
+            if self._record_card_balance(card_number, balance, timestamp, [(str(chat_id), None)]):
+                changed = True
+            if changed:
+                self._dirty += 1
+        self._schedule_flush()
+
+    def get_card_cursor(self, card_number: str) -> Optional[dict]:
+        with self._lock:
+            card_data = self._db.get(CARDS_KEY, {}).get(card_number, {})
+            cursor = card_data.get("cursor")
+            return dict(cursor) if cursor else None
+
+    def set_card_cursor(self, card_number: str, cursor: dict) -> None:
+        with self._lock:
+            cards = self._db.setdefault(CARDS_KEY, {})
+            cards.setdefault(card_number, {})["cursor"] = cursor
+            self._dirty += 1
+        self._schedule_flush()
+
+    @contextmanager
+    def _leases_file(self):
+        """Открывает файл аренд под эксклюзивной блокировкой и сохраняет изменения"""
+        with self._leases_lock, open(self.path + ".leases", "a+", encoding="utf-8") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                leases = json.loads(content) if content.strip() else {}
+                before = dict(leases)
+                yield leases
+                if leases != before:
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(leases, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def acquire_lease(self, name: str, owner: str, ttl: float, now: float) -> bool:
+        with self._leases_file() as leases:
+            current = leases.get(name)
+            if current and current["owner"] != owner and current["expires_at"] >= now:
+                return False
+            leases[name] = {"owner": owner, "expires_at": now + ttl}
+            return True
+
+    def release_lease(self, name: str, owner: str) -> None:
+        with self._leases_file() as leases:
+            if leases.get(name, {}).get("owner") == owner:
+                del leases[name]
+
+    def list_leases(self, prefix: str) -> list:
+        with self._leases_file() as leases:
+            return sorted(
+                (name, lease["owner"], lease["expires_at"])
+                for name, lease in leases.items() if name.startswith(prefix)
+            )
+
+    def iter_users(self, batch_size: int = 500):
+        with self._lock:
+            chat_ids = [chat_id for chat_id, _ in self._iter_users()]
+
+        for offset in range(0, len(chat_ids), batch_size):
+            # Копии порции делаются под блокировкой, отдаются без нее
+            batch = []
+            with self._lock:
+                for chat_id in chat_ids[offset:offset + batch_size]:
+                    user_data = self._db.get(chat_id)
+                    if user_data is None:
+                        continue
+                    user_data = normalize_user(copy.deepcopy(user_data))
+                    if user_data is not None:
+                        # Статистика строится по истории, а file_id годны только для этого бота
+                        for derived in DERIVED_FIELDS:
+                            user_data.pop(derived, None)
+                        user_data.setdefault("balance_rollups", history.empty_rollups())
+                        user_data.setdefault("payments", {})
+                        batch.append((int(chat_id), user_data))
+            yield from batch
+
+    def import_user(self, chat_id: int, user_data: dict) -> None:
+        user_data = normalize_user(copy.deepcopy(user_data))
+        if user_data is None:
+            raise StorageError(f"Malformed user record for {chat_id}")
+        for derived in DERIVED_FIELDS:
+            user_data.pop(derived, None)
+        user_data.setdefault("balance_rollups", history.empty_rollups())
+        user_data.setdefault("payments", {})
+        with self._lock:
+            self._index_card(str(chat_id), card_of(self._db.get(str(chat_id))), card_of(user_data))
+            self._db[str(chat_id)] = user_data
+            self._dirty += 1
+        self._schedule_flush()
+
+    def migrate_legacy_users(self) -> int:
+        with self._lock:
+            migrated = 0
+            for chat_id, user_data in list(self._iter_users()):
+                if is_legacy_user(user_data):
+                    self._db[chat_id] = normalize_user(user_data)
+                    self._compact(self._db[chat_id], int(time.time()))
+                    migrated += 1
+            if migrated:
+                self._dirty += 1
+        return migrated
+
+    def check_integrity(self) -> list:
+        # Файл уже разобран при открытии; проверяем только служебные разделы
+        problems = []
+        with self._lock:
+            for key in (CARDS_KEY, OUTBOX_KEY):
+                if key in self._db and not isinstance(self._db[key], dict):
+                    problems.append(f"{key}: expected an object")
+        return problems
+
+    def close(self) -> None:
+        """Останавливает фоновую запись и сохраняет последние изменения"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        try:
+            self.flush()
+        finally:
+            # Закрытие файла снимает блокировку базы
+            self._process_lock.close()
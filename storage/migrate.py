@@ -0,0 +1,60 @@
+"""
+Одноразовый перенос базы из cards_db.json в SQLite
+
+Запуск: python -m storage.migrate [путь_к_json] [путь_к_sqlite]
+"""
+
+import sys
+
+import codec
+from storage.json_backend import CARDS_KEY, OUTBOX_KEY, is_reserved_key, normalize_user
+from storage.sqlite_backend import SqliteStorage
+
+
+def migrate_json_to_sqlite(json_path: str, sqlite_path: str) -> int:
+    """
+    Переносит всех пользователей из JSON файла в SQLite
+    Записи старого формата (просто номер карты) переносятся как новые
+    Возвращает количество перенесенных пользователей
+    """
+    with open(json_path, 'rb') as f:
+        db = codec.loads(f.read())
+
+    target = SqliteStorage(sqlite_path)
+    migrated = 0
+    try:
+        for card_number, card_data in db.get(CARDS_KEY, {}).items():
+            if card_data.get("cursor"):
+                target.set_card_cursor(card_number, card_data["cursor"])
+            if card_data.get("balance") is not None:
+                target.record_card_balance(
+                    card_number, card_data["balance"], card_data.get("balance_at", 0.0)
+                )
+
+        # Переносим только еще не отправленные сообщения
+        for item in db.get(OUTBOX_KEY, {}).get("items", {}).values():
+            if item.get("status") == "pending":
+                target.enqueue_notification(item["chat_id"], item["text"], item["created_at"])
+
+        for chat_id, raw_user in db.items():
+            if is_reserved_key(chat_id):
+                continue
+            user_data = normalize_user(raw_user)
+            if user_data is None:
+                print(f"Skipping malformed record for {chat_id}")
+                continue
+            target.import_user(int(chat_id), user_data)
+            migrated += 1
+    finally:
+        target.close()
+
+    return migrated
+
+
+if __name__ == "__main__":
+    from config import DB_FILE, SQLITE_DB_FILE
+
+    source = sys.argv[1] if len(sys.argv) > 1 else DB_FILE
+    destination = sys.argv[2] if len(sys.argv) > 2 else SQLITE_DB_FILE
+    count = migrate_json_to_sqlite(source, destination)
+    print(f"Migrated {count} users from {source} to {destination}")
@@ -0,0 +1,704 @@
+"""
+Хранилище в SQLite (режим WAL, отдельная таблица на каждую сущность)
+"""
+
+import itertools
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from storage.base import Storage, apply_fsm_changes
+from storage import history
+
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    chat_id     INTEGER PRIMARY KEY,
+    card_number TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_card_number ON users(card_number);
+
+CREATE TABLE IF NOT EXISTS balance_history (
+    chat_id INTEGER NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
+    ts      INTEGER NOT NULL,
+    balance REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_balance_history_chat_ts ON balance_history(chat_id, ts);
+
+CREATE TABLE IF NOT EXISTS balance_rollups (
+    chat_id INTEGER NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
+    level   TEXT NOT NULL,
+    start   INTEGER NOT NULL,
+    min     REAL NOT NULL,
+    max     REAL NOT NULL,
+    last    REAL NOT NULL,
+    n       INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, level, start)
+);
+
+CREATE TABLE IF NOT EXISTS balance_stats (
+    chat_id INTEGER NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
+    day     INTEGER NOT NULL,
+    min     REAL NOT NULL,
+    max     REAL NOT NULL,
+    sum     REAL NOT NULL,
+    n       INTEGER NOT NULL,
+    spent   REAL NOT NULL,
+    PRIMARY KEY (chat_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS chart_cache (
+    chat_id   INTEGER NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
+    range_key TEXT NOT NULL,
+    day       INTEGER NOT NULL,
+    file_id   TEXT NOT NULL,
+    PRIMARY KEY (chat_id, range_key)
+);
+
+CREATE TABLE IF NOT EXISTS payments (
+    chat_id      INTEGER NOT NULL REFERENCES users(chat_id) ON DELETE CASCADE,
+    payment_date TEXT NOT NULL,
+    received     INTEGER NOT NULL DEFAULT 1,
+    timestamp    TEXT,
+    amount       REAL,
+    PRIMARY KEY (chat_id, payment_date)
+);
+CREATE INDEX IF NOT EXISTS idx_payments_payment_date ON payments(payment_date, chat_id);
+
+CREATE TABLE IF NOT EXISTS cards (
+    card_number TEXT PRIMARY KEY,
+    cursor      TEXT
+);
+
+CREATE TABLE IF NOT EXISTS card_balances (
+    card_number TEXT PRIMARY KEY,
+    balance     REAL NOT NULL,
+    updated_at  REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS balance_alerts (
+    chat_id   INTEGER PRIMARY KEY REFERENCES users(chat_id) ON DELETE CASCADE,
+    threshold REAL NOT NULL,
+    baseline  REAL
+);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    id              INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id         INTEGER NOT NULL,
+    text            TEXT NOT NULL,
+    status          TEXT NOT NULL DEFAULT 'pending',
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at      REAL NOT NULL,
+    sent_at         REAL,
+    error           TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_notifications_pending ON notifications(status, next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS fsm_states (
+    key        TEXT PRIMARY KEY,
+    state      TEXT,
+    data       TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states(expires_at);
+
+CREATE TABLE IF NOT EXISTS leases (
+    name       TEXT PRIMARY KEY,
+    owner      TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class SqliteStorage(Storage):
+    """Бэкенд на SQLite: каждая операция затрагивает только строки одного пользователя"""
+
+    def __init__(self, path: str, history_raw_days: int = 30, history_daily_days: int = 365):
+        self.path = path
+        self.history_raw_days = history_raw_days
+        self.history_daily_days = history_daily_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        self._migrate_schema(version)
+        self._conn.executescript(SCHEMA)
+        self._copy_legacy_history()
+        if version < 3:
+            self._fill_balance_stats()
+        self._conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+    def _migrate_schema(self, version: int) -> None:
+        """Готовит базу, созданную предыдущими версиями схемы, к созданию новых таблиц"""
+        if version >= 2:
+            return
+
+        # v1: история хранила дату строкой "YYYY-MM-DD HH:MM:SS"
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(balance_history)")]
+        if "date" in columns:
+            self._conn.execute("ALTER TABLE balance_history RENAME TO balance_history_v1")
+
+    def _copy_legacy_history(self) -> None:
+        """Переносит историю из таблицы v1 в новый формат"""
+        legacy = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'balance_history_v1'"
+        ).fetchone()
+        if legacy is None:
+            return
+
+        rows = self._conn.execute(
+            "SELECT chat_id, date, balance FROM balance_history_v1 ORDER BY id"
+        ).fetchall()
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO balance_history (chat_id, ts, balance) VALUES (?, ?, ?)",
+                [(chat_id, history.parse_legacy_date(date), balance) for chat_id, date, balance in rows]
+            )
+            conn.execute("DROP TABLE balance_history_v1")
+
+    def _fill_balance_stats(self) -> None:
+        """v3: дневная статистика по уже накопленной сырой истории"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO balance_stats (chat_id, day, min, max, sum, n, spent) "
+                "SELECT chat_id, ts - ts % ?, MIN(balance), MAX(balance), SUM(balance), COUNT(*), "
+                "       TOTAL(MAX(previous - balance, 0)) "
+                "FROM ("
+                "    SELECT chat_id, ts, balance, LAG(balance) OVER ("
+                "        PARTITION BY chat_id ORDER BY ts, rowid"
+                "    ) AS previous FROM balance_history"
+                ") GROUP BY chat_id, ts - ts % ?",
+                (history.DAY_SECONDS, history.DAY_SECONDS)
+            )
+
+    @contextmanager
+    def _transaction(self):
+        """Блокировка соединения и транзакция на запись"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def _fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get_card_number(self, chat_id: int) -> Optional[str]:
+        row = self._fetchone("SELECT card_number FROM users WHERE chat_id = ?", (chat_id,))
+        return row[0] if row else None
+
+    def set_card_number(self, chat_id: int, card_number: str) -> None:
+        with self._transaction() as conn:
+            # Опорный баланс подписки относился к прежней карте
+            conn.execute(
+                "UPDATE balance_alerts SET baseline = NULL WHERE chat_id = ? AND EXISTS ("
+                "    SELECT 1 FROM users WHERE chat_id = ? AND card_number IS NOT ?"
+                ")",
+                (chat_id, chat_id, card_number)
+            )
+            conn.execute(
+                "INSERT INTO users (chat_id, card_number) VALUES (?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET card_number = excluded.card_number",
+                (chat_id, card_number)
+            )
+
+    def add_balance_history(self, chat_id: int, timestamp: int, balance: float) -> None:
+        with self._transaction() as conn:
+            self._add_history(conn, chat_id, timestamp, balance)
+
+    def _add_history(self, conn: sqlite3.Connection, chat_id: int, timestamp: int,
+                     balance: float) -> None:
+        if conn.execute("SELECT 1 FROM users WHERE chat_id = ?", (chat_id,)).fetchone() is None:
+            return
+
+        last = conn.execute(
+            "SELECT ts, balance FROM balance_history WHERE chat_id = ? "
+            "ORDER BY ts DESC, rowid DESC LIMIT 1",
+            (chat_id,)
+        ).fetchone()
+        if last is None or last[1] != balance:
+            ts = max(timestamp, last[0]) if last else timestamp
+            conn.execute(
+                "INSERT INTO balance_history (chat_id, ts, balance) VALUES (?, ?, ?)",
+                (chat_id, ts, balance)
+            )
+            self._add_stat(conn, chat_id, ts, balance, last[1] if last else None)
+            # Графики отрисованы по прежней истории
+            conn.execute("DELETE FROM chart_cache WHERE chat_id = ?", (chat_id,))
+        self._compact(conn, chat_id, timestamp)
+
+    @staticmethod
+    def _add_stat(conn: sqlite3.Connection, chat_id: int, ts: int, balance: float,
+                  previous: Optional[float]) -> None:
+        """Учитывает запись в дневной статистике (см. history.add_stat)"""
+        spent = max(previous - balance, 0.0) if previous is not None else 0.0
+        conn.execute(
+            "INSERT INTO balance_stats (chat_id, day, min, max, sum, n, spent) "
+            "VALUES (?, ?, ?, ?, ?, 1, ?) "
+            "ON CONFLICT(chat_id, day) DO UPDATE SET "
+            "min = MIN(min, excluded.min), max = MAX(max, excluded.max), "
+            "sum = sum + excluded.sum, n = n + 1, spent = spent + excluded.spent",
+            (chat_id, history.day_start(ts), balance, balance, balance, spent)
+        )
+        conn.execute(
+            "DELETE FROM balance_stats WHERE chat_id = ? AND day < ?",
+            (chat_id, history.day_start(ts - history.STATS_DAYS * history.DAY_SECONDS))
+        )
+
+    def _compact(self, conn: sqlite3.Connection, chat_id: int, now: int) -> None:
+        """Сворачивает старые записи пользователя в агрегаты по дням и неделям"""
+        raw_cutoff = history.day_start(now - self.history_raw_days * history.DAY_SECONDS)
+        rows = conn.execute(
+            "SELECT ts, balance FROM balance_history WHERE chat_id = ? AND ts < ? ORDER BY ts, rowid",
+            (chat_id, raw_cutoff)
+        ).fetchall()
+        if rows:
+            self._upsert_buckets(
+                conn, chat_id, "day",
+                history.rollup(history.points_as_buckets(rows), history.day_start)
+            )
+            conn.execute(
+                "DELETE FROM balance_history WHERE chat_id = ? AND ts < ?", (chat_id, raw_cutoff)
+            )
+
+        daily_cutoff = history.week_start(now - self.history_daily_days * history.DAY_SECONDS)
+        days = conn.execute(
+            "SELECT start, min, max, last, n FROM balance_rollups "
+            "WHERE chat_id = ? AND level = 'day' AND start < ? ORDER BY start",
+            (chat_id, daily_cutoff)
+        ).fetchall()
+        if days:
+            self._upsert_buckets(conn, chat_id, "week", history.rollup(days, history.week_start))
+            conn.execute(
+                "DELETE FROM balance_rollups WHERE chat_id = ? AND level = 'day' AND start < ?",
+                (chat_id, daily_cutoff)
+            )
+
+    @staticmethod
+    def _upsert_buckets(conn: sqlite3.Connection, chat_id: int, level: str, buckets: list) -> None:
+        conn.executemany(
+            "INSERT INTO balance_rollups (chat_id, level, start, min, max, last, n) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id, level, start) DO UPDATE SET "
+            "min = MIN(min, excluded.min), max = MAX(max, excluded.max), "
+            "last = excluded.last, n = n + excluded.n",
+            [(chat_id, level) + tuple(bucket) for bucket in buckets]
+        )
+
+    def get_balance_history(self, chat_id: int, since: Optional[int] = None,
+                            until: Optional[int] = None) -> list:
+        rows = self._fetchall(
+            "SELECT ts, balance FROM balance_history WHERE chat_id = ? "
+            "AND ts >= COALESCE(?, ts) AND ts <= COALESCE(?, ts) ORDER BY ts, rowid",
+            (chat_id, since, until)
+        )
+        return [tuple(row) for row in rows]
+
+    def get_balance_rollups(self, chat_id: int, level: str, since: Optional[int] = None,
+                            until: Optional[int] = None) -> list:
+        rows = self._fetchall(
+            "SELECT start, min, max, last, n FROM balance_rollups WHERE chat_id = ? AND level = ? "
+            "AND start >= COALESCE(?, start) AND start <= COALESCE(?, start) ORDER BY start",
+            (chat_id, level, since, until)
+        )
+        return [tuple(row) for row in rows]
+
+    def get_balance_stats(self, chat_id: int, since: Optional[int] = None) -> list:
+        rows = self._fetchall(
+            "SELECT day, min, max, sum, n, spent FROM balance_stats WHERE chat_id = ? "
+            "AND day >= COALESCE(?, day) ORDER BY day",
+            (chat_id, since)
+        )
+        return [tuple(row) for row in rows]
+
+    def get_chart_file_id(self, chat_id: int, range_key: str, day: int) -> Optional[str]:
+        row = self._fetchone(
+            "SELECT file_id FROM chart_cache WHERE chat_id = ? AND range_key = ? AND day = ?",
+            (chat_id, range_key, day)
+        )
+        return row[0] if row else None
+
+    def set_chart_file_id(self, chat_id: int, range_key: str, day: int, file_id: str) -> None:
+        # Пользователь мог быть удален, пока график отправлялся
+        self._execute(
+            "INSERT INTO chart_cache (chat_id, range_key, day, file_id) "
+            "SELECT chat_id, ?, ?, ? FROM users WHERE chat_id = ? "
+            "ON CONFLICT(chat_id, range_key) DO UPDATE SET "
+            "day = excluded.day, file_id = excluded.file_id",
+            (range_key, day, file_id, chat_id)
+        )
+
+    def delete_user(self, chat_id: int) -> None:
+        self._execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
+
+    def mark_payment_received(self, chat_id: int, payment_date: str,
+                              timestamp: str, amount: float,
+                              notification: Optional[str] = None) -> None:
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR REPLACE INTO payments (chat_id, payment_date, received, timestamp, amount) "
+                "SELECT chat_id, ?, 1, ?, ? FROM users WHERE chat_id = ?",
+                (payment_date, timestamp, amount, chat_id)
+            )
+            if notification is not None and cursor.rowcount:
+                self._enqueue(conn, chat_id, notification, time.time())
+
+    @staticmethod
+    def _enqueue(conn: sqlite3.Connection, chat_id: int, text: str, now: float) -> None:
+        conn.execute(
+            "INSERT INTO notifications (chat_id, text, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+            (chat_id, text, now, now)
+        )
+
+    def enqueue_notification(self, chat_id: int, text: str, now: float) -> None:
+        with self._transaction() as conn:
+            self._enqueue(conn, chat_id, text, now)
+
+    def claim_notifications(self, now: float, limit: int, visibility_timeout: float) -> list:
+        # Захват одним UPDATE: другой процесс не заберет те же сообщения
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "UPDATE notifications SET next_attempt_at = ? WHERE id IN ("
+                "    SELECT id FROM notifications WHERE status = 'pending' AND next_attempt_at <= ? "
+                "    ORDER BY next_attempt_at, id LIMIT ?"
+                ") RETURNING id, chat_id, text, attempts",
+                (now + visibility_timeout, now, limit)
+            ).fetchall()
+        return [
+            {"id": notification_id, "chat_id": chat_id, "text": text, "attempts": attempts}
+            for notification_id, chat_id, text, attempts in sorted(rows)
+        ]
+
+    def mark_notification_sent(self, notification_id: int, now: float) -> None:
+        self._execute(
+            "UPDATE notifications SET status = 'sent', attempts = attempts + 1, sent_at = ?, error = NULL "
+            "WHERE id = ?",
+            (now, notification_id)
+        )
+
+    def mark_notification_failed(self, notification_id: int, error: str,
+                                 retry_at: Optional[float]) -> None:
+        if retry_at is None:
+            self._execute(
+                "UPDATE notifications SET status = 'failed', attempts = attempts + 1, error = ? "
+                "WHERE id = ?",
+                (error, notification_id)
+            )
+        else:
+            self._execute(
+                "UPDATE notifications SET attempts = attempts + 1, error = ?, next_attempt_at = ? "
+                "WHERE id = ?",
+                (error, retry_at, notification_id)
+            )
+
+    def prune_notifications(self, before: float) -> int:
+        cursor = self._execute(
+            "DELETE FROM notifications WHERE status != 'pending' AND created_at < ?", (before,)
+        )
+        return cursor.rowcount
+
+    def is_payment_received(self, chat_id: int, payment_date: str) -> bool:
+        row = self._fetchone(
+            "SELECT received FROM payments WHERE chat_id = ? AND payment_date = ?",
+            (chat_id, payment_date)
+        )
+        return bool(row and row[0])
+
+    def get_all_users(self) -> list:
+        rows = self._fetchall("SELECT chat_id FROM users ORDER BY chat_id")
+        return [str(chat_id) for (chat_id,) in rows]
+
+    def get_unpaid_cards(self, payment_date: str) -> list:
+        rows = self._fetchall(
+            "SELECT u.card_number, u.chat_id FROM users u "
+            "WHERE u.card_number IS NOT NULL AND u.card_number != '' "
+            "AND NOT EXISTS ("
+            "    SELECT 1 FROM payments p "
+            "    WHERE p.payment_date = ? AND p.chat_id = u.chat_id AND p.received"
+            ") ORDER BY u.card_number, u.chat_id",
+            (payment_date,)
+        )
+        return [
+            (card_number, [str(chat_id) for _, chat_id in group])
+            for card_number, group in itertools.groupby(rows, key=lambda row: row[0])
+        ]
+
+    def get_card_subscribers(self, card_number: str) -> list:
+        rows = self._fetchall(
+            "SELECT chat_id FROM users WHERE card_number = ? ORDER BY chat_id", (card_number,)
+        )
+        return [str(chat_id) for (chat_id,) in rows]
+
+    def set_balance_alert(self, chat_id: int, threshold: Optional[float]) -> None:
+        if threshold is None:
+            self._execute("DELETE FROM balance_alerts WHERE chat_id = ?", (chat_id,))
+            return
+        self._execute(
+            "INSERT INTO balance_alerts (chat_id, threshold) "
+            "SELECT chat_id, ? FROM users WHERE chat_id = ? "
+            "ON CONFLICT(chat_id) DO UPDATE SET threshold = excluded.threshold",
+            (threshold, chat_id)
+        )
+
+    def get_balance_alert(self, chat_id: int) -> Optional[dict]:
+        row = self._fetchone(
+            "SELECT threshold, baseline FROM balance_alerts WHERE chat_id = ?", (chat_id,)
+        )
+        return {"threshold": row[0], "baseline": row[1]} if row else None
+
+    def get_alert_cards(self) -> list:
+        rows = self._fetchall(
+            "SELECT u.card_number, cb.balance, a.chat_id, a.threshold, a.baseline "
+            "FROM balance_alerts a JOIN users u ON u.chat_id = a.chat_id "
+            "LEFT JOIN card_balances cb ON cb.card_number = u.card_number "
+            "WHERE u.card_number IS NOT NULL AND u.card_number != '' "
+            "ORDER BY u.card_number, a.chat_id"
+        )
+        result = []
+        for card_number, group in itertools.groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            result.append((card_number, group[0][1], [
+                (str(chat_id), threshold, baseline) for _, _, chat_id, threshold, baseline in group
+            ]))
+        return result
+
+    def record_card_balance(self, card_number: str, balance: float, now: float,
+                            alerts: list = ()) -> None:
+        with self._transaction() as conn:
+            previous = conn.execute(
+                "SELECT balance FROM card_balances WHERE card_number = ?", (card_number,)
+            ).fetchone()
+            self._record_card_balance(conn, card_number, balance, now, alerts)
+            if previous is None or previous[0] != balance:
+                subscribers = conn.execute(
+                    "SELECT a.chat_id FROM balance_alerts a JOIN users u ON u.chat_id = a.chat_id "
+                    "WHERE u.card_number = ? ORDER BY a.chat_id",
+                    (card_number,)
+                ).fetchall()
+                for (chat_id,) in subscribers:
+                    self._add_history(conn, chat_id, int(now), balance)
+
+    def _record_card_balance(self, conn: sqlite3.Connection, card_number: str, balance: float,
+                             now: float, alerts: list) -> None:
+        conn.execute(
+            "INSERT INTO card_balances (card_number, balance, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(card_number) DO UPDATE SET "
+            "balance = excluded.balance, updated_at = excluded.updated_at",
+            (card_number, balance, now)
+        )
+        for chat_id, text in alerts:
+            cursor = conn.execute(
+                "UPDATE balance_alerts SET baseline = ? WHERE chat_id = ? AND EXISTS ("
+                "    SELECT 1 FROM users WHERE chat_id = ? AND card_number = ?"
+                ")",
+                (balance, int(chat_id), int(chat_id), card_number)
+            )
+            if text is not None and cursor.rowcount:
+                self._enqueue(conn, int(chat_id), text, now)
+
+    def record_user_balance(self, chat_id: int, card_number: str, timestamp: int,
+                            balance: float) -> None:
+        with self._transaction() as conn:
+            self._add_history(conn, chat_id, timestamp, balance)
+            self._record_card_balance(conn, card_number, balance, timestamp, [(str(chat_id), None)])
+
+    def get_card_cursor(self, card_number: str) -> Optional[dict]:
+        row = self._fetchone("SELECT cursor FROM cards WHERE card_number = ?", (card_number,))
+        return json.loads(row[0]) if row and row[0] else None
+
+    def set_card_cursor(self, card_number: str, cursor: dict) -> None:
+        self._execute(
+            "INSERT INTO cards (card_number, cursor) VALUES (?, ?) "
+            "ON CONFLICT(card_number) DO UPDATE SET cursor = excluded.cursor",
+            (card_number, json.dumps(cursor))
+        )
+
+    def acquire_lease(self, name: str, owner: str, ttl: float, now: float) -> bool:
+        # Один upsert с условием: изменение проходит, только если аренда
+        # свободна, истекла или уже наша; иначе rowcount = 0
+        cursor = self._execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (name, owner, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release_lease(self, name: str, owner: str) -> None:
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def list_leases(self, prefix: str) -> list:
+        rows = self._fetchall(
+            "SELECT name, owner, expires_at FROM leases WHERE substr(name, 1, ?) = ? ORDER BY name",
+            (len(prefix), prefix)
+        )
+        return [tuple(row) for row in rows]
+
+    def get_fsm_record(self, key: str, now: float) -> Optional[dict]:
+        row = self._fetchone(
+            "SELECT state, data, expires_at FROM fsm_states WHERE key = ? AND expires_at > ?",
+            (key, now)
+        )
+        if row is None:
+            return None
+        return {"state": row[0], "data": json.loads(row[1]), "expires_at": row[2]}
+
+    def update_fsm_record(self, key: str, changes: dict, expires_at: float,
+                          now: float) -> Optional[dict]:
+        # Чтение и запись в одной транзакции: реплики меняют запись по очереди
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT state, data, expires_at FROM fsm_states WHERE key = ?", (key,)
+            ).fetchone()
+            current = {"state": row[0], "data": json.loads(row[1]), "expires_at": row[2]} if row else None
+            record = apply_fsm_changes(current, changes, expires_at, now)
+            if record is None:
+                conn.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+            else:
+                conn.execute(
+                    "INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                    "data = excluded.data, expires_at = excluded.expires_at",
+                    (key, record["state"], json.dumps(record["data"], ensure_ascii=False), expires_at)
+                )
+        return record
+
+    def prune_fsm_records(self, now: float) -> int:
+        cursor = self._execute("DELETE FROM fsm_states WHERE expires_at <= ?", (now,))
+        return cursor.rowcount
+
+    def import_user(self, chat_id: int, user_data: dict) -> None:
+        """Записывает пользователя целиком (история и выплаты) одной транзакцией"""
+        balance_history = history.normalize_history(user_data.get("balance_history"))
+        rollups = user_data.get("balance_rollups") or history.empty_rollups()
+
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
+            conn.execute(
+                "INSERT INTO users (chat_id, card_number) VALUES (?, ?)",
+                (chat_id, user_data.get("card_number"))
+            )
+            conn.executemany(
+                "INSERT INTO balance_history (chat_id, ts, balance) VALUES (?, ?, ?)",
+                [(chat_id, ts, balance) for ts, balance in history.select_range(balance_history)]
+            )
+            conn.executemany(
+                "INSERT INTO balance_stats (chat_id, day, min, max, sum, n, spent) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (chat_id,) + tuple(bucket) for bucket in history.select_buckets(
+                        history.stats_from_history(balance_history), fields=history.STATS_FIELDS
+                    )
+                ]
+            )
+            for level in history.BUCKET_LEVELS:
+                self._upsert_buckets(
+                    conn, chat_id, level, list(history.iter_buckets(rollups[level]))
+                )
+            conn.executemany(
+                "INSERT INTO payments (chat_id, payment_date, received, timestamp, amount) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [
+                    (chat_id, payment_date, int(bool(payment.get("received", True))),
+                     payment.get("timestamp"), payment.get("amount"))
+                    for payment_date, payment in user_data.get("payments", {}).items()
+                ]
+            )
+            alert = user_data.get("balance_alert")
+            if alert:
+                conn.execute(
+                    "INSERT INTO balance_alerts (chat_id, threshold, baseline) VALUES (?, ?, ?)",
+                    (chat_id, alert["threshold"], alert.get("baseline"))
+                )
+
+    def iter_users(self, batch_size: int = 500):
+        # Постраничный перебор по ключу: память не зависит от размера базы
+        last_chat_id = -2 ** 63
+        while True:
+            users = self._fetchall(
+                "SELECT chat_id, card_number FROM users WHERE chat_id > ? ORDER BY chat_id LIMIT ?",
+                (last_chat_id, batch_size)
+            )
+            if not users:
+                return
+            last_chat_id = users[-1][0]
+            first_chat_id = users[0][0]
+
+            records = {
+                chat_id: {
+                    "card_number": card_number,
+                    "balance_history": history.empty_history(),
+                    "balance_rollups": history.empty_rollups(),
+                    "payments": {}
+                }
+                for chat_id, card_number in users
+            }
+            bounds = (first_chat_id, last_chat_id)
+            for chat_id, ts, balance in self._fetchall(
+                "SELECT chat_id, ts, balance FROM balance_history "
+                "WHERE chat_id BETWEEN ? AND ? ORDER BY chat_id, ts, rowid", bounds
+            ):
+                columns = records[chat_id]["balance_history"]
+                columns["t"].append(ts)
+                columns["b"].append(balance)
+            for chat_id, level, *bucket in self._fetchall(
+                "SELECT chat_id, level, start, min, max, last, n FROM balance_rollups "
+                "WHERE chat_id BETWEEN ? AND ? ORDER BY chat_id, level, start", bounds
+            ):
+                columns = records[chat_id]["balance_rollups"][level]
+                for field, value in zip(history.BUCKET_FIELDS, bucket):
+                    columns[field].append(value)
+            for chat_id, payment_date, received, timestamp, amount in self._fetchall(
+                "SELECT chat_id, payment_date, received, timestamp, amount FROM payments "
+                "WHERE chat_id BETWEEN ? AND ?", bounds
+            ):
+                records[chat_id]["payments"][payment_date] = {
+                    "received": bool(received),
+                    "timestamp": timestamp,
+                    "amount": amount
+                }
+            for chat_id, threshold, baseline in self._fetchall(
+                "SELECT chat_id, threshold, baseline FROM balance_alerts "
+                "WHERE chat_id BETWEEN ? AND ?", bounds
+            ):
+                records[chat_id]["balance_alert"] = {"threshold": threshold, "baseline": baseline}
+
+            yield from records.items()
+
+    def migrate_legacy_users(self) -> int:
+        # Старая схема переводится целиком при открытии базы (_migrate_schema)
+        return 0
+
+    def check_integrity(self) -> list:
+        problems = [
+            f"integrity_check: {row[0]}"
+            for row in self._fetchall("PRAGMA integrity_check") if row[0] != "ok"
+        ]
+        problems.extend(
+            f"foreign_key_check: {table} row {rowid} references missing {parent}"
+            for table, rowid, parent, _ in self._fetchall("PRAGMA foreign_key_check")
+        )
+        return problems
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
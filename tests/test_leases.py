@@ -0,0 +1,190 @@
+"""
+Аренды в хранилище и раздача шардов проверки между процессами
+
+    python -m unittest discover -s tests -t .
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import database
+from sharding import ShardLeases
+from storage import JsonStorage, SqliteStorage
+
+
+class FakeClock:
+    """Подменяет time.time, чтобы аренды истекали без ожидания"""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class LeaseStorageMixin:
+    """Общие проверки acquire/renew/release для обоих бэкендов"""
+
+    def open_storage(self, path: str):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = self.open_storage(os.path.join(self.directory, "db"))
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.directory)
+
+    def test_free_lease_is_acquired(self):
+        self.assertTrue(self.storage.acquire_lease("shard:1", "a", 10, 100))
+        self.assertEqual(self.storage.list_leases("shard:"), [("shard:1", "a", 110)])
+
+    def test_live_lease_is_not_taken_by_another_owner(self):
+        self.storage.acquire_lease("shard:1", "a", 10, 100)
+        self.assertFalse(self.storage.acquire_lease("shard:1", "b", 10, 105))
+        # Ровно в момент истечения аренда еще действует
+        self.assertFalse(self.storage.acquire_lease("shard:1", "b", 10, 110))
+        self.assertEqual(self.storage.list_leases("shard:"), [("shard:1", "a", 110)])
+
+    def test_owner_renews_its_lease(self):
+        self.storage.acquire_lease("shard:1", "a", 10, 100)
+        self.assertTrue(self.storage.acquire_lease("shard:1", "a", 10, 108))
+        self.assertEqual(self.storage.list_leases("shard:"), [("shard:1", "a", 118)])
+        self.assertFalse(self.storage.acquire_lease("shard:1", "b", 10, 112))
+
+    def test_expired_lease_is_taken_over(self):
+        self.storage.acquire_lease("shard:1", "a", 10, 100)
+        self.assertTrue(self.storage.acquire_lease("shard:1", "b", 10, 111))
+        self.assertEqual(self.storage.list_leases("shard:"), [("shard:1", "b", 121)])
+        # Прежний владелец не может продлить отобранную аренду
+        self.assertFalse(self.storage.acquire_lease("shard:1", "a", 10, 112))
+
+    def test_only_owner_releases(self):
+        self.storage.acquire_lease("shard:1", "a", 10, 100)
+        self.storage.release_lease("shard:1", "b")
+        self.assertEqual(len(self.storage.list_leases("shard:")), 1)
+        self.storage.release_lease("shard:1", "a")
+        self.assertEqual(self.storage.list_leases("shard:"), [])
+        self.assertTrue(self.storage.acquire_lease("shard:1", "b", 10, 101))
+
+    def test_list_leases_filters_by_prefix(self):
+        self.storage.acquire_lease("payment-shard:1", "a", 10, 100)
+        self.storage.acquire_lease("payment-worker:a", "a", 10, 100)
+        self.storage.acquire_lease("balance-shard:1", "a", 10, 100)
+        self.assertEqual([name for name, _, _ in self.storage.list_leases("payment-shard:")],
+                         ["payment-shard:1"])
+
+
+class SqliteLeaseTest(LeaseStorageMixin, unittest.TestCase):
+    def open_storage(self, path: str):
+        return SqliteStorage(path + ".sqlite3")
+
+
+class JsonLeaseTest(LeaseStorageMixin, unittest.TestCase):
+    def open_storage(self, path: str):
+        return JsonStorage(path + ".json", flush_interval=0)
+
+
+class ShardLeasesTest(unittest.IsolatedAsyncioTestCase):
+    """Несколько процессов с общей базой SQLite"""
+
+    SHARDS = 16
+    TTL = 30.0
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = SqliteStorage(os.path.join(self.directory, "db.sqlite3"))
+        self.clock = FakeClock()
+        patches = [mock.patch.object(database, "_storage", self.storage),
+                   mock.patch("time.time", self.clock)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.directory)
+
+    def worker(self, owner: str) -> ShardLeases:
+        return ShardLeases(shards=self.SHARDS, ttl=self.TTL, owner=owner)
+
+    def assert_disjoint(self, *workers: ShardLeases):
+        seen = set()
+        for worker in workers:
+            self.assertFalse(seen & worker.owned, f"{worker.owner} holds a shard of another worker")
+            seen |= worker.owned
+        # Владение в процессе совпадает с арендами в базе
+        leased = {name: owner for name, owner, _ in self.storage.list_leases("payment-shard:")}
+        for worker in workers:
+            for shard in worker.owned:
+                self.assertEqual(leased.get(f"payment-shard:{shard}"), worker.owner)
+
+    async def test_single_worker_takes_all_shards(self):
+        a = self.worker("a")
+        self.assertTrue(await a.refresh())
+        self.assertEqual(a.owned, set(range(self.SHARDS)))
+        self.assertFalse(await a.refresh())
+
+    async def test_workers_split_shards_without_overlap(self):
+        a, b = self.worker("a"), self.worker("b")
+        await a.refresh()
+        await b.refresh()
+        # Все шарды заняты живым процессом a, b ждет, пока тот отдаст лишние
+        self.assertEqual(b.owned, set())
+        self.assert_disjoint(a, b)
+
+        for _ in range(3):
+            self.clock.now += a.renew_interval
+            await a.refresh()
+            self.assert_disjoint(a, b)
+            await b.refresh()
+            self.assert_disjoint(a, b)
+
+        self.assertEqual(len(a.owned), self.SHARDS // 2)
+        self.assertEqual(len(b.owned), self.SHARDS // 2)
+        self.assertEqual(a.owned | b.owned, set(range(self.SHARDS)))
+
+    async def test_three_workers_cover_every_shard_once(self):
+        workers = [self.worker(name) for name in ("a", "b", "c")]
+        for _ in range(4):
+            for worker in workers:
+                await worker.refresh()
+                self.assert_disjoint(*workers)
+            self.clock.now += self.TTL / 3
+
+        owned = [worker.owned for worker in workers]
+        self.assertEqual(set().union(*owned), set(range(self.SHARDS)))
+        self.assertTrue(all(len(shards) <= 6 for shards in owned))
+
+    async def test_shards_of_a_stopped_worker_are_taken_after_expiry(self):
+        a, b = self.worker("a"), self.worker("b")
+        for _ in range(3):
+            await a.refresh()
+            await b.refresh()
+        a_shards = set(a.owned)
+        self.assertTrue(a_shards)
+
+        # a перестал продлевать аренды: до истечения его шарды не трогают
+        self.clock.now += self.TTL / 2
+        await b.refresh()
+        self.assertFalse(b.owned & a_shards)
+
+        self.clock.now += self.TTL
+        await b.refresh()
+        self.assertEqual(b.owned, set(range(self.SHARDS)))
+
+    async def test_release_all_frees_shards_immediately(self):
+        a, b = self.worker("a"), self.worker("b")
+        await a.refresh()
+        await a.release_all()
+        self.assertEqual(a.owned, set())
+        await b.refresh()
+        self.assertEqual(b.owned, set(range(self.SHARDS)))
+
+
+if __name__ == "__main__":
+    unittest.main()
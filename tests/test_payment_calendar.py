@@ -0,0 +1,129 @@
+"""
+Праздники Норвегии, перенос дат выплат и окна проверки
+
+    python -m unittest discover -s tests -t .
+"""
+
+import unittest
+from datetime import date, datetime
+
+import pytz
+
+from payment_calendar import (
+    PaymentCalendar,
+    easter_sunday,
+    is_business_day,
+    norwegian_holidays,
+    shift_to_business_day
+)
+
+TIMEZONE = "Europe/Oslo"
+
+
+def oslo(year: int, month: int, day: int, hour: int = 0) -> float:
+    return pytz.timezone(TIMEZONE).localize(datetime(year, month, day, hour)).timestamp()
+
+
+def make_calendar(payment_dates=(1, 16), shift_rule: str = "previous") -> PaymentCalendar:
+    return PaymentCalendar(payment_dates=payment_dates, days_before=2, days_after=2,
+                           timezone=TIMEZONE, shift_rule=shift_rule, months=12)
+
+
+class HolidaysTest(unittest.TestCase):
+    def test_easter_sunday(self):
+        self.assertEqual(easter_sunday(2018), date(2018, 4, 1))
+        self.assertEqual(easter_sunday(2019), date(2019, 4, 21))
+        self.assertEqual(easter_sunday(2024), date(2024, 3, 31))
+        self.assertEqual(easter_sunday(2025), date(2025, 4, 20))
+        self.assertEqual(easter_sunday(2038), date(2038, 4, 25))
+
+    def test_holidays_2025(self):
+        self.assertEqual(norwegian_holidays(2025), frozenset({
+            date(2025, 1, 1),
+            date(2025, 4, 17), date(2025, 4, 18), date(2025, 4, 20), date(2025, 4, 21),
+            date(2025, 5, 1), date(2025, 5, 17),
+            date(2025, 5, 29),
+            date(2025, 6, 8), date(2025, 6, 9),
+            date(2025, 12, 25), date(2025, 12, 26),
+        }))
+
+    def test_business_days(self):
+        self.assertTrue(is_business_day(date(2025, 4, 16)))
+        self.assertFalse(is_business_day(date(2025, 4, 17)))   # Skjærtorsdag
+        self.assertFalse(is_business_day(date(2025, 5, 29)))   # Kristi himmelfartsdag
+        self.assertFalse(is_business_day(date(2025, 11, 15)))  # суббота
+        self.assertTrue(is_business_day(date(2025, 12, 24)))   # сочельник - рабочий день
+
+
+class ShiftTest(unittest.TestCase):
+    def test_easter_monday_payment(self):
+        # 1 апреля 2024 - Andre påskedag; перед ним пасха, суббота и два праздника
+        self.assertEqual(shift_to_business_day(date(2024, 4, 1), "previous"), date(2024, 3, 27))
+        self.assertEqual(shift_to_business_day(date(2024, 4, 1), "next"), date(2024, 4, 2))
+
+    def test_easter_sunday_payment(self):
+        self.assertEqual(shift_to_business_day(date(2018, 4, 1), "previous"), date(2018, 3, 28))
+        self.assertEqual(shift_to_business_day(date(2018, 4, 1), "next"), date(2018, 4, 3))
+
+    def test_fixed_holiday_payment(self):
+        self.assertEqual(shift_to_business_day(date(2025, 5, 1), "previous"), date(2025, 4, 30))
+        self.assertEqual(shift_to_business_day(date(2025, 5, 1), "next"), date(2025, 5, 2))
+        # Перенос назад через границу года
+        self.assertEqual(shift_to_business_day(date(2025, 1, 1), "previous"), date(2024, 12, 31))
+
+    def test_weekend_payment(self):
+        self.assertEqual(shift_to_business_day(date(2025, 11, 16), "previous"), date(2025, 11, 14))
+        self.assertEqual(shift_to_business_day(date(2025, 11, 16), "next"), date(2025, 11, 17))
+
+    def test_business_day_is_not_shifted(self):
+        for rule in ("previous", "next", "none"):
+            self.assertEqual(shift_to_business_day(date(2025, 4, 16), rule), date(2025, 4, 16))
+
+    def test_no_shift(self):
+        self.assertEqual(shift_to_business_day(date(2024, 4, 1), "none"), date(2024, 4, 1))
+
+    def test_unknown_rule(self):
+        with self.assertRaises(ValueError):
+            make_calendar(shift_rule="nearest")
+
+
+class PaymentCalendarTest(unittest.TestCase):
+    def test_window_of_shifted_payment(self):
+        window = make_calendar().window_for("2024-04-01")
+        self.assertEqual(window.period, "2024-04-01")
+        self.assertEqual(window.payday, date(2024, 3, 27))
+        self.assertEqual(window.start_date, date(2024, 3, 25))
+        self.assertEqual(window.start, oslo(2024, 3, 25))
+        self.assertEqual(window.payday_start, oslo(2024, 3, 27))
+        self.assertEqual(window.end, oslo(2024, 3, 29))
+
+    def test_current_period_follows_shifted_payday(self):
+        calendar = make_calendar()
+        self.assertIsNone(calendar.current_period(oslo(2024, 3, 24, 12)))
+        self.assertEqual(calendar.current_period(oslo(2024, 3, 25, 12)), "2024-04-01")
+        self.assertEqual(calendar.current_period(oslo(2024, 3, 28, 23)), "2024-04-01")
+        # Плановая дата выплаты уже вне окна: выплата пришла 27 марта
+        self.assertIsNone(calendar.current_period(oslo(2024, 4, 1, 12)))
+        self.assertEqual(calendar.current_period(oslo(2024, 4, 15, 12)), "2024-04-16")
+
+    def test_next_window_start(self):
+        calendar = make_calendar()
+        self.assertEqual(calendar.next_window_start(oslo(2024, 3, 20)), oslo(2024, 3, 25))
+        self.assertEqual(calendar.next_window_start(oslo(2024, 3, 26)), oslo(2024, 4, 14))
+
+    def test_missing_day_uses_end_of_month(self):
+        calendar = make_calendar(payment_dates=(31,))
+        self.assertEqual(calendar.current_period(oslo(2025, 2, 27, 12)), "2025-02-28")
+        self.assertEqual(calendar.window_for("2025-02-28").payday, date(2025, 2, 28))
+
+    def test_dates_shifted_to_one_payday_are_one_payment(self):
+        # 16 и 17 мая 2026: суббота и Grunnlovsdag (воскресенье) - обе на пятницу 15-го
+        calendar = make_calendar(payment_dates=(16, 17))
+        calendar.build(oslo(2026, 5, 1))
+        paydays = [window.payday for window in calendar._windows]
+        self.assertEqual(paydays.count(date(2026, 5, 15)), 1)
+        self.assertEqual(calendar.current_period(oslo(2026, 5, 14, 12)), "2026-05-16")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Режим webhook: aiohttp сервер с обработчиком обновлений aiogram
+"""
+
+import asyncio
+import logging
+import re
+import signal
+from typing import Callable
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from config import (
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    HEALTH_PATH
+)
+
+# Допустимый секрет webhook по документации Telegram
+SECRET_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")
+
+logger = logging.getLogger(__name__)
+
+
+def build_app(dp: Dispatcher, bot: Bot, is_healthy: Callable[[], bool]) -> web.Application:
+    """
+    Собирает aiohttp приложение: обработчик webhook с проверкой
+    секретного токена и endpoint для проверки состояния
+    """
+    app = web.Application()
+
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    async def health_handler(request: web.Request) -> web.Response:
+        if is_healthy():
+            return web.json_response({"status": "ok"})
+        return web.json_response({"status": "unhealthy"}, status=503)
+
+    app.router.add_get(HEALTH_PATH, health_handler)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, is_healthy: Callable[[], bool]) -> None:
+    """
+    Регистрирует webhook в Telegram и обслуживает обновления до SIGINT/SIGTERM
+    При остановке новые запросы перестают приниматься, а начатые дорабатывают
+    """
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("WEBHOOK_BASE_URL must be set when BOT_MODE=webhook")
+    # Без секрета обновления принимались бы от любого, кто знает адрес.
+    # Случайный секрет не подходит: реплики перезаписывали бы секрет друг друга
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET must be set when BOT_MODE=webhook")
+    if not SECRET_TOKEN_RE.match(WEBHOOK_SECRET):
+        raise RuntimeError("WEBHOOK_SECRET must be 1-256 characters of A-Z, a-z, 0-9, _ and -")
+
+    app = build_app(dp, bot, is_healthy)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows: остановка через KeyboardInterrupt
+            pass
+
+    try:
+        await site.start()
+        await bot.set_webhook(
+            url=WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info("Webhook server listening on %s:%s", WEBHOOK_HOST, WEBHOOK_PORT)
+        await stop.wait()
+    finally:
+        # Webhook не удаляем: другие реплики за балансировщиком продолжают работу
+        await runner.cleanup()